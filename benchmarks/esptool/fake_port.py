@@ -0,0 +1,113 @@
+"""In-memory stand-in for a serial port connected to a chip running the esptool flasher stub.
+
+FakeStubPort parses the SLIP frames written by ESPLoader, executes the flash commands
+against a bytearray and queues the replies, so the host side of write_flash, verify_flash
+and read_flash can be timed without hardware.
+"""
+import hashlib
+import struct
+import zlib
+
+ESP_FLASH_BEGIN = 0x02
+ESP_FLASH_DATA = 0x03
+ESP_FLASH_END = 0x04
+ESP_READ_REG = 0x0a
+ESP_FLASH_DEFL_BEGIN = 0x10
+ESP_FLASH_DEFL_DATA = 0x11
+ESP_FLASH_DEFL_END = 0x12
+ESP_SPI_FLASH_MD5 = 0x13
+ESP_READ_FLASH = 0xD2
+
+
+def slip_frame(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+class FakeStubPort(object):
+    """ Serial port look-alike backed by flash_size bytes of emulated SPI flash """
+
+    def __init__(self, flash_size):
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.port = 'fake://stub'
+        self.baudrate = 115200
+        self.timeout = 3
+        self.write_timeout = None
+        self.dtr = False
+        self._rx = bytearray()  # bytes waiting to be read by the host
+        self._rx_pos = 0
+        self._write_offset = 0
+        self._block_size = 0
+        self._inflate = None
+
+    # pyserial interface used by ESPLoader
+
+    def write(self, data):
+        for frame in bytes(data).split(b'\xc0'):
+            if frame:
+                self._handle(frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb'))
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self._rx[self._rx_pos:self._rx_pos + size])
+        self._rx_pos += len(data)
+        if self._rx_pos == len(self._rx):
+            self._rx = bytearray()
+            self._rx_pos = 0
+        return data
+
+    def inWaiting(self):
+        return len(self._rx) - self._rx_pos
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def flushInput(self):
+        self._rx = bytearray()
+        self._rx_pos = 0
+
+    reset_input_buffer = flushInput
+
+    def setDTR(self, state):
+        self.dtr = state
+
+    def setRTS(self, state):
+        pass
+
+    # stub side
+
+    def _reply(self, op, value=0, data=b''):
+        body = data + b'\x00\x00'  # status and error bytes of the stub
+        self._rx += slip_frame(struct.pack('<BBHI', 1, op, len(body), value) + body)
+
+    def _handle(self, packet):
+        if len(packet) < 8 or packet[0] != 0:
+            return  # acknowledgement of a read_flash packet, nothing to do
+        op, = struct.unpack('<B', packet[1:2])
+        data = packet[8:]
+        if op in (ESP_FLASH_BEGIN, ESP_FLASH_DEFL_BEGIN):
+            size, _, self._block_size, self._write_offset = struct.unpack('<IIII', data[:16])
+            self.flash[self._write_offset:self._write_offset + size] = b'\xff' * size
+            self._inflate = zlib.decompressobj() if op == ESP_FLASH_DEFL_BEGIN else None
+        elif op == ESP_FLASH_DATA:
+            length, seq = struct.unpack('<II', data[:8])
+            offs = self._write_offset + seq * self._block_size
+            self.flash[offs:offs + length] = data[16:16 + length]
+        elif op == ESP_FLASH_DEFL_DATA:
+            length = struct.unpack('<I', data[:4])[0]
+            chunk = self._inflate.decompress(data[16:16 + length])
+            self.flash[self._write_offset:self._write_offset + len(chunk)] = chunk
+            self._write_offset += len(chunk)
+        elif op == ESP_SPI_FLASH_MD5:
+            addr, size = struct.unpack('<II', data[:8])
+            self._reply(op, data=hashlib.md5(self.flash[addr:addr + size]).digest())
+            return
+        elif op == ESP_READ_FLASH:
+            addr, size, sector_size, _ = struct.unpack('<IIII', data[:16])
+            self._reply(op)
+            content = bytes(self.flash[addr:addr + size])
+            for offs in range(0, size, sector_size):
+                self._rx += slip_frame(content[offs:offs + sector_size])
+            self._rx += slip_frame(hashlib.md5(content).digest())
+            return
+        self._reply(op)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""Host-side performance benchmarks for esptool.py.
+
+Times SLIP encoding/decoding, the image checksum, _update_image_flash_params, zlib
+compression and the complete write_flash, verify_flash and read_flash loops against an
+in-memory fake stub port (fake_port.py), using a bootloader, an application and a mostly
+empty filesystem image generated deterministically on each run.
+
+Throughput is reported in MB/s of image data and peak memory as the tracemalloc peak of
+one run. Results are compared against a stored baseline, and the script exits with
+status 1 if a benchmark got slower (or needs more memory) than the threshold allows:
+
+    python run_benchmarks.py --save-baseline     # on the reference machine, before a change
+    python run_benchmarks.py --require-baseline  # after the change
+
+The baseline depends on the machine, so none is committed. Without --require-baseline
+a missing baseline (or a benchmark missing in it) is only reported; with it, as in CI,
+that fails with status 2.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', '..'))
+
+import esptool  # noqa: E402
+from fake_port import FakeStubPort, slip_frame  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+FLASH_SIZE = 0x400000
+BOOTLOADER_ADDRESS = 0x0
+APP_ADDRESS = 0x10000
+FS_ADDRESS = 0x200000
+
+
+def make_bootloader():
+    """ ~20KB ESP32-S3 second stage bootloader with appended SHA-256 """
+    rng = random.Random(1)
+    image = esptool.ESP32S3FirmwareImage()
+    image.entrypoint = 0x403c9000
+    image.flash_mode = 2
+    image.flash_size_freq = 0x20
+    image.append_digest = True
+    for addr, size in ((0x3fcd5000, 0x1800), (0x403cc000, 0x3200), (0x403ce000, 0x0c00)):
+        data = esptool.autotune_sample(size)
+        image.segments.append(esptool.ImageSegment(addr, data[:rng.randrange(size // 2, size) & ~3]))
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+    try:
+        image.save(path)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def make_app():
+    """ 1MB of application-like data: code, strings, already compressed assets and padding """
+    return esptool.autotune_sample(0x100000)
+
+
+def make_filesystem():
+    """ 1MB FAT-like partition: a few small files at the start, the rest erased """
+    rng = random.Random(3)
+    data = bytearray(b'\xff' * 0x100000)
+    offs = 0
+    for _ in range(24):
+        size = rng.randint(0x200, 0x2000)
+        data[offs:offs + size] = esptool.autotune_sample(size)
+        offs += (size + 0xfff) & ~0xfff
+    return bytes(data)
+
+
+class Image(object):
+    def __init__(self, name, address, data):
+        self.name = name
+        self.address = address
+        self.data = data
+
+
+def make_images():
+    return [Image('bootloader', BOOTLOADER_ADDRESS, make_bootloader()),
+            Image('app', APP_ADDRESS, make_app()),
+            Image('fs', FS_ADDRESS, make_filesystem())]
+
+
+def connect():
+    """ Stub loader talking to a fresh fake port """
+    port = FakeStubPort(FLASH_SIZE)
+    rom = esptool.ESP32S3ROM(port, 115200)
+    return esptool.ESP32S3StubLoader(rom), port
+
+
+def flash_args(images, **kwargs):
+    args = argparse.Namespace(addr_filename=[(img.address, io.BytesIO(img.data)) for img in images],
+                              flash_mode='dio', flash_freq='80m', flash_size='4MB', erase_all=False,
+                              compress=None, no_compress=False, no_stub=False, compress_level=None,
+                              no_flash_profile=True, encrypt=False, encrypt_files=None,
+                              ignore_flash_encryption_efuse_setting=False, verify=False, diff='no')
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    for _, f in args.addr_filename:
+        f.name = 'memory'
+    return args
+
+
+class NullPort(object):
+    def write(self, data):
+        return len(data)
+
+
+class FrameSource(object):
+    """ Minimal port serving a prepared byte stream to slip_reader """
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def inWaiting(self):
+        return len(self._data) - self._pos
+
+    def read(self, size=1):
+        data = self._data[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def bench_slip_encode(images):
+    loader = esptool.ESP32S3StubLoader.__new__(esptool.ESP32S3StubLoader)
+    loader._port = NullPort()
+    loader._trace_enabled = False
+    data = b''.join(img.data for img in images)
+    for offs in range(0, len(data), 0x4000):
+        loader.write(data[offs:offs + 0x4000])
+    return len(data)
+
+
+def bench_slip_decode(images):
+    data = b''.join(img.data for img in images)
+    frames = [data[offs:offs + 0x1000] for offs in range(0, len(data), 0x1000)]
+    reader = esptool.slip_reader(FrameSource(b''.join(slip_frame(f) for f in frames)), lambda *args: None)
+    for _ in frames:
+        next(reader)
+    return len(data)
+
+
+def bench_checksum(images):
+    data = b''.join(img.data for img in images)
+    for offs in range(0, len(data), 0x4000):
+        esptool.ESPLoader.checksum(data[offs:offs + 0x4000])
+    return len(data)
+
+
+def bench_update_image_flash_params(images):
+    # only the image at the bootloader offset is parsed and patched
+    esp = esptool.ESP32S3ROM.__new__(esptool.ESP32S3ROM)
+    args = flash_args(images)
+    bootloader = images[0]
+    for _ in range(50):
+        esptool._update_image_flash_params(esp, bootloader.address, args, bootloader.data)
+    return 50 * len(bootloader.data)
+
+
+def bench_compress(images):
+    import zlib
+    for img in images:
+        zlib.compress(img.data, 9)
+    return sum(len(img.data) for img in images)
+
+
+def bench_write_flash(images):
+    esp, port = connect()
+    esptool.write_flash(esp, flash_args(images))
+    for img in images:
+        written = bytes(port.flash[img.address:img.address + len(img.data)])
+        if written[4:] != esptool.pad_to(img.data, 4)[4:]:
+            raise RuntimeError('write_flash wrote wrong data for %s' % img.name)
+    return sum(len(img.data) for img in images)
+
+
+def bench_verify_flash(images):
+    esp, port = connect()
+    for img in images:
+        port.flash[img.address:img.address + len(img.data)] = img.data
+    esptool.verify_flash(esp, flash_args(images, flash_mode='keep', flash_freq='keep', flash_size='keep'))
+    return sum(len(img.data) for img in images)
+
+
+def bench_read_flash(images):
+    esp, port = connect()
+    for img in images:
+        port.flash[img.address:img.address + len(img.data)] = img.data
+    for img in images:
+        if esp.read_flash(img.address, len(img.data)) != img.data:
+            raise RuntimeError('read_flash returned wrong data for %s' % img.name)
+    return sum(len(img.data) for img in images)
+
+
+BENCHMARKS = [
+    ('slip_encode', bench_slip_encode),
+    ('slip_decode', bench_slip_decode),
+    ('checksum', bench_checksum),
+    ('update_image_flash_params', bench_update_image_flash_params),
+    ('compress', bench_compress),
+    ('write_flash', bench_write_flash),
+    ('verify_flash', bench_verify_flash),
+    ('read_flash', bench_read_flash),
+]
+
+
+def run(func, images, repeat):
+    """ Return (MB/s of the fastest run, tracemalloc peak in KiB of a separate run) """
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            t = time.perf_counter()
+            size = func(images)
+            elapsed = time.perf_counter() - t
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start()
+        try:
+            func(images)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return size / 1e6 / max(best, 1e-9), peak / 1024
+
+
+def compare(results, baseline, threshold):
+    """ Return a list of regression messages """
+    regressions = []
+    for name, result in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            continue
+        if result['mb_s'] < ref['mb_s'] * (1 - threshold):
+            regressions.append('%s: %.2f MB/s, baseline %.2f MB/s' % (name, result['mb_s'], ref['mb_s']))
+        # small absolute allowance so tiny allocations don't flap
+        if result['peak_kib'] > ref['peak_kib'] * (1 + threshold) + 64:
+            regressions.append('%s: peak %.0f KiB, baseline %.0f KiB' % (name, result['peak_kib'], ref['peak_kib']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='esptool.py host-side performance benchmarks')
+    parser.add_argument('--baseline', help='Baseline JSON file (default: %(default)s)', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', help='Store the results as the new baseline', action='store_true')
+    parser.add_argument('--require-baseline', help='Fail if the baseline or a benchmark in it is missing',
+                        action='store_true')
+    parser.add_argument('--threshold', help='Allowed relative regression (default: %(default)s)', type=float,
+                        default=0.2)
+    parser.add_argument('--repeat', help='Timed runs per benchmark, the fastest counts (default: %(default)s)',
+                        type=int, default=3)
+    parser.add_argument('--only', help='Run only the named benchmarks', nargs='+',
+                        choices=[name for name, _ in BENCHMARKS])
+    args = parser.parse_args()
+
+    images = make_images()
+    print('Images: %s' % ', '.join('%s %d bytes' % (img.name, len(img.data)) for img in images))
+    results = {}
+    print('%-27s %10s %12s' % ('benchmark', 'MB/s', 'peak KiB'))
+    for name, func in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        mb_s, peak_kib = run(func, images, args.repeat)
+        results[name] = {'mb_s': round(mb_s, 3), 'peak_kib': round(peak_kib, 1)}
+        print('%-27s %10.2f %12.0f' % (name, mb_s, peak_kib))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'host': platform.platform(), 'python': platform.python_version(), 'results': results},
+                      f, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save-baseline to create one.' % args.baseline)
+        return 2 if args.require_baseline else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('host') != platform.platform():
+        print('WARNING: baseline was recorded on %s, results may not be comparable.' % baseline.get('host'))
+    missing = sorted(set(results) - set(baseline['results']))
+    if missing:
+        print('No baseline for %s' % ', '.join(missing))
+        if args.require_baseline:
+            return 2
+    regressions = compare(results, baseline['results'], args.threshold)
+    for message in regressions:
+        print('REGRESSION %s' % message)
+    if not regressions:
+        print('No regressions beyond %d%% against %s' % (args.threshold * 100, args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
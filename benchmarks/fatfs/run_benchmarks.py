@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+"""Benchmark suite of FAT image generation, wear levelling and parsing with synthetic trees.
+
+Builds deterministic synthetic trees and runs the stages of the image pipeline on each of them
+for every sector size:
+
+    generate          fatfsgen.FATFS.generate into the mapped output file, as fatfsgen.py does
+    generate_memory   fatfsgen.FATFS.generate into the image in the memory
+    generate_legacy   every file is read whole and written with FATFS.write_content,
+                      the way the images were built before generate streamed the files
+    wl                wl_fatfsgen.add_wl wraps the plain image into the wear levelling layer
+    parse             fatfsparse: the WL layer is detected and removed, all directories are parsed
+                      and all files are read from the mapped image
+    extract           FATImage.extract of the WL image into an empty directory
+
+The trees are:
+
+    small_files   thousands of small files spread over a few directories
+    deep          deeply nested directories with a few files on each level
+    long_names    files with long names (several LFN entries each)
+    large         a few multi-MiB files
+    wide_short    thousands of empty files with short (8.3) names in one directory
+    wide_long     thousands of empty files with long names in one directory
+
+The wide trees show how the lookup and the allocation of the directory entries scale,
+run them with several --wide-files values to see the time per file. This script replaces
+the former bench_large_assets.py (the generate stages of the large tree) and
+bench_directory_scaling.py (the wide trees).
+
+Each stage runs in a separate process, so its peak RSS is not shared with the other stages;
+the time is measured in the process around the stage only (without the interpreter start
+and the imports). The fastest of the runs and the largest peak RSS count. The images of the three
+generate stages must be identical apart from the random volume ID, the parsed and the extracted
+content is checked against the tree.
+
+Results are compared against a stored baseline, and the script exits with status 1 if a stage
+got slower (or needs more memory) than the threshold allows:
+
+    python run_benchmarks.py --save-baseline     # on the reference machine, before a change
+    python run_benchmarks.py --require-baseline  # after the change
+
+The baseline depends on the machine, so none is committed. Without --require-baseline
+a missing baseline (or a stage missing in it) is only reported; with it, as in CI,
+that fails with status 2.
+"""
+import argparse
+import filecmp
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FATFS_DIR = os.path.join(HERE, '..', '..', 'fatfs')
+sys.path.append(FATFS_DIR)
+
+import fatfsgen  # noqa: E402
+import fatfsparse  # noqa: E402
+import wl_fatfsgen  # noqa: E402
+from fatfs_utils.fat_image import FATImage  # noqa: E402
+from fatfs_utils.partition_plan import PartitionPlan  # noqa: E402
+from fatfs_utils.utils import map_filesystem  # noqa: E402
+from wl_fatfsgen import WLFATFS  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+SCENARIOS = ('small_files', 'deep', 'long_names', 'large', 'wide_short', 'wide_long')
+STAGES = ('generate', 'generate_memory', 'generate_legacy', 'wl', 'parse', 'extract')
+GENERATE_STAGES = {'generate': 'plain_image', 'generate_memory': 'memory_image', 'generate_legacy': 'legacy_image'}
+VOLUME_ID = slice(39, 43)
+WL_SECTOR_SIZE = 0x1000
+READ_CHUNK = 0x10000
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def make_small_files(root, rng, args):
+    """ Small files of up to 1 KiB, 100 in each directory """
+    for i in range(args.small_files):
+        directory = os.path.join(root, 'dir%03d' % (i // 100))
+        os.makedirs(directory, exist_ok=True)
+        write_file(os.path.join(directory, 'file%05d.txt' % i), rng.randbytes(rng.randint(0, 1024)))
+
+
+def make_deep(root, rng, args):
+    """ One chain of nested directories, each level with a few files and a sibling directory """
+    directory = root
+    for level in range(args.depth):
+        directory = os.path.join(directory, 'level%02d' % level)
+        os.makedirs(os.path.join(directory, 'sibling'))
+        for i in range(3):
+            write_file(os.path.join(directory, 'data%d.bin' % i), rng.randbytes(rng.randint(0, 6000)))
+
+
+def make_long_names(root, rng, args):
+    """ Names of 60 to 200 characters, 100 files in each directory """
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789_-'
+    for i in range(args.long_names):
+        directory = os.path.join(root, 'directory with a long name %d' % (i // 100))
+        os.makedirs(directory, exist_ok=True)
+        name = '%05d_%s.txt' % (i, ''.join(rng.choice(alphabet) for _ in range(rng.randint(50, 190))))
+        write_file(os.path.join(directory, name), rng.randbytes(rng.randint(0, 200)))
+
+
+def make_large(root, rng, args):
+    """ Pseudo-random multi-MiB files and one file not aligned to the sector """
+    os.makedirs(root, exist_ok=True)
+    chunk = rng.randbytes(0x100000)
+    for i in range(args.large_files):
+        with open(os.path.join(root, 'asset%d.bin' % i), 'wb') as f:
+            for j in range(args.large_size):
+                f.write(chunk[j:] + chunk[:j])
+    write_file(os.path.join(root, 'tail.bin'), chunk[:0x12345])
+
+
+def make_wide_short(root, rng, args):
+    """ Empty files with short names in one directory """
+    os.makedirs(os.path.join(root, 'dir'))
+    for i in range(args.wide_files):
+        write_file(os.path.join(root, 'dir', 'F%07d.TXT' % i), b'')
+
+
+def make_wide_long(root, rng, args):
+    """ Empty files with long names in one directory, the first 6 characters differ
+    (at most 127 long names may share them) """
+    os.makedirs(os.path.join(root, 'dir'))
+    for i in range(args.wide_files):
+        write_file(os.path.join(root, 'dir', '%06d_long_file_name.txt' % i), b'')
+
+
+TREE_BUILDERS = {
+    'small_files': make_small_files,
+    'deep': make_deep,
+    'long_names': make_long_names,
+    'large': make_large,
+    'wide_short': make_wide_short,
+    'wide_long': make_wide_long,
+}
+
+
+def make_tree(root, scenario, args):
+    os.makedirs(root)
+    TREE_BUILDERS[scenario](root, random.Random(scenario), args)
+
+
+def tree_files(root):
+    """ Relative paths and sizes of the files of the tree """
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            files[os.path.relpath(path, root)] = os.path.getsize(path)
+    return files
+
+
+def wl_plain_size(partition_size):
+    """ Size of the plain FAT image inside the WL partition, the same computation as WLFATFS """
+    sectors = partition_size // WL_SECTOR_SIZE
+    state_sectors = -(-(WLFATFS.WL_STATE_HEADER_SIZE + WLFATFS.WL_STATE_RECORD_SIZE * sectors) // WL_SECTOR_SIZE)
+    return (sectors - WLFATFS.WL_DUMMY_SECTORS_COUNT - WLFATFS.WL_CFG_SECTORS_COUNT
+            - WLFATFS.WL_STATE_COPY_COUNT * state_sectors) * WL_SECTOR_SIZE
+
+
+def partition_sizes(tree, sector_size):
+    """ Return (WL partition size, plain image size) of the smallest WL partition holding the tree """
+    required = PartitionPlan(tree, sector_size=sector_size, long_names_enabled=True).geometry().size
+    partition_size = -(-required // WL_SECTOR_SIZE) * WL_SECTOR_SIZE
+    while wl_plain_size(partition_size) < required:
+        partition_size += WL_SECTOR_SIZE
+    return partition_size, wl_plain_size(partition_size)
+
+
+def open_wl_image(path):
+    return FATImage(fatfsparse.remove_wear_levelling_if_exists(map_filesystem(path)))
+
+
+def stage_generate(job):
+    fatfs = fatfsgen.FATFS(size=job['plain_size'], sector_size=job['sector_size'], long_names_enabled=True,
+                           output_path=job['plain_image'])
+    fatfs.generate(job['tree'])
+    fatfs.write_filesystem(job['plain_image'])
+    fatfs.close()
+    return {}
+
+
+def stage_generate_memory(job):
+    fatfs = fatfsgen.FATFS(size=job['plain_size'], sector_size=job['sector_size'], long_names_enabled=True)
+    fatfs.generate(job['tree'])
+    fatfs.write_filesystem(job['memory_image'])
+    return {}
+
+
+def stage_generate_legacy(job):
+    fatfs = fatfsgen.FATFS(size=job['plain_size'], sector_size=job['sector_size'], long_names_enabled=True)
+
+    def add_directory(real_path, path_from_root):
+        # same order of the objects as FATFS.generate
+        for name in sorted(os.listdir(real_path)):
+            child_path = os.path.join(real_path, name)
+            if os.path.isdir(child_path):
+                fatfs.create_directory(name.upper(), path_from_root=path_from_root)
+                add_directory(child_path, path_from_root + [name.upper()])
+                continue
+            with open(child_path, 'rb') as f:
+                content = f.read()
+            file_name, extension = os.path.splitext(name.upper())
+            fatfs.create_file(file_name, extension=extension[1:], path_from_root=path_from_root or None,
+                              is_empty=len(content) == 0)
+            fatfs.write_content(path_from_root + [name.upper()], content)
+
+    add_directory(job['tree'], [])
+    fatfs.write_filesystem(job['legacy_image'])
+    return {}
+
+
+def stage_wl(job):
+    with open(job['plain_image'], 'rb') as f:
+        plain_image = f.read()
+    write_file(job['wl_image'], wl_fatfsgen.add_wl(plain_image, job['partition_size'],
+                                                   sector_size=job['sector_size']))
+    return {}
+
+
+def stage_parse(job):
+    image = open_wl_image(job['wl_image'])
+    files = read_bytes = 0
+    for directory, _, names in image.walk():
+        for name in names:
+            with image.open(directory + '/' + name if directory else name) as f:
+                for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+                    read_bytes += len(chunk)
+            files += 1
+    return {'files': files, 'bytes': read_bytes}
+
+
+def stage_extract(job):
+    open_wl_image(job['wl_image']).extract(job['output_directory'])
+    return {}
+
+
+STAGE_FUNCTIONS = {
+    'generate': stage_generate,
+    'generate_memory': stage_generate_memory,
+    'generate_legacy': stage_generate_legacy,
+    'wl': stage_wl,
+    'parse': stage_parse,
+    'extract': stage_extract,
+}
+
+
+def child(stage, job):
+    """ Run one stage and print its time, peak RSS in MiB and the stage's own results as JSON """
+    t = time.perf_counter()
+    result = STAGE_FUNCTIONS[stage](job)
+    result['seconds'] = time.perf_counter() - t
+    result['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def measure(stage, job, repeat):
+    """ Return the result of the fastest run with the largest peak RSS of all the runs """
+    best = None
+    peak = 0.0
+    for _ in range(repeat):
+        if stage == 'extract':
+            shutil.rmtree(job['output_directory'], ignore_errors=True)
+        output = subprocess.run([sys.executable, __file__, '--child', stage, json.dumps(job)],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        peak = max(peak, result['peak_rss_mib'])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['peak_rss_mib'] = peak
+    return best
+
+
+def check_extracted(tree, output_directory):
+    """ Return the paths of the files of the tree missing in the extracted directory or differing from it """
+    # the short names are stored in upper case, so the paths are compared case-insensitively as by FAT
+    extracted = {path.upper(): path for path in tree_files(output_directory)}
+    bad = []
+    for path in sorted(tree_files(tree)):
+        if path.upper() not in extracted or not filecmp.cmp(os.path.join(tree, path),
+                                                            os.path.join(output_directory, extracted[path.upper()]),
+                                                            shallow=False):
+            bad.append(path)
+    return bad
+
+
+def differing_images(job, stages):
+    """ Return the generate stages whose image differs from the one of fatfsgen apart from the volume ID """
+    images = {}
+    for stage in stages:
+        if stage in GENERATE_STAGES:
+            with open(job[GENERATE_STAGES[stage]], 'rb') as f:
+                image = bytearray(f.read())
+            image[VOLUME_ID] = b'\x00' * 4
+            images[stage] = image
+    return [stage for stage, image in images.items() if image != images.get('generate', image)]
+
+
+def compare(results, baseline, threshold):
+    """ Return a list of regression messages """
+    regressions = []
+    for name, result in results.items():
+        ref = baseline.get(name)
+        if ref is None:
+            continue
+        # small absolute allowances so the short stages and the interpreter don't flap
+        if result['seconds'] > ref['seconds'] * (1 + threshold) + 0.01:
+            regressions.append('%s: %.3f s, baseline %.3f s' % (name, result['seconds'], ref['seconds']))
+        if result['peak_rss_mib'] > ref['peak_rss_mib'] * (1 + threshold) + 2:
+            regressions.append('%s: peak RSS %.1f MiB, baseline %.1f MiB'
+                               % (name, result['peak_rss_mib'], ref['peak_rss_mib']))
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], json.loads(sys.argv[3]))
+        return 0
+
+    parser = argparse.ArgumentParser(description='FAT image generation and parsing benchmarks')
+    parser.add_argument('--baseline', help='Baseline JSON file (default: %(default)s)', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', help='Store the results as the new baseline', action='store_true')
+    parser.add_argument('--require-baseline', help='Fail if the baseline or a stage in it is missing',
+                        action='store_true')
+    parser.add_argument('--threshold', help='Allowed relative regression (default: %(default)s)', type=float,
+                        default=0.2)
+    parser.add_argument('--repeat', help='Runs per stage, the fastest counts (default: %(default)s)', type=int,
+                        default=3)
+    parser.add_argument('--scenarios', help='Trees to run (default: all)', nargs='+', choices=SCENARIOS,
+                        default=SCENARIOS)
+    parser.add_argument('--stages', help='Stages to run, wl, parse and extract need generate (default: all)',
+                        nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--sector-sizes', help='Sector sizes (default: %(default)s)', type=int, nargs='+',
+                        choices=[512, 4096], default=[512, 4096])
+    parser.add_argument('--small-files', help='Files of the small_files tree (default: %(default)s)', type=int,
+                        default=3000)
+    parser.add_argument('--depth', help='Nesting of the deep tree (default: %(default)s)', type=int, default=40)
+    parser.add_argument('--long-names', help='Files of the long_names tree (default: %(default)s)', type=int,
+                        default=600)
+    parser.add_argument('--large-files', help='Files of the large tree (default: %(default)s)', type=int, default=3)
+    parser.add_argument('--large-size', help='Size of one large file in MiB (default: %(default)s)', type=int,
+                        default=4)
+    parser.add_argument('--wide-files', help='Files of the wide trees (default: %(default)s)', type=int,
+                        default=5000)
+    args = parser.parse_args()
+    if 'generate' not in args.stages and set(args.stages) & {'wl', 'parse', 'extract'}:
+        parser.error('the wl, parse and extract stages need the generate stage')
+
+    work_dir = tempfile.mkdtemp(prefix='fatfs_bench_')
+    results = {}
+    errors = []
+    try:
+        print('%-32s %10s %14s' % ('benchmark', 'seconds', 'peak RSS MiB'))
+        for scenario in args.scenarios:
+            tree = os.path.join(work_dir, scenario)
+            make_tree(tree, scenario, args)
+            files = tree_files(tree)
+            for sector_size in args.sector_sizes:
+                partition_size, plain_size = partition_sizes(tree, sector_size)
+                job = {'tree': tree, 'sector_size': sector_size, 'partition_size': partition_size,
+                       'plain_size': plain_size, 'plain_image': os.path.join(work_dir, 'plain.img'),
+                       'memory_image': os.path.join(work_dir, 'memory.img'),
+                       'legacy_image': os.path.join(work_dir, 'legacy.img'),
+                       'wl_image': os.path.join(work_dir, 'wl.img'),
+                       'output_directory': os.path.join(work_dir, 'extracted')}
+                for stage in [stage for stage in STAGES if stage in args.stages]:
+                    name = '%s/%d/%s' % (scenario, sector_size, stage)
+                    result = measure(stage, job, args.repeat)
+                    results[name] = {'seconds': round(result['seconds'], 4),
+                                     'peak_rss_mib': round(result['peak_rss_mib'], 1)}
+                    print('%-32s %10.3f %14.1f' % (name, result['seconds'], result['peak_rss_mib']))
+                    if stage == 'parse' and (result['files'], result['bytes']) != (len(files), sum(files.values())):
+                        errors.append('%s: %d files of %d bytes parsed, the tree has %d files of %d bytes'
+                                      % (name, result['files'], result['bytes'], len(files), sum(files.values())))
+                for stage in differing_images(job, args.stages):
+                    errors.append('%s/%d/%s: the image differs from the one of generate'
+                                  % (scenario, sector_size, stage))
+                bad = check_extracted(tree, job['output_directory']) if 'extract' in args.stages else []
+                if bad:
+                    errors.append('%s/%d: %d extracted files differ, e.g. %s' % (scenario, sector_size, len(bad),
+                                                                                 bad[0]))
+            shutil.rmtree(tree)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for message in errors:
+        print('ERROR %s' % message)
+    if errors:
+        return 1
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'host': platform.platform(), 'python': platform.python_version(), 'results': results},
+                      f, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save-baseline to create one.' % args.baseline)
+        return 2 if args.require_baseline else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('host') != platform.platform():
+        print('WARNING: baseline was recorded on %s, results may not be comparable.' % baseline.get('host'))
+    missing = sorted(set(results) - set(baseline['results']))
+    if missing:
+        print('No baseline for %s' % ', '.join(missing))
+        if args.require_baseline:
+            return 2
+    regressions = compare(results, baseline['results'], args.threshold)
+    for message in regressions:
+        print('REGRESSION %s' % message)
+    if not regressions:
+        print('No regressions beyond %d%% against %s' % (args.threshold * 100, args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,15 +34,14 @@ import shutil
 import json
 import hashlib
 import math
-from tempfile import mkdtemp
 from datetime import datetime, timezone
+import fnmatch
 import glob
 import sys
 import time
 import serial
 import argparse
 import struct
-import tempfile
 
 print("\nActivating virtual environment...")
 print("Please run: source .venv/bin/activate")
@@ -58,6 +57,17 @@ except ImportError:
     
 from typing import Optional
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fatfs"))
+from fatfsgen import FATFS  # noqa: E402
+from littlefsgen import LittleFS  # noqa: E402
+from littlefsparse import directory_tasks, image_tasks  # noqa: E402
+from fatfs_utils.content_manifest import ContentManifest  # noqa: E402
+from fatfs_utils.exceptions import NoFreeBlockException, TooLongNameException  # noqa: E402
+from fatfs_utils.fat_image import FATImage  # noqa: E402
+from fatfs_utils.littlefs_image import LittleFSImage  # noqa: E402
+from fatfs_utils.partition_plan import PartitionPlan  # noqa: E402
+from fatfs_utils.virtual_tree import VirtualTree  # noqa: E402
+
 # Define paths
 MPY_DIR = os.path.abspath("../lvgl_micropython")
 MCT_DIR = os.path.abspath("../MCT")
@@ -93,72 +103,28 @@ def find_esp32_port():
     return None
 
 # Filesystem functions
-def create_littlefs_image(image_path, source_dir, partition_size):
-    """Create a LittleFS image from the source directory."""
-    # Try to find mklittlefs in ESP-IDF tools or system PATH
-    mklittlefs_path = None
-    
-    # Check ESP-IDF tools first
-    esp_idf_tools = os.environ.get('IDF_PATH')
-    if esp_idf_tools:
-        esp_mklittlefs = os.path.join(esp_idf_tools, 'components', 'spiffs', 'mklittlefs', 'mklittlefs')
-        if os.path.exists(esp_mklittlefs):
-            mklittlefs_path = esp_mklittlefs
-    
-    # Try system PATH
-    if not mklittlefs_path:
-        try:
-            result = subprocess.run(['which', 'mklittlefs'], capture_output=True, text=True)
-            if result.returncode == 0:
-                mklittlefs_path = result.stdout.strip()
-        except:
-            pass
-    
-    # Try common locations
-    if not mklittlefs_path:
-        common_paths = [
-            '/usr/local/bin/mklittlefs',
-            '/opt/homebrew/bin/mklittlefs',
-            '../mklittlefs/mklittlefs'
-        ]
-        for path in common_paths:
-            if os.path.exists(path):
-                mklittlefs_path = path
-                break
-    
-    if not mklittlefs_path:
-        print(f"\nError: mklittlefs binary not found!")
-        print("Please ensure mklittlefs is installed or available in PATH")
-        print("You can use ESP-IDF's mklittlefs or install it separately")
-        return False
-        
+def create_littlefs_image(image_path, source, partition_size):
+    """Create a LittleFS image from the source directory or the virtual tree of the files."""
     print(f"\nCreating LittleFS image: {image_path}")
     print(f"Partition size: {partition_size:,} bytes")
-    print(f"Source directory: {source_dir}")
-    
-    # Check if source directory contents will fit
-    total_size = get_directory_size(source_dir)
-    if total_size > partition_size:
-        print(f"Error: Source directory ({total_size:,} bytes) is larger than partition size ({partition_size:,} bytes)")
-        return False
-    
-    print(f"Source directory size: {total_size:,} bytes")
-    print(f"Available space: {partition_size - total_size:,} bytes")
-    
-    # Use parameters from Makefile
-    mklfs_cmd = [
-        mklittlefs_path,     # Use full path to binary
-        "-c", source_dir,    # source directory
-        "-p", "256",         # page size (from Makefile)
-        "-b", "4096",        # block size (from Makefile)
-        "-s", str(partition_size), # filesystem size from partition table
-        image_path           # output file
-    ]
     
-    print(f"\nCreating image with command: {' '.join(mklfs_cmd)}")
-    result = run_command(mklfs_cmd)
-    if result is None:
-        print("Failed to create LittleFS image")
+    # The image is built in process with the geometry of the Makefile (page 256, block 4096)
+    try:
+        littlefs = LittleFS(size=partition_size, block_size=4096, page_size=256)
+        # Check if source contents will fit, the files are listed the same way the image is populated
+        littlefs.scan(source)
+        total_size = sum(file.size for file in littlefs.files())
+        if total_size > partition_size:
+            print(f"Error: Source ({total_size:,} bytes) is larger than partition size ({partition_size:,} bytes)")
+            return False
+
+        print(f"Source size: {total_size:,} bytes")
+        print(f"Available space: {partition_size - total_size:,} bytes")
+
+        littlefs.generate(source)
+        littlefs.write_filesystem(image_path)
+    except (NoFreeBlockException, TooLongNameException, ValueError, OSError) as e:
+        print(f"Failed to create LittleFS image: {e}")
         return False
     
     # Verify the image was created and size is correct
@@ -170,53 +136,20 @@ def create_littlefs_image(image_path, source_dir, partition_size):
     if created_size != partition_size:
         print(f"Warning: Created image size ({created_size:,} bytes) doesn't match partition size ({partition_size:,} bytes)")
         return False
-    
-    print(f"Created LittleFS image: {image_path}")
-    print(f"Size: {created_size:,} bytes")
-    return True
 
-def create_fat_image(image_path, source_dir, size_mb=2):
-    """Create a FAT filesystem image as a fallback."""
-    print(f"\nCreating FAT image: {image_path}")
-    print(f"Size: {size_mb}MB")
-    print(f"Source directory: {source_dir}")
-    
-    # Calculate size in bytes
-    size_bytes = size_mb * 1024 * 1024
-    
-    # Use fatfsgen.py script
-    fatfsgen_path = os.path.abspath("./fatfs/fatfsgen.py")
-    if not os.path.exists(fatfsgen_path):
-        print(f"Error: fatfsgen.py not found at {fatfsgen_path}")
-        return False
-    
-    fatfs_cmd = [
-        "python3",
-        fatfsgen_path,
-        "--sector-size", "4096",
-        "--partition-size", str(size_bytes),
-        "--output", image_path,
-        source_dir
-    ]
-    
-    print(f"\nCreating image with command: {' '.join(fatfs_cmd)}")
-    result = run_command(fatfs_cmd)
-    if result is None:
-        print("Failed to create FAT image")
+    # Read the written image back and compare it with the sources by hashing the files in place
+    with LittleFSImage.from_file(image_path) as image:
+        missing, extra, different = ContentManifest.compare_tasks(directory_tasks(image, source, []),
+                                                                  image_tasks(image))
+    if missing or extra or different:
+        print(f"Error: LittleFS image content mismatch (missing: {missing}, extra: {extra}, different: {different})")
         return False
     
+    print(f"Created LittleFS image: {image_path}")
+    print(f"Size: {created_size:,} bytes")
+    print(f"Used blocks: {littlefs.used_blocks} of {littlefs.block_count}")
     return True
 
-def create_filesystem_image(image_path, source_dir, size_mb=2):
-    """Try to create filesystem image, falling back to FAT if LittleFS fails."""
-    # Try LittleFS first
-    if create_littlefs_image(image_path, source_dir, size_mb):
-        return True
-        
-    print("\nLittleFS creation failed, falling back to FAT filesystem...")
-    # Fall back to FAT
-    return create_fat_image(image_path, source_dir, size_mb)
-
 # Git functions
 def ensure_on_main_branch(repo_path):
     """Ensure we're on the main branch and it's up to date."""
@@ -448,9 +381,6 @@ manifest_file = "manifest.json"
 micropython_firmware_source = "../lvgl_micropython/build/lvgl_micropy_ESP32_GENERIC_S3-SPIRAM_OCT-8.bin"
 micropython_firmware_dest = "lvgl_micropy_ESP32_GENERIC_S3-SPIRAM_OCT-8.bin"
 
-# Path to fatfsgen.py (now in fatfs directory)
-fatfsgen_script = "fatfs/fatfsgen.py"
-
 def read_manifest():
     """Read and parse the manifest.json file."""
     try:
@@ -922,74 +852,36 @@ def validate_manifest_file(directory):
         print(f"Error validating manifest file: {str(e)}")
         return False
 
-def clean_directory(temp_dir, source_dir):
-    """Clean and prepare the temporary directory with MCT files."""
-    try:
-        # Clear any existing contents
-        for item in os.listdir(temp_dir):
-            item_path = os.path.join(temp_dir, item)
-            if os.path.isfile(item_path):
-                os.unlink(item_path)
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-                
-        # Copy MCT files to temp directory
-        # Changed from "frozen" to the root directory
-        mct_source = source_dir
-        if not os.path.exists(mct_source):
-            print(f"Error: MCT source directory not found at {mct_source}")
-            return False
-            
-        # Copy all Python files and directories, excluding git and other non-essential files
-        for item in os.listdir(mct_source):
-            # Skip git directory and other non-essential files
-            if item.startswith('.') or item in ['__pycache__', 'tests', 'docs']:
-                continue
-                
-            source_path = os.path.join(mct_source, item)
-            dest_path = os.path.join(temp_dir, item)
-            
-            if os.path.isfile(source_path) and item.endswith('.py'):
-                shutil.copy2(source_path, dest_path)
-            elif os.path.isdir(source_path):
-                shutil.copytree(source_path, dest_path, 
-                              ignore=shutil.ignore_patterns('__pycache__', '*.pyc', '*.git*'))
-                
-        print(f"Copied MCT files to temporary directory")
-        
-        # List contents of temp directory
-        print("\nTemporary directory contents:")
-        for item in os.listdir(temp_dir):
-            item_path = os.path.join(temp_dir, item)
-            if os.path.isfile(item_path):
-                print(f"  File: {item} ({os.path.getsize(item_path):,} bytes)")
-            elif os.path.isdir(item_path):
-                print(f"  Directory: {item}")
-                
-        return True
-        
-    except Exception as e:
-        print(f"Error cleaning directory: {str(e)}")
-        return False
-
+def mct_tree(source_dir):
+    """Build the virtual tree of the MCT files the image is created from, the sources are read in place."""
+    tree = VirtualTree()
+    # The directories are followed the same way copying them did
+    for dirpath, dirnames, filenames in os.walk(source_dir, followlinks=True):
+        relative = os.path.relpath(dirpath, source_dir)
+        if relative == '.':
+            # Skip git directory and other non-essential files, only Python files are taken from the top
+            dirnames[:] = [item for item in dirnames
+                           if not item.startswith('.') and item not in ['__pycache__', 'tests', 'docs']]
+            filenames = [item for item in filenames if not item.startswith('.') and item.endswith('.py')]
+        else:
+            tree.add_directory(relative)
+            # The same patterns apply to the files and the directories
+            ignored = ['__pycache__', '*.pyc', '*.git*']
+            dirnames[:] = [item for item in dirnames if not any(fnmatch.fnmatch(item, pattern) for pattern in ignored)]
+            filenames = [item for item in filenames if not any(fnmatch.fnmatch(item, pattern) for pattern in ignored)]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            tree.add_file(os.path.join(relative, filename), lambda path=path: open(path, 'rb'),
+                          size=os.path.getsize(path))
+
+    print("\nMCT image contents:")
+    for entry in sorted(tree.scandir(), key=lambda entry: entry.name):
+        if entry.is_file():
+            print(f"  File: {entry.name} ({entry.stat().st_size:,} bytes)")
+        else:
+            print(f"  Directory: {entry.name}")
+    return tree
 
-def get_directory_size(directory):
-    """Calculate the total size of a directory and its contents."""
-    total_size = 0
-    try:
-        # Walk through all files and subdirectories
-        for dirpath, dirnames, filenames in os.walk(directory):
-            # Add size of all files in current directory
-            for filename in filenames:
-                file_path = os.path.join(dirpath, filename)
-                if not os.path.islink(file_path):  # Skip symbolic links
-                    total_size += os.path.getsize(file_path)
-                    
-        return total_size
-        
-    except Exception as e:
-        print(f"Error calculating directory size: {str(e)}")
-        return 0
 
 def run_flash_command(command):
     """Execute the flash command and handle the output."""
@@ -1269,48 +1161,37 @@ def compare_partitions(firmware_path):
 def create_vfs_image(mct_path, output_size):
     """Create a VFS image containing boot.py and main.py from MCT."""
     try:
-        # Create temp directory for VFS contents
-        vfs_temp = "vfs_temp"
-        os.makedirs(vfs_temp, exist_ok=True)
-        
-        # Copy boot.py and main.py from MCT
+        # The image is built from the files in memory, no temp directory is needed
+        files = {}
         for file in ["boot.py", "main.py"]:
             source = os.path.join(mct_path, file)
-            dest = os.path.join(vfs_temp, file)
             if os.path.exists(source):
-                shutil.copy2(source, dest)
-                print(f"Copied {file} to VFS image")
+                with open(source, 'rb') as source_file:
+                    files[file] = source_file.read()
+                print(f"Added {file} to VFS image")
             else:
                 print(f"Warning: {file} not found in MCT")
-        
+
         # Create VFS image using fatfsgen
         vfs_image = "vfs.bin"
-        fatfs_cmd = [
-            sys.executable,
-            fatfsgen_script,
-            "--output_file", vfs_image,
-            "--partition_size", str(output_size),
-            "--sector_size", "4096",
-            vfs_temp
-        ]
-        
         print("\nCreating VFS image:")
-        print(f"Command: {' '.join(fatfs_cmd)}")
-        
-        result = subprocess.run(fatfs_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print("Error creating VFS image:")
-            print(result.stderr)
+        tree = VirtualTree.from_dict(files)
+        fatfs = FATFS(size=output_size, sector_size=4096)
+        fatfs.generate(tree)
+        fatfs.write_filesystem(vfs_image)
+
+        # Check the written image against the sources by hashing the files in place
+        with FATImage.from_file(vfs_image) as image:
+            missing, extra, different = ContentManifest.verify(image, PartitionPlan(tree, sector_size=4096))
+        if missing or extra or different:
+            print(f"Error: VFS image content mismatch (missing: {missing}, extra: {extra}, different: {different})")
             return None
-            
-        # Clean up temp directory
-        shutil.rmtree(vfs_temp)
-        
+
         print(f"Created VFS image: {vfs_image}")
         print(f"Size: {os.path.getsize(vfs_image):,} bytes")
-        
+
         return vfs_image
-        
+
     except Exception as e:
         print(f"Error creating VFS image: {str(e)}")
         return None
@@ -1410,136 +1291,127 @@ print_step(6, "Create filesystem images")
 
 # Create MCT filesystem image
 fatfs_image = "mct.bin"
-temp_directory = tempfile.mkdtemp()
-print(f"Created temporary directory: {temp_directory}")
+# The image is built from the MCT files in place, nothing is copied to a temporary directory
+mct_files = mct_tree(mct_path)
 
-try:
-    # Clean the temporary directory
-    clean_directory(temp_directory, mct_path)
+# Create the MCT filesystem image using app_0 size instead of vfs_size
+if not create_littlefs_image(fatfs_image, mct_files, app_0_size):  # Changed from vfs_size to app_0_size
+    print("Failed to create filesystem image")
+    sys.exit(1)
 
-    # Create the MCT filesystem image using app_0 size instead of vfs_size
-    if not create_littlefs_image(fatfs_image, temp_directory, app_0_size):  # Changed from vfs_size to app_0_size
-        print("Failed to create filesystem image")
-        sys.exit(1)
+print(f"Successfully created filesystem image: {fatfs_image}")
+
+# Create VFS image with correct vfs_size
+print("\nCreating VFS image...")
+vfs_image = create_vfs_image(mct_path, vfs_size)
+if not vfs_image:
+    print("Failed to create VFS image")
+    sys.exit(1)
+
+print_step(7, "Commit and push changes in current working directory")
+cwd = os.getcwd()
+if commit_and_push(cwd, logical_version, add_new_files=False):
+    print("Successfully committed and pushed changes in current directory")
+else:
+    print("Failed to commit and push changes in current directory")
+    sys.exit(1)
 
-    print(f"Successfully created filesystem image: {fatfs_image}")
+# Flash the device if requested (Step 8)
+args = parse_arguments()
+if args.flash:
+    print_step(8, "Flash ESP32-S3")
+    print("Attempting to flash the ESP32-S3...")
 
-    # Create VFS image with correct vfs_size
-    print("\nCreating VFS image...")
-    vfs_image = create_vfs_image(mct_path, vfs_size)
-    if not vfs_image:
-        print("Failed to create VFS image")
+    # Read manifest.json
+    manifest = read_manifest()
+    if not manifest:
+        print("Failed to read manifest.json")
         sys.exit(1)
 
-    print_step(7, "Commit and push changes in current working directory")
-    cwd = os.getcwd()
-    if commit_and_push(cwd, logical_version, add_new_files=False):
-        print("Successfully committed and pushed changes in current directory")
-    else:
-        print("Failed to commit and push changes in current directory")
+    # Get flash parts from manifest
+    flash_parts = manifest['builds'][0]['parts']
+    
+    esp32_port = find_esp32_port()
+    if esp32_port is None:
+        print("Error: No ESP32-S3 device found. Please check the connection.")
         sys.exit(1)
 
-    # Flash the device if requested (Step 8)
-    args = parse_arguments()
-    if args.flash:
-        print_step(8, "Flash ESP32-S3")
-        print("Attempting to flash the ESP32-S3...")
-
-        # Read manifest.json
-        manifest = read_manifest()
-        if not manifest:
-            print("Failed to read manifest.json")
+    print(f"Found ESP32-S3 port: {esp32_port}")
+    
+    # Verify all files exist before starting
+    print("\nVerifying files from manifest:")
+    for part in flash_parts:
+        file_path = part['path']
+        if not os.path.exists(file_path):
+            print(f"Error: File not found: {file_path}")
             sys.exit(1)
+        print(f"Found {file_path} ({os.path.getsize(file_path):,} bytes)")
+        print(f"Flash offset: 0x{part['offset']:x}")
+
+    # Erase flash with verbose output (update size to 8MB)
+    erase_command = [
+        "esptool.py",
+        "--chip", "esp32s3",
+        "--port", esp32_port,
+        "--baud", "460800",
+        "--before", "default_reset",
+        "--after", "hard_reset",
+        "erase_region", "0x0", "0x800000"  # Changed from 0x1000000 (16MB) to 0x800000 (8MB)
+    ]
 
-        # Get flash parts from manifest
-        flash_parts = manifest['builds'][0]['parts']
-        
-        esp32_port = find_esp32_port()
-        if esp32_port is None:
-            print("Error: No ESP32-S3 device found. Please check the connection.")
-            sys.exit(1)
+    print("\nErasing flash with command:")
+    print(" ".join(erase_command))
+    result = run_command(erase_command)
+    if result is None:
+        print("Failed to erase flash. Aborting.")
+        sys.exit(1)
 
-        print(f"Found ESP32-S3 port: {esp32_port}")
-        
-        # Verify all files exist before starting
-        print("\nVerifying files from manifest:")
-        for part in flash_parts:
-            file_path = part['path']
-            if not os.path.exists(file_path):
-                print(f"Error: File not found: {file_path}")
-                sys.exit(1)
-            print(f"Found {file_path} ({os.path.getsize(file_path):,} bytes)")
-            print(f"Flash offset: 0x{part['offset']:x}")
-
-        # Erase flash with verbose output (update size to 8MB)
-        erase_command = [
-            "esptool.py",
-            "--chip", "esp32s3",
-            "--port", esp32_port,
-            "--baud", "460800",
-            "--before", "default_reset",
-            "--after", "hard_reset",
-            "erase_region", "0x0", "0x800000"  # Changed from 0x1000000 (16MB) to 0x800000 (8MB)
-        ]
-
-        print("\nErasing flash with command:")
-        print(" ".join(erase_command))
-        result = run_command(erase_command)
-        if result is None:
-            print("Failed to erase flash. Aborting.")
-            sys.exit(1)
+    # Wait longer after erasing
+    print("Waiting for device to stabilize after erase...")
+    time.sleep(5)
+
+    # Flash command with 8MB flash size
+    flash_command = [
+        "python", "-m", "esptool",
+        "--chip", "esp32s3",
+        "--no-stub",
+        "-p", esp32_port,
+        "-b", "115200",
+        "--before", "usb_reset",
+        "--after", "hard_reset",
+        "write_flash",
+        "--flash_mode", "dio",
+        "--flash_size", "8MB",        # Changed from 16MB to 8MB
+        "--flash_freq", "40m",
+        "--no-compress",
+        "0x0", firmware_dest,
+        f"0x{app_0_offset:x}", fatfs_image,
+        f"0x{vfs_offset:x}", vfs_image
+    ]
 
-        # Wait longer after erasing
-        print("Waiting for device to stabilize after erase...")
-        time.sleep(5)
-
-        # Flash command with 8MB flash size
-        flash_command = [
-            "python", "-m", "esptool",
-            "--chip", "esp32s3",
-            "--no-stub",
-            "-p", esp32_port,
-            "-b", "115200",
-            "--before", "usb_reset",
-            "--after", "hard_reset",
-            "write_flash",
-            "--flash_mode", "dio",
-            "--flash_size", "8MB",        # Changed from 16MB to 8MB
-            "--flash_freq", "40m",
-            "--no-compress",
-            "0x0", firmware_dest,
-            f"0x{app_0_offset:x}", fatfs_image,
-            f"0x{vfs_offset:x}", vfs_image
-        ]
-
-        # Print the exact command that will be executed
-        print("\nExecuting flash command:")
-        print(" ".join(flash_command))
-        print("\nFlash output:")
-
-        # Add longer delay before flashing
-        print("Waiting for device to stabilize...")
-        time.sleep(5)                   # Increased delay
-
-        if not run_flash_command(flash_command):
-            print("Failed to flash the device. Aborting.")
-            sys.exit(1)
+    # Print the exact command that will be executed
+    print("\nExecuting flash command:")
+    print(" ".join(flash_command))
+    print("\nFlash output:")
+
+    # Add longer delay before flashing
+    print("Waiting for device to stabilize...")
+    time.sleep(5)                   # Increased delay
+
+    if not run_flash_command(flash_command):
+        print("Failed to flash the device. Aborting.")
+        sys.exit(1)
+
+    print("\nWaiting for device to reset...")
+    time.sleep(3)
 
-        print("\nWaiting for device to reset...")
-        time.sleep(3)
-
-        print("\nFlash completed successfully!")
-        print("Please check the device for proper operation.")
-        print("\nIf you still get filesystem errors, try these troubleshooting steps:")
-        print("1. Use a shorter/better quality USB cable")
-        print("2. Try a different USB port")
-        print("3. Reduce the baud rate to 115200")
-        print("4. Manually power cycle the device after flashing")
-
-finally:
-    # Clean up
-    shutil.rmtree(temp_directory)
-    print(f"Removed temporary directory: {temp_directory}")
+    print("\nFlash completed successfully!")
+    print("Please check the device for proper operation.")
+    print("\nIf you still get filesystem errors, try these troubleshooting steps:")
+    print("1. Use a shorter/better quality USB cable")
+    print("2. Try a different USB port")
+    print("3. Reduce the baud rate to 115200")
+    print("4. Manually power cycle the device after flashing")
 
 print("Script execution completed.")
 
@@ -14,7 +14,10 @@ import hashlib
 import inspect
 import io
 import itertools
+import json
+import multiprocessing
 import os
+import random
 import re
 import shlex
 import string
@@ -326,6 +329,10 @@ class ESPLoader(object):
     # Chip IDs that are no longer supported by esptool
     UNSUPPORTED_CHIPS = {6: "ESP32-S3(beta 3)"}
 
+    # Number of READ_REG commands sent back to back by read_regs() before waiting for the responses.
+    # Kept small so the requests fit into the 128 byte UART RX FIFO of the ROM loader.
+    READ_REG_BATCH_WINDOW = 8
+
     def __init__(self, port=DEFAULT_PORT, baud=ESP_ROM_BAUD, trace_enabled=False):
         """Base constructor for ESPLoader bootloader interaction
 
@@ -340,6 +347,8 @@ class ESPLoader(object):
         """
         self.secure_download_mode = False  # flag is set to True if esptool detects the ROM is in Secure Download Mode
         self.stub_is_disabled = False  # flag is set to True if esptool detects conditions which require the stub to be disabled
+        self._efuse_cache = {}  # eFuse words read during this session, see prefetch_efuses()
+        self._device_info = None  # cached result of device_info()
 
         if isinstance(port, basestring):
             self._port = serial.serial_for_url(port)
@@ -586,6 +595,20 @@ class ESPLoader(object):
                 return p.pid
         print("\nFailed to get PID of a device on {}, using standard reset sequence.".format(active_port))
 
+    def transport_id(self):
+        """ Short name of the link to the chip ("usb-otg", "usb-jtag-serial" or "uart@<baud>"),
+        used to key the flash write profiles measured by autotune_flash """
+        if hasattr(self, "uses_usb") and self.uses_usb():
+            return "usb-otg"
+        active_port = getattr(self._port, "port", None) or ""
+        if list_ports is not None and active_port.lower().startswith(("com", "/dev/")):
+            if active_port.startswith("/dev/") and os.path.islink(active_port):
+                active_port = os.path.realpath(active_port)
+            for p in list_ports.comports():
+                if p.device == active_port and p.pid == self.USB_JTAG_SERIAL_PID:
+                    return "usb-jtag-serial"
+        return "uart@%d" % self._port.baudrate
+
     def bootloader_reset(self, usb_jtag_serial=False, extra_delay=False):
         """ Issue a reset-to-bootloader, with USB-JTAG-Serial custom reset sequence option
         """
@@ -727,6 +750,8 @@ class ESPLoader(object):
 
     def read_reg(self, addr, timeout=DEFAULT_TIMEOUT):
         """ Read memory address in target """
+        if addr in self._efuse_cache:
+            return self._efuse_cache[addr]
         # we don't call check_command here because read_reg() function is called
         # when detecting chip type, and the way we check for success (STATUS_BYTES_LENGTH) is different
         # for different chip types (!)
@@ -735,8 +760,96 @@ class ESPLoader(object):
             raise FatalError.WithResult("Failed to read register address %08x" % addr, data)
         return val
 
+    def read_regs(self, addrs, timeout=DEFAULT_TIMEOUT):
+        """ Read several memory addresses in target, returns the values in the same order.
+
+        READ_REG commands are sent back to back (READ_REG_BATCH_WINDOW at a time) and only then
+        are the responses collected, saving one round trip per register compared to read_reg().
+        """
+        addrs = list(addrs)
+        values = []
+        saved_timeout = self._port.timeout
+        new_timeout = min(timeout, MAX_TIMEOUT)
+        if new_timeout != saved_timeout:
+            self._port.timeout = new_timeout
+        try:
+            for start in range(0, len(addrs), self.READ_REG_BATCH_WINDOW):
+                window = addrs[start:start + self.READ_REG_BATCH_WINDOW]
+                self.trace("read_regs batch of %d: %s", len(window), ", ".join("%08x" % a for a in window))
+                for addr in window:
+                    self.write(struct.pack(b'<BBHI', 0x00, self.ESP_READ_REG, 4, 0) + struct.pack('<I', addr))
+                for addr in window:
+                    values.append(self._read_reg_response(addr))
+        finally:
+            if new_timeout != saved_timeout:
+                self._port.timeout = saved_timeout
+        return values
+
+    def _read_reg_response(self, addr):
+        """ Wait for the response of one READ_REG command sent by read_regs() """
+        for retry in range(100):
+            p = self.read()
+            if len(p) < 8:
+                continue
+            (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', p[:8])
+            if resp != 1 or op_ret != self.ESP_READ_REG:
+                continue
+            data = p[8:]
+            if byte(data, 0) != 0:
+                if byte(data, 1) == self.ROM_INVALID_RECV_MSG:
+                    self.flush_input()
+                    raise UnsupportedCommandError(self, self.ESP_READ_REG)
+                raise FatalError.WithResult("Failed to read register address %08x" % addr, data)
+            return val
+        raise FatalError("Response doesn't match request")
+
+    def prefetch_efuses(self):
+        """ Read the eFuse words returned by _efuse_cache_addrs() with one batched read.
+
+        Subsequent read_reg() calls of these addresses (chip description, features, MAC, key purposes)
+        are served from the cache for the rest of the session. If the batched read fails, the cache stays
+        empty and the registers are read one by one as before.
+        """
+        addrs = self._efuse_cache_addrs()
+        if not addrs or self.secure_download_mode or self._efuse_cache:
+            return
+        try:
+            values = self.read_regs(addrs)
+        except (FatalError, UnsupportedCommandError) as e:
+            self.trace("Batched eFuse read failed (%s), falling back to single reads", e)
+            self.flush_input()
+            return
+        self._efuse_cache.update(zip(addrs, values))
+
+    def _efuse_cache_addrs(self):
+        """ Addresses of the eFuse words holding the chip identity, overridden per chip family """
+        return []
+
+    def device_info(self, flash_id=False, refresh=False):
+        """ Return the identity of the connected chip as a dict, cached for the session.
+
+        Keys are chip_name, description, features, crystal_mhz and mac (None in Secure Download Mode)
+        and flash_id. The flash ID is only read if flash_id=True, as reading it needs the SPI flash
+        to be attached, and stays None otherwise. refresh=True reads the flash ID again even if it is
+        cached, e.g. after the flash chip was reset; the identity of the chip itself doesn't change.
+        """
+        if self._device_info is None:
+            info = {'chip_name': self.CHIP_NAME, 'description': None, 'features': None,
+                    'crystal_mhz': None, 'mac': None, 'flash_id': None}
+            if not self.secure_download_mode:
+                self.prefetch_efuses()
+                info['description'] = self.get_chip_description()
+                info['features'] = self.get_chip_features()
+                info['crystal_mhz'] = self.get_crystal_freq()
+                info['mac'] = self.read_mac()
+            self._device_info = info
+        if flash_id and (refresh or self._device_info['flash_id'] is None) and not self.secure_download_mode:
+            self._device_info['flash_id'] = self.flash_id()
+        return self._device_info
+
     """ Write to memory address in target """
     def write_reg(self, addr, value, mask=0xFFFFFFFF, delay_us=0, delay_after_us=0):
+        self._efuse_cache.pop(addr, None)
         command = struct.pack('<IIII', addr, value, mask, delay_us)
         if delay_after_us > 0:
             # add a dummy write to a date register as an excuse to have a delay
@@ -1466,6 +1579,9 @@ class ESP8266ROM(ESPLoader):
         id1 = self.read_reg(self.ESP_OTP_MAC1)
         return (id0 >> 24) | ((id1 & MAX_UINT24) << 8)
 
+    def _efuse_cache_addrs(self):
+        return [self.ESP_OTP_MAC0 + 4 * i for i in range(4)]
+
     def read_mac(self):
         """ Read MAC from OTP ROM """
         mac0 = self.read_reg(self.ESP_OTP_MAC0)
@@ -1514,6 +1630,8 @@ class ESP8266StubLoader(ESP8266ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
     def get_erase_size(self, offset, size):
@@ -1773,6 +1891,9 @@ class ESP32ROM(ESPLoader):
     def chip_id(self):
         raise NotSupportedError(self, "chip_id")
 
+    def _efuse_cache_addrs(self):
+        return [self.EFUSE_RD_REG_BASE + 4 * n for n in range(7)]
+
     def read_mac(self):
         """ Read MAC from EFUSE region """
         words = [self.read_efuse(2), self.read_efuse(1)]
@@ -1981,6 +2102,10 @@ class ESP32S2ROM(ESP32ROM):
     def override_vddsdio(self, new_voltage):
         raise NotImplementedInROMError("VDD_SDIO overrides are not supported for ESP32-S2")
 
+    def _efuse_cache_addrs(self):
+        # BLOCK0 words from the key purposes up to the end of the system data block
+        return [self.EFUSE_BASE + offs for offs in range(0x030, 0x080, 4)]
+
     def read_mac(self):
         mac0 = self.read_reg(self.MAC_EFUSE_REG)
         mac1 = self.read_reg(self.MAC_EFUSE_REG + 4)  # only bottom 16 bits are MAC
@@ -2227,6 +2352,10 @@ class ESP32S3ROM(ESP32ROM):
     def override_vddsdio(self, new_voltage):
         raise NotImplementedInROMError("VDD_SDIO overrides are not supported for ESP32-S3")
 
+    def _efuse_cache_addrs(self):
+        # BLOCK0 words from the key purposes up to the end of the system data block
+        return [self.EFUSE_BASE + offs for offs in range(0x030, 0x080, 4)]
+
     def read_mac(self):
         mac0 = self.read_reg(self.MAC_EFUSE_REG)
         mac1 = self.read_reg(self.MAC_EFUSE_REG + 4)  # only bottom 16 bits are MAC
@@ -2398,6 +2527,10 @@ class ESP32C3ROM(ESP32ROM):
     def override_vddsdio(self, new_voltage):
         raise NotImplementedInROMError("VDD_SDIO overrides are not supported for ESP32-C3")
 
+    def _efuse_cache_addrs(self):
+        # BLOCK0 words from the key purposes up to the end of the system data block
+        return [self.EFUSE_BASE + offs for offs in range(0x030, 0x080, 4)]
+
     def read_mac(self):
         mac0 = self.read_reg(self.MAC_EFUSE_REG)
         mac1 = self.read_reg(self.MAC_EFUSE_REG + 4)  # only bottom 16 bits are MAC
@@ -2522,6 +2655,10 @@ class ESP32H2BETA1ROM(ESP32ROM):
     def override_vddsdio(self, new_voltage):
         raise NotImplementedInROMError("VDD_SDIO overrides are not supported for ESP32-H2")
 
+    def _efuse_cache_addrs(self):
+        # BLOCK0 words from the key purposes up to the end of the system data block
+        return [self.EFUSE_BASE + offs for offs in range(0x030, 0x080, 4)]
+
     def read_mac(self):
         mac0 = self.read_reg(self.MAC_EFUSE_REG)
         mac1 = self.read_reg(self.MAC_EFUSE_REG + 4)  # only bottom 16 bits are MAC
@@ -2662,6 +2799,8 @@ class ESP32StubLoader(ESP32ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
 
@@ -2682,6 +2821,8 @@ class ESP32S2StubLoader(ESP32S2ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
         if rom_loader.uses_usb():
@@ -2706,6 +2847,8 @@ class ESP32S3BETA2StubLoader(ESP32S3BETA2ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
 
@@ -2726,6 +2869,8 @@ class ESP32S3StubLoader(ESP32S3ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
         if rom_loader.uses_usb():
@@ -2750,6 +2895,8 @@ class ESP32C3StubLoader(ESP32C3ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
 
@@ -2770,6 +2917,8 @@ class ESP32H2BETA1StubLoader(ESP32H2BETA1ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
 
@@ -2790,6 +2939,8 @@ class ESP32H2BETA2StubLoader(ESP32H2BETA2ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
 
@@ -2810,6 +2961,8 @@ class ESP32C2StubLoader(ESP32C2ROM):
         self.secure_download_mode = rom_loader.secure_download_mode
         self._port = rom_loader._port
         self._trace_enabled = rom_loader._trace_enabled
+        self._efuse_cache = rom_loader._efuse_cache
+        self._device_info = rom_loader._device_info
         self.flush_input()  # resets _slip_reader
 
 
@@ -4030,7 +4183,7 @@ def detect_flash_size(esp, args):
     if args.flash_size == 'detect':
         if esp.secure_download_mode:
             raise FatalError("Detecting flash size is not supported in secure download mode. Need to manually specify flash size.")
-        flash_id = esp.flash_id()
+        flash_id = esp.device_info(flash_id=True)['flash_id']
         size_id = flash_id >> 16
         args.flash_size = DETECTED_FLASH_SIZES.get(size_id)
         if args.flash_size is None:
@@ -4087,12 +4240,26 @@ def _update_image_flash_params(esp, address, args, image):
 
 
 def write_flash(esp, args):
+    compress_explicit = args.compress is not None or args.no_compress
     # set args.compress based on default behaviour:
     # -> if either --compress or --no-compress is set, honour that
     # -> otherwise, set --compress unless --no-stub is set
     if args.compress is None and not args.no_compress:
         args.compress = not args.no_stub
 
+    # apply the profile measured by autotune_flash for this chip and transport, if any
+    compress_level = 9
+    profile = None if getattr(args, 'no_flash_profile', False) else _load_flash_profile(esp)
+    if profile is not None and profile['block_size'] <= esp.FLASH_WRITE_SIZE:
+        esp.FLASH_WRITE_SIZE = profile['block_size']
+        if not compress_explicit:
+            args.compress = profile['compress_level'] > 0
+        if profile['compress_level'] > 0:
+            compress_level = profile['compress_level']
+        print('Using flash write profile: block size 0x%x, %s' % (esp.FLASH_WRITE_SIZE, _describe_compress_level(profile['compress_level'])))
+    if getattr(args, 'compress_level', None) is not None:
+        compress_level = args.compress_level
+
     # In case we have encrypted files to write, we first do few sanity checks before actual flash
     if args.encrypt or args.encrypt_files is not None:
         do_write = True
@@ -4195,7 +4362,7 @@ def write_flash(esp, args):
         uncsize = len(image)
         if compress:
             uncimage = image
-            image = zlib.compress(uncimage, 9)
+            image = zlib.compress(uncimage, compress_level)
             # Decompress the compressed binary a block at a time, to dynamically calculate the
             # timeout based on the real write size
             decompress = zlib.decompressobj()
@@ -4296,6 +4463,164 @@ def write_flash(esp, args):
             verify_flash(esp, args)
 
 
+FLASH_PROFILES_FILE = os.path.join(os.path.expanduser('~'), '.esptool', 'flash_profiles.json')
+
+
+def _flash_profiles_path():
+    return os.environ.get('ESPTOOL_FLASH_PROFILES', FLASH_PROFILES_FILE)
+
+
+def _flash_profile_key(esp):
+    return "%s/%s/%s" % (esp.CHIP_NAME, "stub" if esp.IS_STUB else "rom", esp.transport_id())
+
+
+def _load_flash_profiles():
+    try:
+        with open(_flash_profiles_path(), 'r') as f:
+            profiles = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return profiles if isinstance(profiles, dict) else {}
+
+
+def _load_flash_profile(esp):
+    """ Return the stored write profile for the connected chip and transport, or None """
+    if esp.secure_download_mode:
+        return None
+    profile = _load_flash_profiles().get(_flash_profile_key(esp))
+    try:
+        return {'block_size': int(profile['block_size']), 'compress_level': int(profile['compress_level'])}
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+def _save_flash_profile(esp, profile):
+    path = _flash_profiles_path()
+    profiles = _load_flash_profiles()
+    profiles[_flash_profile_key(esp)] = profile
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    return path
+
+
+def _describe_compress_level(level):
+    return 'compression level %d' % level if level > 0 else 'uncompressed'
+
+
+def autotune_sample(size):
+    """ Deterministic test data with the mix of code, strings and erased areas of a typical app image """
+    rng = random.Random(size)
+    chunks = []
+    while sum(len(c) for c in chunks) < size:
+        kind = rng.randint(0, 3)
+        length = rng.randint(0x100, 0x1000)
+        if kind == 0:  # incompressible, like encrypted or already compressed data
+            chunks.append(bytes(bytearray(rng.getrandbits(8) for _ in range(length))))
+        elif kind == 1:  # code: limited alphabet of instruction bytes
+            chunks.append(bytes(bytearray(rng.choice(bytearray(b'\x00\x01\x06\x0c\x11\x20\x41\x80\x91\xa2\xc0\xf0')) for _ in range(length))))
+        elif kind == 2:  # strings
+            chunks.append(b''.join(rng.choice([b'error ', b'flash ', b'%s: %d\n', b'wifi ', b'esp_']) for _ in range(length // 6)))
+        else:  # erased flash
+            chunks.append(b'\xff' * length)
+    return b''.join(chunks)[:size]
+
+
+def _timed_flash_write(esp, data, address, block_size, level):
+    """ Write data at address with the given block size and compression level (0 = uncompressed), return seconds taken """
+    saved_write_size = esp.FLASH_WRITE_SIZE
+    esp.FLASH_WRITE_SIZE = block_size
+    try:
+        t = time.time()
+        timeout = DEFAULT_TIMEOUT
+        if level > 0:
+            image = zlib.compress(data, level)
+            decompress = zlib.decompressobj()
+            blocks = esp.flash_defl_begin(len(data), len(image), address)
+            for seq in range(blocks):
+                block = image[seq * block_size:(seq + 1) * block_size]
+                block_timeout = max(DEFAULT_TIMEOUT, timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, len(decompress.decompress(block))))
+                if not esp.IS_STUB:
+                    timeout = block_timeout  # ROM code writes block to flash before ACKing
+                esp.flash_defl_block(block, seq, timeout=timeout)
+                if esp.IS_STUB:
+                    timeout = block_timeout
+        else:
+            blocks = esp.flash_begin(len(data), address)
+            for seq in range(blocks):
+                block = data[seq * block_size:(seq + 1) * block_size]
+                esp.flash_block(block + b'\xff' * (block_size - len(block)), seq)
+        if esp.IS_STUB:
+            # wait until the last block has actually been written out to flash
+            esp.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR, timeout=timeout)
+        return time.time() - t
+    finally:
+        esp.FLASH_WRITE_SIZE = saved_write_size
+
+
+def autotune_flash(esp, args):
+    if esp.secure_download_mode:
+        raise FatalError("Flash write autotuning is not supported in Secure Download Mode.")
+    if args.address % esp.FLASH_SECTOR_SIZE:
+        raise FatalError("Scratch address 0x%x is not aligned to a 0x%x byte flash sector." % (args.address, esp.FLASH_SECTOR_SIZE))
+    sample = args.sample.read()[:args.size] if args.sample is not None else autotune_sample(args.size)
+    sample = pad_to(sample, 4)
+    if len(sample) == 0:
+        raise FatalError("Sample data for autotuning is empty.")
+
+    # the default block size is the largest one the loader accepts, only try smaller ones
+    max_block = esp.FLASH_WRITE_SIZE
+    block_sizes = sorted(set(b for b in (max_block // 4, max_block // 2, max_block) if b >= ESPLoader.FLASH_WRITE_SIZE))
+    levels = [0, 1, 6, 9]
+
+    original = None
+    if args.no_backup:
+        print('WARNING: %d bytes at 0x%08x will be overwritten and not restored.' % (len(sample), args.address))
+    else:
+        print('Backing up %d bytes at 0x%08x...' % (len(sample), args.address))
+        try:
+            original = esp.read_flash(args.address, len(sample))
+        except NotImplementedInROMError:
+            raise FatalError("The %s ROM loader can't read the flash to back up the scratch region. "
+                             "Use the stub loader, or pass --no-backup to overwrite %d bytes at 0x%08x "
+                             "without restoring them."
+                             % (esp.CHIP_NAME, len(sample), args.address))
+
+    results = []
+    print('Block size  Transfer               Throughput')
+    try:
+        for block_size in block_sizes:
+            for level in levels:
+                try:
+                    elapsed = min(_timed_flash_write(esp, sample, args.address, block_size, level)
+                                  for _ in range(args.repeat))
+                except (FatalError, NotImplementedInROMError) as e:
+                    print('0x%-8x  %-21s  failed (%s)' % (block_size, _describe_compress_level(level), e))
+                    esp.flush_input()
+                    continue
+                kbits = len(sample) / max(elapsed, 1e-6) * 8 / 1000
+                results.append((kbits, block_size, level))
+                print('0x%-8x  %-21s  %.1f kbit/s' % (block_size, _describe_compress_level(level), kbits))
+    finally:
+        # the scratch region is restored even if the measurement is interrupted (serial error, timeout, Ctrl-C)
+        if original is not None:
+            print('Restoring flash contents...')
+            _timed_flash_write(esp, original, args.address, max_block, 9)
+            if esp.flash_md5sum(args.address, len(original)) != hashlib.md5(original).hexdigest():
+                raise FatalError("Restoring flash contents at 0x%08x failed, the backup does not match the flash."
+                                 % args.address)
+
+    if not results:
+        raise FatalError("No block size and compression level combination could be measured.")
+    kbits, block_size, level = max(results)
+    path = _save_flash_profile(esp, {'block_size': block_size, 'compress_level': level,
+                                     'kbit_s': round(kbits, 1), 'sample_size': len(sample)})
+    print('Fastest: block size 0x%x, %s (%.1f kbit/s)' % (block_size, _describe_compress_level(level), kbits))
+    print('Profile for %s saved to %s' % (_flash_profile_key(esp), path))
+
+
 def image_info(args):
     if args.chip == "auto":
         print("WARNING: --chip not specified, defaulting to ESP8266.")
@@ -4334,6 +4659,172 @@ def image_info(args):
         pass  # ESP8266 image has no append_digest field
 
 
+class _CapturedOutput(object):
+    """ Minimal stdout replacement collecting the warnings printed while an image is parsed """
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines += [line for line in text.splitlines() if line.strip()]
+
+    def flush(self):
+        pass
+
+
+def _detect_image_chip(header):
+    """ Guess the chip an image was built for from its (extended) header.
+
+    ESP32-family images carry the chip ID in the extended header, which always starts with
+    the WP pin field (usually WP_PIN_DISABLED). Anything else is treated as an ESP8266 image.
+    """
+    if len(header) >= 24 and byte(header, 0) == ESPLoader.ESP_IMAGE_MAGIC and byte(header, 8) == ESP32FirmwareImage.WP_PIN_DISABLED:
+        chip_id = struct.unpack('<H', header[12:14])[0]
+        for chip in SUPPORTED_CHIPS:
+            rom_loader = _chip_to_rom_loader(chip)
+            if getattr(rom_loader, 'IMAGE_CHIP_ID', None) == chip_id:
+                return chip
+    return 'esp8266'
+
+
+def _image_info_worker(job):
+    """ Analyse a single firmware image and return the result as a JSON-serialisable dict.
+
+    Runs in a worker process of image_info_batch, so it must not raise: parse errors are
+    reported in the 'error' field of the result.
+    """
+    chip, filename, digest = job
+    result = {'file': filename, 'sha256': digest, 'chip': chip}
+    captured = _CapturedOutput()
+    saved_stdout, sys.stdout = sys.stdout, captured
+    try:
+        image = LoadFirmwareImage(chip, filename)
+        rom_loader = image.ROM_LOADER
+        flash_sizes = dict((v, k) for (k, v) in rom_loader.FLASH_SIZES.items())
+        flash_freqs = dict((v, k) for (k, v) in rom_loader.FLASH_FREQUENCY.items())
+        flash_modes = {0: 'qio', 1: 'qout', 2: 'dio', 3: 'dout'}
+        result['image_version'] = image.version
+        result['entrypoint'] = image.entrypoint
+        result['flash_params'] = {
+            'mode': flash_modes.get(image.flash_mode, image.flash_mode),
+            'size': flash_sizes.get(image.flash_size_freq & 0xF0, image.flash_size_freq & 0xF0),
+            'freq': flash_freqs.get(image.flash_size_freq & 0x0F, image.flash_size_freq & 0x0F),
+        }
+        if chip != 'esp8266':
+            result['min_rev_full'] = image.min_rev_full
+            result['max_rev_full'] = image.max_rev_full
+        result['segments'] = [{'addr': seg.addr,
+                               'length': len(seg.data),
+                               'file_offs': seg.file_offs,
+                               'memory_types': seg.get_memory_type(image)} for seg in image.segments]
+        calc_checksum = image.calculate_checksum()
+        result['checksum'] = {'stored': image.checksum,
+                              'calculated': calc_checksum,
+                              'valid': image.checksum == calc_checksum}
+        if getattr(image, 'append_digest', False):
+            result['validation_hash'] = {'stored': hexify(image.stored_digest).lower(),
+                                         'calculated': hexify(image.calc_digest).lower(),
+                                         'valid': image.stored_digest == image.calc_digest}
+        else:
+            result['validation_hash'] = None
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        sys.stdout = saved_stdout
+    result['warnings'] = captured.lines
+    return result
+
+
+def _is_image_file(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(1)
+    return len(magic) == 1 and byte(magic, 0) in (ESPLoader.ESP_IMAGE_MAGIC, ESPBOOTLOADER.IMAGE_V2_MAGIC)
+
+
+def _expand_image_paths(paths):
+    """ Expand directories to the sorted list of *.bin application images they contain (recursively).
+
+    Files given explicitly are always returned, files found in directories only if they start
+    with an image magic byte (so partition tables and filesystem images are skipped).
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, n) for n in sorted(names)
+                          if n.lower().endswith('.bin') and _is_image_file(os.path.join(root, n))]
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise FatalError('No such file or directory: %s' % path)
+    return files
+
+
+def image_info_batch(args):
+    """ Analyse many firmware images in parallel and emit the results as JSON.
+
+    Results are cached by (chip, SHA-256 of the file content) in the --cache file, so re-running
+    over the same release directories only parses new or changed images.
+    """
+    files = _expand_image_paths(args.paths)
+
+    cache = {}
+    if args.cache and os.path.exists(args.cache):
+        with open(args.cache, 'r') as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                print('WARNING: Ignoring corrupted image_info cache %s' % args.cache, file=sys.stderr)
+
+    jobs = []
+    for filename in files:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        chip = args.chip if args.chip != 'auto' else _detect_image_chip(data[:24])
+        jobs.append((chip, filename, hashlib.sha256(data).hexdigest()))
+
+    def cache_key(job):
+        return '%s:%s' % (job[0], job[2])
+
+    pending = [job for job in jobs if cache_key(job) not in cache]
+    if pending:
+        if args.jobs == 1 or len(pending) == 1:
+            analysed = [_image_info_worker(job) for job in pending]
+        else:
+            pool = multiprocessing.Pool(args.jobs or None)
+            try:
+                analysed = pool.map(_image_info_worker, pending)
+            finally:
+                pool.close()
+                pool.join()
+        for job, result in zip(pending, analysed):
+            cache[cache_key(job)] = result
+
+    results = []
+    for job in jobs:
+        result = dict(cache[cache_key(job)])
+        result['file'] = job[1]  # the same content may be cached under a different path
+        results.append(result)
+
+    if args.cache:
+        with open(args.cache, 'w') as f:
+            json.dump(cache, f, sort_keys=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print('Wrote image info of %d file(s) (%d analysed, %d cached) to %s'
+              % (len(results), len(pending), len(results) - len(pending), args.output), file=sys.stderr)
+    else:
+        print(output)
+    failed = len([r for r in results if 'error' in r])
+    if failed:
+        # stdout carries the JSON report, so don't raise FatalError (its message would be printed there)
+        print('%d image(s) could not be parsed' % failed, file=sys.stderr)
+        sys.exit(2)
+
+
 def make_image(args):
     image = ESP8266ROMFirmwareImage()
     if len(args.segfile) == 0:
@@ -4757,6 +5248,23 @@ def main(argv=None, esp=None):
                                action="store_true", default=None)
     compress_args.add_argument('--no-compress', '-u', help='Disable data compression during transfer (default if --no-stub is specified)',
                                action="store_true")
+    parser_write_flash.add_argument('--compress-level', help='zlib compression level used with --compress (default: 9, or the autotuned profile)',
+                                    type=int, choices=range(1, 10), default=None)
+    parser_write_flash.add_argument('--no-flash-profile', help='Ignore the block size and compression profile stored by autotune_flash',
+                                    action='store_true')
+
+    parser_autotune_flash = subparsers.add_parser(
+        'autotune_flash',
+        help='Measure flash write throughput for several block sizes and compression levels on a scratch region '
+             'and store the fastest as the write_flash profile for this chip and transport')
+    parser_autotune_flash.add_argument('address', help='Scratch flash address used for the test writes (sector aligned)', type=arg_auto_int)
+    parser_autotune_flash.add_argument('--size', help='Amount of test data to write (default 64KB)', type=arg_auto_int, default=0x10000)
+    parser_autotune_flash.add_argument('--sample', help='File with representative data to write instead of the built-in sample '
+                                       '(image entropy affects the best compression level)', type=argparse.FileType('rb'))
+    parser_autotune_flash.add_argument('--repeat', help='Number of timed writes per combination, the fastest counts (default 1)',
+                                       type=arg_auto_int, default=1)
+    parser_autotune_flash.add_argument('--no-backup', help='Overwrite the scratch region without backing it up and restoring it '
+                                       '(required if the loader can\'t read the flash)', action='store_true')
 
     subparsers.add_parser(
         'run',
@@ -4767,6 +5275,16 @@ def main(argv=None, esp=None):
         help='Dump headers from an application image')
     parser_image_info.add_argument('filename', help='Image file to parse')
 
+    parser_image_info_batch = subparsers.add_parser(
+        'image_info_batch',
+        help='Dump headers of many application images (files or directories of *.bin) as JSON')
+    parser_image_info_batch.add_argument('paths', help='Image files or directories to scan for *.bin files', nargs='+')
+    parser_image_info_batch.add_argument('--jobs', '-j', help='Number of worker processes (default: one per CPU)',
+                                         type=int, default=0)
+    parser_image_info_batch.add_argument('--cache', help='JSON file caching results by image content hash', default=None)
+    parser_image_info_batch.add_argument('--output', '-o', help='Write the JSON report to this file instead of stdout',
+                                         default=None)
+
     parser_make_image = subparsers.add_parser(
         'make_image',
         help='Create an application image from binary files')
@@ -4913,7 +5431,8 @@ def main(argv=None, esp=None):
     argv = expand_file_arguments(argv or sys.argv[1:])
 
     args = parser.parse_args(argv)
-    print('esptool.py v%s' % __version__)
+    # keep stdout machine-readable for operations emitting JSON
+    print('esptool.py v%s' % __version__, file=sys.stderr if args.operation == 'image_info_batch' else sys.stdout)
 
     # operation function can take 1 arg (args), 2 args (esp, arg)
     # or be a member function of the ESPLoader class.
@@ -4958,9 +5477,10 @@ def main(argv=None, esp=None):
         if esp.secure_download_mode:
             print("Chip is %s in Secure Download Mode" % esp.CHIP_NAME)
         else:
-            print("Chip is %s" % (esp.get_chip_description()))
-            print("Features: %s" % ", ".join(esp.get_chip_features()))
-            print("Crystal is %dMHz" % esp.get_crystal_freq())
+            info = esp.device_info()
+            print("Chip is %s" % info['description'])
+            print("Features: %s" % ", ".join(info['features']))
+            print("Crystal is %dMHz" % info['crystal_mhz'])
             read_mac(esp, args)
 
         if not args.no_stub:
@@ -4996,8 +5516,7 @@ def main(argv=None, esp=None):
         # XMC chip startup sequence
         XMC_VENDOR_ID = 0x20
 
-        def is_xmc_chip_strict():
-            id = esp.flash_id()
+        def is_xmc_chip_strict(id):
             rdid = ((id & 0xff) << 16) | ((id >> 16) & 0xff) | (id & 0xff00)
 
             vendor_id = ((rdid >> 16) & 0xFF)
@@ -5022,7 +5541,7 @@ def main(argv=None, esp=None):
         def flash_xmc_startup():
             # If the RDID value is a valid XMC one, may skip the flow
             fast_check = True
-            if fast_check and is_xmc_chip_strict():
+            if fast_check and is_xmc_chip_strict(esp.device_info(flash_id=True)['flash_id']):
                 return  # Successful XMC flash chip boot-up detected by RDID, skipping.
 
             sfdp_mfid_addr = 0x10
@@ -5037,15 +5556,15 @@ def main(argv=None, esp=None):
             time.sleep(0.002)               # Delay tXUDPD
             esp.run_spiflash_command(0xAB)  # Release Power-Down
             time.sleep(0.00002)
-            # Check for success
-            if not is_xmc_chip_strict():
+            # Check for success, the flash ID read before the fix is stale now
+            if not is_xmc_chip_strict(esp.device_info(flash_id=True, refresh=True)['flash_id']):
                 print("WARNING: XMC flash boot-up fix failed.")
             print("XMC flash chip boot-up fix successful!")
 
         # Check flash chip connection
         if not esp.secure_download_mode:
             try:
-                flash_id = esp.flash_id()
+                flash_id = esp.device_info(flash_id=True)['flash_id']
                 if flash_id in (0xffffff, 0x000000):
                     print('WARNING: Failed to communicate with the flash chip, read/write operations will fail. '
                           'Try checking the chip connections or removing any other hardware connected to IOs.')
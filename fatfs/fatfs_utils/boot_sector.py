@@ -1,12 +1,13 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 from inspect import getmembers, isroutine
-from typing import Optional
+from typing import BinaryIO, List, Optional, Tuple
 
 from construct import Const, Int8ul, Int16ul, Int32ul, PaddedString, Struct, core
 
 from .exceptions import InconsistentFATAttributes, NotInitialized
 from .fatfs_state import BootSectorState
+from .struct_codec import StructCodec
 from .utils import (ALLOWED_SECTOR_SIZES, ALLOWED_SECTORS_PER_CLUSTER, EMPTY_BYTE, FAT32, FULL_BYTE,
                     SHORT_NAMES_ENCODING, FATDefaults, generate_4bytes_random, pad_string)
 
@@ -54,54 +55,105 @@ class BootSector:
         'Signature_word' / Const(FATDefaults.SIGNATURE_WORD)
     )
     assert BOOT_SECTOR_HEADER.sizeof() == BOOT_HEADER_SIZE
+    BOOT_SECTOR_CODEC = StructCodec(BOOT_SECTOR_HEADER, [
+        ('BS_jmpBoot', '3s'),
+        ('BS_OEMName', f'{MAX_OEM_NAME_SIZE}s'),
+        ('BPB_BytsPerSec', 'H'),
+        ('BPB_SecPerClus', 'B'),
+        ('BPB_RsvdSecCnt', 'H'),
+        ('BPB_NumFATs', 'B'),
+        ('BPB_RootEntCnt', 'H'),
+        ('BPB_TotSec16', 'H'),
+        ('BPB_Media', 'B'),
+        ('BPB_FATSz16', 'H'),
+        ('BPB_SecPerTrk', 'H'),
+        ('BPB_NumHeads', 'H'),
+        ('BPB_HiddSec', 'I'),
+        ('BPB_TotSec32', 'I'),
+        ('BS_DrvNum', '1s'),
+        ('BS_Reserved1', '1s'),
+        ('BS_BootSig', '1s'),
+        ('BS_VolID', 'I'),
+        ('BS_VolLab', f'{MAX_VOL_LAB_SIZE}s'),
+        ('BS_FilSysType', f'{MAX_FS_TYPE_SIZE}s'),
+        ('BS_EMPTY', '448s'),
+        ('Signature_word', '2s'),
+    ])
 
     def __init__(self, boot_sector_state: Optional[BootSectorState] = None) -> None:
         self._parsed_header: dict = {}
         self.boot_sector_state: BootSectorState = boot_sector_state
 
-    def generate_boot_sector(self) -> None:
+    def _build_header(self) -> bytes:
         boot_sector_state: BootSectorState = self.boot_sector_state
         if boot_sector_state is None:
             raise NotInitialized('The BootSectorState instance is not initialized!')
-        volume_uuid = generate_4bytes_random()
-        pad_header: bytes = (boot_sector_state.sector_size - BootSector.BOOT_HEADER_SIZE) * EMPTY_BYTE
-        data_content: bytes = boot_sector_state.data_sectors * boot_sector_state.sector_size * FULL_BYTE
-        root_dir_content: bytes = boot_sector_state.root_dir_sectors_cnt * boot_sector_state.sector_size * EMPTY_BYTE
-        fat_tables_content: bytes = (boot_sector_state.sectors_per_fat_cnt
-                                     * boot_sector_state.fat_tables_cnt
-                                     * boot_sector_state.sector_size
-                                     * EMPTY_BYTE)
-        self.boot_sector_state.binary_image = (
-            BootSector.BOOT_SECTOR_HEADER.build(
-                dict(BS_OEMName=pad_string(boot_sector_state.oem_name, size=BootSector.MAX_OEM_NAME_SIZE),
-                     BPB_BytsPerSec=boot_sector_state.sector_size,
-                     BPB_SecPerClus=boot_sector_state.sectors_per_cluster,
-                     BPB_RsvdSecCnt=boot_sector_state.reserved_sectors_cnt,
-                     BPB_NumFATs=boot_sector_state.fat_tables_cnt,
-                     BPB_RootEntCnt=boot_sector_state.entries_root_count,
-                     # if fat type is 12 or 16 BPB_TotSec16 is filled and BPB_TotSec32 is 0x00 and vice versa
-                     BPB_TotSec16=0x00 if boot_sector_state.fatfs_type == FAT32 else boot_sector_state.sectors_count,
-                     BPB_Media=boot_sector_state.media_type,
-                     BPB_FATSz16=boot_sector_state.sectors_per_fat_cnt,
-                     BPB_SecPerTrk=boot_sector_state.sec_per_track,
-                     BPB_NumHeads=boot_sector_state.num_heads,
-                     BPB_HiddSec=boot_sector_state.hidden_sectors,
-                     BPB_TotSec32=boot_sector_state.sectors_count if boot_sector_state.fatfs_type == FAT32 else 0x00,
-                     BS_VolID=volume_uuid,
-                     BS_VolLab=pad_string(boot_sector_state.volume_label,
-                                          size=BootSector.MAX_VOL_LAB_SIZE),
-                     BS_FilSysType=pad_string(boot_sector_state.file_sys_type,
-                                              size=BootSector.MAX_FS_TYPE_SIZE)
-                     )
-            ) + pad_header + fat_tables_content + root_dir_content + data_content
+        # the volume ID is random unless it is set explicitly
+        volume_uuid = boot_sector_state.volume_uuid if boot_sector_state.volume_uuid >= 0 else generate_4bytes_random()
+        header_: bytes = BootSector.BOOT_SECTOR_CODEC.build(
+            dict(BS_OEMName=pad_string(boot_sector_state.oem_name, size=BootSector.MAX_OEM_NAME_SIZE),
+                 BPB_BytsPerSec=boot_sector_state.sector_size,
+                 BPB_SecPerClus=boot_sector_state.sectors_per_cluster,
+                 BPB_RsvdSecCnt=boot_sector_state.reserved_sectors_cnt,
+                 BPB_NumFATs=boot_sector_state.fat_tables_cnt,
+                 BPB_RootEntCnt=boot_sector_state.entries_root_count,
+                 # if fat type is 12 or 16 BPB_TotSec16 is filled and BPB_TotSec32 is 0x00 and vice versa
+                 BPB_TotSec16=0x00 if boot_sector_state.fatfs_type == FAT32 else boot_sector_state.sectors_count,
+                 BPB_Media=boot_sector_state.media_type,
+                 BPB_FATSz16=boot_sector_state.sectors_per_fat_cnt,
+                 BPB_SecPerTrk=boot_sector_state.sec_per_track,
+                 BPB_NumHeads=boot_sector_state.num_heads,
+                 BPB_HiddSec=boot_sector_state.hidden_sectors,
+                 BPB_TotSec32=boot_sector_state.sectors_count if boot_sector_state.fatfs_type == FAT32 else 0x00,
+                 BS_VolID=volume_uuid,
+                 BS_VolLab=pad_string(boot_sector_state.volume_label,
+                                      size=BootSector.MAX_VOL_LAB_SIZE),
+                 BS_FilSysType=pad_string(boot_sector_state.file_sys_type,
+                                          size=BootSector.MAX_FS_TYPE_SIZE)
+                 )
         )
+        return header_
+
+    def _empty_regions(self) -> List[Tuple[bytes, int]]:
+        """
+        :returns: the fill byte and the size of the regions following the boot sector header in the empty image
+        """
+        boot_sector_state: BootSectorState = self.boot_sector_state
+        return [
+            (EMPTY_BYTE, boot_sector_state.sector_size - BootSector.BOOT_HEADER_SIZE),  # header padding
+            (EMPTY_BYTE, (boot_sector_state.sectors_per_fat_cnt
+                          * boot_sector_state.fat_tables_cnt
+                          * boot_sector_state.sector_size)),  # FAT tables
+            (EMPTY_BYTE, boot_sector_state.root_dir_sectors_cnt * boot_sector_state.sector_size),  # root directory
+            (FULL_BYTE, boot_sector_state.data_sectors * boot_sector_state.sector_size),  # data region
+        ]
+
+    def generate_boot_sector(self) -> None:
+        header_: bytes = self._build_header()
+        self.boot_sector_state.binary_image = header_ + b''.join(fill_ * size_
+                                                                 for fill_, size_ in self._empty_regions())
+
+    def write_empty_image(self, output: BinaryIO, chunk_size: int = 0x100000) -> int:
+        """
+        Writes the same content as `generate_boot_sector` creates to the output file,
+        the regions are written in chunks so the image is never held in memory as a whole.
+
+        :returns: size of the image
+        """
+        written_: int = output.write(self._build_header())
+        for fill_, size_ in self._empty_regions():
+            chunk_: bytes = fill_ * min(size_, chunk_size)
+            while size_ > 0:
+                written_ += output.write(chunk_[:size_])
+                size_ -= len(chunk_)
+        return written_
 
     def parse_boot_sector(self, binary_data: bytes) -> None:
         """
         Checks the validity of the boot sector and derives the metadata from boot sector to the structured shape.
         """
         try:
-            self._parsed_header = BootSector.BOOT_SECTOR_HEADER.parse(binary_data)
+            self._parsed_header = BootSector.BOOT_SECTOR_CODEC.parse(binary_data)
         except core.StreamError:
             raise NotInitialized('The boot sector header is not parsed successfully!')
 
@@ -1,7 +1,7 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 
 from construct import Int16ul
 
@@ -18,6 +18,7 @@ def get_dir_size(is_root: bool, boot_sector: BootSectorState) -> int:
 class Cluster:
     """
     class Cluster handles values in FAT table and allocates sectors in data region.
+    The clusters of a FAT are light views over its table, created on demand by `FAT.clusters`.
     """
     RESERVED_BLOCK_ID: int = 0
     ROOT_BLOCK_ID: int = 1
@@ -29,34 +30,45 @@ class Cluster:
     def __init__(self,
                  cluster_id: int,
                  boot_sector_state: BootSectorState,
-                 init_: bool) -> None:
+                 init_: bool,
+                 fat: Any = None) -> None:
         """
         Initially, if init_ is False, the cluster is virtual and is not allocated (doesn't do changes in the FAT).
         :param cluster_id: the cluster ID - a key value linking the file's cluster,
           the corresponding physical cluster (data region) and the FAT table cluster.
         :param boot_sector_state: auxiliary structure holding the file-system's metadata
         :param init_: True for allocation the cluster on instantiation, otherwise False.
+        :param fat: the FAT the cluster belongs to, its values are read from and written to the FAT's table.
+          Without FAT the cluster works directly with the FAT region of the binary image.
         :returns: None
         """
         self.id: int = cluster_id
         self.boot_sector_state: BootSectorState = boot_sector_state
+        self.fat = fat
 
-        self._next_cluster = None  # type: Optional[Cluster]
         # First cluster in FAT is reserved, low 8 bits contains BPB_Media and the rest is filled with 1
         # e.g. the esp32 media type is 0xF8 thus the FAT[0] = 0xFF8 for FAT12, 0xFFF8 for FAT16
         if self.id == Cluster.RESERVED_BLOCK_ID and init_:
             self.set_in_fat(self.INITIAL_BLOCK_SWITCH[self.boot_sector_state.fatfs_type])
-            return
-        self.cluster_data_address: int = self._compute_cluster_data_address()
-        assert self.cluster_data_address
+
+    @property
+    def cluster_data_address(self) -> int:
+        cluster_data_address_: int = self._compute_cluster_data_address()
+        return cluster_data_address_
 
     @property
     def next_cluster(self):  # type: () -> Optional[Cluster]
-        return self._next_cluster
+        """
+        The following cluster in the chain, taken from the FAT. None if the cluster is the last one.
+        """
+        if self.fat is None:
+            return None
+        next_id_: Optional[int] = self.fat.get_next_cluster_id(self.id)
+        return None if next_id_ is None else self.fat.clusters[next_id_]
 
     @next_cluster.setter
     def next_cluster(self, value):  # type: (Optional[Cluster]) -> None
-        self._next_cluster = value
+        self.set_in_fat(self.ALLOCATED_BLOCK_SWITCH[self.boot_sector_state.fatfs_type] if value is None else value.id)
 
     def _cluster_id_to_fat_position_in_bits(self, _id: int) -> int:
         """
@@ -120,6 +132,8 @@ class Cluster:
 
         three bytes - AB XC YZ - stores two blocks - CAB YZX
         """
+        if self.fat is not None:
+            return self.fat.get_cluster_value(self.id)
         address_: int = self.real_cluster_address
         bin_img_: bytearray = self.boot_sector_state.binary_image
         if self.boot_sector_state.fatfs_type == FAT12:
@@ -173,6 +187,10 @@ class Cluster:
             self.boot_sector_state.binary_image[address] &= 0xf0
             self.boot_sector_state.binary_image[address] |= value_
 
+        if self.fat is not None:
+            self.fat.set_cluster_value(self.id, value)
+            return
+
         # value must fit into number of bits of the fat (12, 16 or 32)
         assert value <= (1 << self.boot_sector_state.fatfs_type) - 1
         half_bytes = split_by_half_byte_12_bit_little_endian(value)
@@ -0,0 +1,229 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import BinaryIO, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .fat_image import FATImage, FATStat
+from .partition_plan import PartitionPlan
+from .utils import CONTENT_MANIFEST_NAME
+from .virtual_tree import VirtualTree
+
+CONTENT_MANIFEST_MAGIC: str = 'fatfs-content-manifest'
+CHUNK_SIZE: int = 0x10000
+# the path of the file, its size and the function returning the digest of its content
+HashTask = Tuple[str, int, Callable[[], str]]
+
+
+class ManifestEntry(NamedTuple):
+    path: str
+    size: int
+    digest: str
+
+    def format(self) -> str:
+        return f'{self.digest} {self.size} {self.path}\n'
+
+
+def hash_stream(stream: BinaryIO, algorithm: str) -> str:
+    hash_ = hashlib.new(algorithm)
+    for chunk_ in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        hash_.update(chunk_)
+    return hash_.hexdigest()
+
+
+def hash_file(path: str, algorithm: str) -> str:
+    with open(path, 'rb') as file_:
+        return hash_stream(file_, algorithm)
+
+
+def hash_opened(opener: Callable[[], BinaryIO], algorithm: str) -> str:
+    with opener() as stream_:
+        return hash_stream(stream_, algorithm)
+
+
+def hash_image_file(image: FATImage, stat: FATStat, algorithm: str) -> str:
+    """
+    Hashes the content of the file straight from the runs of its cluster chain in the image.
+    """
+    hash_ = hashlib.new(algorithm)
+    if stat.size:
+        for address_, length_ in image.fat.get_chain_runs(stat.first_cluster, stat.size):
+            end_: int = address_ + length_
+            for offset_ in range(address_, end_, CHUNK_SIZE):
+                hash_.update(image.boot_sector_state.binary_image[offset_: min(offset_ + CHUNK_SIZE, end_)])
+    return hash_.hexdigest()
+
+
+def _hash_all(tasks: List[HashTask], jobs: Optional[int]) -> List[ManifestEntry]:
+    """
+    Runs the hashing tasks (the path, the size and the function hashing the content) in the thread pool,
+    `hashlib` releases the GIL for the larger chunks, so the files are hashed in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        digests_: List[str] = list(executor.map(lambda task: task[2](), tasks))
+    return [ManifestEntry(path=path_, size=size_, digest=digest_)
+            for (path_, size_, _), digest_ in zip(tasks, digests_)]
+
+
+class ContentManifest:
+    """
+    The manifest of the files of the partition stored as the file in its root directory, so the tree can be compared
+    by reading the manifest instead of hashing the files (e.g. over the REPL of the device).
+
+    The format is the text parseable without JSON, the first line is the header with the version, the hash algorithm
+    and the tree hash, then a line `<digest> <size> <path>` for each file sorted by the path. The paths are separated
+    by '/' and the names are as they are stored in the image. The tree hash is the hash of the file lines, so it covers
+    the paths, the sizes and the content; the manifest itself is not listed.
+    """
+    VERSION: int = 1
+    HASH_ALGORITHM: str = 'sha256'
+    DIGEST_LENGTH: int = 64
+
+    def __init__(self, entries: List[ManifestEntry]) -> None:
+        self.entries: List[ManifestEntry] = sorted(entries)
+
+    @property
+    def tree_hash(self) -> str:
+        lines_: str = ''.join(entry_.format() for entry_ in self.entries)
+        return hashlib.new(self.HASH_ALGORITHM, lines_.encode()).hexdigest()
+
+    @classmethod
+    def header_size(cls) -> int:
+        return len(f'{CONTENT_MANIFEST_MAGIC} {cls.VERSION} {cls.HASH_ALGORITHM} \n') + cls.DIGEST_LENGTH
+
+    def to_text(self) -> str:
+        return f'{CONTENT_MANIFEST_MAGIC} {self.VERSION} {self.HASH_ALGORITHM} {self.tree_hash}\n' \
+            + ''.join(entry_.format() for entry_ in self.entries)
+
+    @classmethod
+    def parse(cls, text: str) -> 'ContentManifest':
+        """
+        :raises ValueError: the text is not the manifest or the tree hash does not match the files
+        """
+        lines_: List[str] = text.splitlines()
+        header_: List[str] = lines_[0].split(' ') if lines_ else []
+        if len(header_) != 4 or header_[0] != CONTENT_MANIFEST_MAGIC:
+            raise ValueError('The content manifest has no valid header!')
+        if int(header_[1]) != cls.VERSION or header_[2] != cls.HASH_ALGORITHM:
+            raise ValueError(f'Unsupported version or hash of the content manifest: {header_[1]} {header_[2]}')
+        entries_: List[ManifestEntry] = []
+        for line_ in lines_[1:]:
+            digest_, size_, path_ = line_.split(' ', 2)
+            entries_.append(ManifestEntry(path=path_, size=int(size_), digest=digest_))
+        manifest_: ContentManifest = cls(entries_)
+        if manifest_.tree_hash != header_[3]:
+            raise ValueError('The tree hash of the content manifest does not match its files!')
+        return manifest_
+
+    @classmethod
+    def image_tasks(cls,
+                    image: FATImage,
+                    manifest_name: str = CONTENT_MANIFEST_NAME) -> List[HashTask]:
+        """
+        The hashing tasks of the files of the image, the manifest in the root directory is skipped.
+        The directories are parsed here, so the tasks only read the content.
+        """
+        tasks_: List[HashTask] = []
+        for directory_, _, _ in image.walk():
+            for stat_ in image.scandir(directory_):  # type: FATStat
+                if stat_.is_dir or stat_.path == manifest_name:
+                    continue
+                tasks_.append((stat_.path, stat_.size, partial(hash_image_file, image, stat_, cls.HASH_ALGORITHM)))
+        return tasks_
+
+    @classmethod
+    def plan_tasks(cls, plan: PartitionPlan) -> List[HashTask]:
+        """
+        The hashing tasks of the planned files, the paths are the ones the files have in the generated image.
+        """
+        tasks_: List[HashTask] = []
+        for object_ in plan.objects:
+            if object_.is_dir:
+                continue
+            hasher_: Callable[[], str] = partial(hash_opened, object_.opener, cls.HASH_ALGORITHM) \
+                if object_.opener is not None else partial(hash_file, object_.real_path, cls.HASH_ALGORITHM)
+            tasks_.append(('/'.join(object_.path), object_.size, hasher_))
+        return tasks_
+
+    @classmethod
+    def from_image(cls,
+                   image: FATImage,
+                   manifest_name: str = CONTENT_MANIFEST_NAME,
+                   jobs: Optional[int] = None) -> 'ContentManifest':
+        """
+        Hashes the files of the image, the manifest in the root directory is skipped.
+
+        :param jobs: number of the hashing threads, None for the default of `ThreadPoolExecutor`
+        """
+        return cls(_hash_all(cls.image_tasks(image, manifest_name), jobs))
+
+    @classmethod
+    def from_plan(cls, plan: PartitionPlan, jobs: Optional[int] = None) -> 'ContentManifest':
+        """
+        Hashes the source files of the plan, i.e. the manifest the image generated from the plan would have.
+        The files of the virtual tree are hashed one by one, the archives can not be read concurrently.
+        """
+        return cls(_hash_all(cls.plan_tasks(plan), 1 if isinstance(plan.input_directory, VirtualTree) else jobs))
+
+    @classmethod
+    def read_from_image(cls, image: FATImage, manifest_name: str = CONTENT_MANIFEST_NAME) -> 'ContentManifest':
+        return cls.parse(image.read_file(manifest_name).decode())
+
+    @classmethod
+    def planned_size(cls, plan: PartitionPlan) -> int:
+        """
+        The size of the manifest of the planned files, it is known before the files are hashed.
+        """
+        return cls.header_size() + sum(len(ManifestEntry('/'.join(object_.path), object_.size,
+                                                         cls.DIGEST_LENGTH * '0').format().encode())
+                                       for object_ in plan.objects if not object_.is_dir)
+
+    @classmethod
+    def verify(cls,
+               image: FATImage,
+               plan: PartitionPlan,
+               manifest_name: str = CONTENT_MANIFEST_NAME,
+               jobs: Optional[int] = None) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Compares the files of the image with the source files of the plan, both are hashed in the same thread pool
+        and nothing is written to the disk. The paths are compared case-insensitively as by FAT.
+
+        :returns: the paths of the files missing in the image, the files only in the image and the files which differ
+        """
+        image_tasks_: List[HashTask] = [
+            (path_.upper(), size_, hasher_) for path_, size_, hasher_ in cls.image_tasks(image, manifest_name)]
+        return cls.compare_tasks(cls.plan_tasks(plan), image_tasks_, jobs,
+                                 sources_in_parallel=not isinstance(plan.input_directory, VirtualTree))
+
+    @classmethod
+    def compare_tasks(cls,
+                      source_tasks: List[HashTask],
+                      image_tasks: List[HashTask],
+                      jobs: Optional[int] = None,
+                      sources_in_parallel: bool = True) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Hashes the source files and the files of the image in the same thread pool and compares them by the paths.
+
+        :param sources_in_parallel: False if the sources can not be read concurrently (e.g. the archive)
+        :returns: the paths of the files missing in the image, the files only in the image and the files which differ
+        """
+        if sources_in_parallel:
+            entries_: List[ManifestEntry] = _hash_all(image_tasks + source_tasks, jobs)
+            image_entries_, source_entries_ = entries_[:len(image_tasks)], entries_[len(image_tasks):]
+        else:
+            image_entries_ = _hash_all(image_tasks, jobs)
+            source_entries_ = _hash_all(source_tasks, 1)
+        return cls(source_entries_).diff(cls(image_entries_))
+
+    def diff(self, other: 'ContentManifest') -> Tuple[List[str], List[str], List[str]]:
+        """
+        :returns: the paths of the files missing in the other manifest, the files only in the other manifest
+            and the files which differ
+        """
+        own_: Dict[str, ManifestEntry] = {entry_.path: entry_ for entry_ in self.entries}
+        others_: Dict[str, ManifestEntry] = {entry_.path: entry_ for entry_ in other.entries}
+        return (sorted(own_.keys() - others_.keys()),
+                sorted(others_.keys() - own_.keys()),
+                sorted(path_ for path_ in own_.keys() & others_.keys() if own_[path_] != others_[path_]))
@@ -0,0 +1,204 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import struct
+from array import array
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from .cluster import Cluster
+from .entry import Entry
+from .fat import pack_fat12, pack_fat16
+from .fat_image import DELETED_ENTRY_MARK, FATImage, FATStat
+from .utils import EMPTY_BYTE, FAT12, FULL_BYTE, MAX_NAME_SIZE, FATDefaults, required_clusters_count_for_size
+
+# the offset of DIR_FstClusLO in the short entry
+FIRST_CLUSTER_OFFSET: int = 26
+DOT_NAMES: Tuple[bytes, bytes] = (b'.       ', b'..      ')
+
+
+class FragmentationReport(NamedTuple):
+    files: int
+    fragmented_files: int
+    directories: int
+    fragmented_directories: int
+    # the runs of the adjacent clusters of all the files and the directories
+    fragments: int
+    used_clusters: int
+    free_clusters: int
+    free_runs: int
+    largest_free_run: int
+    # the free clusters at the end of the data region
+    free_tail: int
+
+    def format(self) -> str:
+        return '\n'.join([
+            f'files:                  {self.files} ({self.fragmented_files} fragmented)',
+            f'directories:            {self.directories} ({self.fragmented_directories} fragmented)',
+            f'fragments:              {self.fragments}',
+            f'used clusters:          {self.used_clusters}',
+            f'free clusters:          {self.free_clusters} in {self.free_runs} runs '
+            f'(largest {self.largest_free_run}, {self.free_tail} at the end)',
+        ])
+
+
+class _PackedDirectory:
+    def __init__(self, first_cluster: Optional[int], slots: List[bytearray]) -> None:
+        # the original first cluster, None for the root directory
+        self.first_cluster: Optional[int] = first_cluster
+        # the used entries of the directory, the deleted ones are dropped
+        self.slots: List[bytearray] = slots
+        self.new_cluster: int = 0
+
+
+class FATDefragmenter(FATImage):
+    """
+    Rewrites the plain FAT image (without wear levelling) so every object occupies consecutive clusters
+    and the objects follow each other from the start of the data region in the order of their entries,
+    directory by directory (depth-first). The deleted entries are dropped from the directories, so the directories
+    are packed, and all the free clusters are at the end of the data region. The entries (names, attributes,
+    timestamps) and the content of the files stay the same, only the first clusters change.
+    """
+
+    def fragmentation(self) -> FragmentationReport:
+        files_ = fragmented_files_ = directories_ = fragmented_directories_ = fragments_ = 0
+        for directory_, _, _ in self.walk():
+            for stat_ in self.scandir(directory_):  # type: FATStat
+                runs_cnt_: int = len(self.fat.get_chain_runs(stat_.first_cluster)) if stat_.first_cluster else 0
+                fragments_ += runs_cnt_
+                if stat_.is_dir:
+                    directories_ += 1
+                    fragmented_directories_ += runs_cnt_ > 1
+                else:
+                    files_ += 1
+                    fragmented_files_ += runs_cnt_ > 1
+        free_runs_: List[int] = []
+        previous_free_: bool = False
+        for value_ in self.fat.table[Cluster.ROOT_BLOCK_ID + 1:]:
+            if value_ == 0:
+                if previous_free_:
+                    free_runs_[-1] += 1
+                else:
+                    free_runs_.append(1)
+            previous_free_ = value_ == 0
+        free_clusters_: int = sum(free_runs_)
+        return FragmentationReport(files=files_,
+                                   fragmented_files=fragmented_files_,
+                                   directories=directories_,
+                                   fragmented_directories=fragmented_directories_,
+                                   fragments=fragments_,
+                                   used_clusters=len(self.fat.table) - Cluster.ROOT_BLOCK_ID - 1 - free_clusters_,
+                                   free_clusters=free_clusters_,
+                                   free_runs=len(free_runs_),
+                                   largest_free_run=max(free_runs_, default=0),
+                                   free_tail=free_runs_[-1] if previous_free_ else 0)
+
+    def _packed_directory(self, first_cluster: Optional[int]) -> _PackedDirectory:
+        raw_: bytes = self._directory_bytes(first_cluster)
+        slots_: List[bytearray] = []
+        for position_ in range(0, len(raw_) - len(raw_) % FATDefaults.ENTRY_SIZE, FATDefaults.ENTRY_SIZE):
+            if raw_[position_] == 0:
+                break
+            if raw_[position_] != DELETED_ENTRY_MARK:
+                slots_.append(bytearray(raw_[position_: position_ + FATDefaults.ENTRY_SIZE]))
+        return _PackedDirectory(first_cluster, slots_)
+
+    @staticmethod
+    def _is_object(slot: bytearray) -> bool:
+        attributes_: int = slot[11]
+        return attributes_ != Entry.ATTR_LONG_NAME and not attributes_ & Entry.ATTR_VOLUME_ID \
+            and bytes(slot[:MAX_NAME_SIZE]) not in DOT_NAMES
+
+    def defragment(self) -> bytearray:
+        """
+        :returns: the new image of the same size and geometry
+        """
+        state_ = self.boot_sector_state
+        cluster_size_: int = state_.sector_size
+        directories_: List[_PackedDirectory] = []
+        # (old first cluster, new first cluster, size) of the files
+        files_: List[Tuple[int, int, int]] = []
+        table_: array = array('H', bytes(2 * len(self.fat.table)))
+        table_[Cluster.RESERVED_BLOCK_ID] = self.fat.table[Cluster.RESERVED_BLOCK_ID]
+        table_[Cluster.ROOT_BLOCK_ID] = self.fat.table[Cluster.ROOT_BLOCK_ID]
+        next_cluster_: int = Cluster.ROOT_BLOCK_ID + 1
+
+        def allocate(clusters_cnt_: int) -> int:
+            nonlocal next_cluster_
+            first_: int = next_cluster_
+            next_cluster_ += clusters_cnt_
+            for id_ in range(first_, next_cluster_ - 1):
+                table_[id_] = id_ + 1
+            table_[next_cluster_ - 1] = (1 << self.fat.fatfs_type) - 1
+            return first_
+
+        def place(directory_: _PackedDirectory) -> None:
+            subdirectories_: List[Tuple[bytearray, _PackedDirectory]] = []
+            for slot_ in directory_.slots:
+                if not self._is_object(slot_):
+                    continue
+                first_cluster_: int = struct.unpack_from('<H', slot_, FIRST_CLUSTER_OFFSET)[0]
+                if slot_[11] & Entry.ATTR_DIRECTORY:
+                    subdirectory_: _PackedDirectory = self._packed_directory(first_cluster_)
+                    subdirectory_.new_cluster = allocate(max(1, required_clusters_count_for_size(
+                        cluster_size_, len(subdirectory_.slots) * FATDefaults.ENTRY_SIZE)))
+                    subdirectories_.append((slot_, subdirectory_))
+                    continue
+                size_: int = struct.unpack_from('<I', slot_, FIRST_CLUSTER_OFFSET + 2)[0]
+                new_cluster_: int = allocate(required_clusters_count_for_size(cluster_size_, size_)) \
+                    if size_ and first_cluster_ else 0
+                struct.pack_into('<H', slot_, FIRST_CLUSTER_OFFSET, new_cluster_)
+                if new_cluster_:
+                    files_.append((first_cluster_, new_cluster_, size_))
+            for slot_, subdirectory_ in subdirectories_:
+                struct.pack_into('<H', slot_, FIRST_CLUSTER_OFFSET, subdirectory_.new_cluster)
+                for dot_slot_ in subdirectory_.slots:
+                    if bytes(dot_slot_[:MAX_NAME_SIZE]) == DOT_NAMES[0]:
+                        struct.pack_into('<H', dot_slot_, FIRST_CLUSTER_OFFSET, subdirectory_.new_cluster)
+                    elif bytes(dot_slot_[:MAX_NAME_SIZE]) == DOT_NAMES[1] and directory_.first_cluster is not None:
+                        # the link to the root directory is kept as it is
+                        struct.pack_into('<H', dot_slot_, FIRST_CLUSTER_OFFSET, directory_.new_cluster)
+                directories_.append(subdirectory_)
+                place(subdirectory_)
+
+        root_: _PackedDirectory = self._packed_directory(None)
+        place(root_)
+
+        image_: bytearray = bytearray(len(self._image))
+        data_start_: int = state_.data_region_start
+        image_[:state_.fat_table_start_address] = self._image[:state_.fat_table_start_address]
+        image_[data_start_:] = FULL_BYTE * (len(image_) - data_start_)
+        fat_: bytes = pack_fat12(table_) if self.fat.fatfs_type == FAT12 else pack_fat16(table_)
+        for fat_index_ in range(state_.fat_tables_cnt):
+            fat_start_: int = state_.fat_table_start_address + fat_index_ * state_.sectors_per_fat_cnt * cluster_size_
+            image_[fat_start_: fat_start_ + len(fat_)] = fat_
+        root_bytes_: bytes = b''.join(root_.slots)
+        image_[state_.root_directory_start: state_.root_directory_start + len(root_bytes_)] = root_bytes_
+        for directory_ in directories_:
+            address_: int = Cluster.compute_cluster_data_address(state_, directory_.new_cluster)
+            directory_bytes_: bytes = b''.join(directory_.slots)
+            clusters_cnt_: int = max(1, required_clusters_count_for_size(cluster_size_, len(directory_bytes_)))
+            image_[address_: address_ + clusters_cnt_ * cluster_size_] = directory_bytes_.ljust(
+                clusters_cnt_ * cluster_size_, EMPTY_BYTE)
+        for old_cluster_, new_cluster_, size_ in files_:
+            address_ = Cluster.compute_cluster_data_address(state_, new_cluster_)
+            for chunk_ in self.fat.iter_chained_content(old_cluster_, size_):
+                image_[address_: address_ + len(chunk_)] = chunk_
+                address_ += len(chunk_)
+        return image_
+
+
+def _objects(image: FATImage) -> Iterator[FATStat]:
+    for directory_, _, _ in image.walk():
+        for stat_ in image.scandir(directory_):
+            yield stat_._replace(first_cluster=0)
+
+
+def same_content(image: FATImage, other: FATImage) -> bool:
+    """
+    Compares the trees of the images: the names, the attributes, the timestamps and the content of the files.
+    The placement of the objects is not compared.
+    """
+    objects_: List[FATStat] = list(_objects(image))
+    if objects_ != list(_objects(other)):
+        return False
+    return all(image.read_file(stat_.path) == other.read_file(stat_.path) for stat_ in objects_ if not stat_.is_dir)
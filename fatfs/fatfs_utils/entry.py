@@ -1,12 +1,14 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
-from typing import List, Optional, Union
+from bisect import bisect_right
+from typing import Dict, Iterator, List, Optional, Union
 
 from construct import Const, Int8ul, Int16ul, Int32ul, PaddedString, Struct
 
 from .exceptions import LowerCaseException, TooLongNameException
 from .fatfs_state import FATFSState
+from .struct_codec import StructCodec
 from .utils import (DATETIME, EMPTY_BYTE, FATFS_INCEPTION, MAX_EXT_SIZE, MAX_NAME_SIZE, SHORT_NAMES_ENCODING,
                     FATDefaults, build_date_entry, build_time_entry, is_valid_fatfs_name, pad_string)
 
@@ -61,6 +63,23 @@ class Entry:
         'DIR_FstClusLO' / Int16ul,
         'DIR_FileSize' / Int32ul,
     )
+    # (de)serialization of the short entries is done by the equivalent struct based codec,
+    # the construct definition above is used for validation of the invalid entries
+    ENTRY_CODEC = StructCodec(ENTRY_FORMAT_SHORT_NAME, [
+        ('DIR_Name', f'{MAX_NAME_SIZE}s'),
+        ('DIR_Name_ext', f'{MAX_EXT_SIZE}s'),
+        ('DIR_Attr', 'B'),
+        ('DIR_NTRes', 'B'),
+        ('DIR_CrtTimeTenth', '1s'),
+        ('DIR_CrtTime', 'H'),
+        ('DIR_CrtDate', 'H'),
+        ('DIR_LstAccDate', 'H'),
+        ('DIR_FstClusHI', '2s'),
+        ('DIR_WrtTime', 'H'),
+        ('DIR_WrtDate', 'H'),
+        ('DIR_FstClusLO', 'H'),
+        ('DIR_FileSize', 'I'),
+    ])
 
     def __init__(self,
                  entry_id: int,
@@ -83,12 +102,12 @@ class Entry:
 
     @staticmethod
     def _parse_entry(entry_bytearray: Union[bytearray, bytes]) -> dict:
-        entry_: dict = Entry.ENTRY_FORMAT_SHORT_NAME.parse(entry_bytearray)
+        entry_: dict = Entry.ENTRY_CODEC.parse(entry_bytearray)
         return entry_
 
     @staticmethod
     def _build_entry(**kwargs) -> bytes:  # type: ignore
-        entry_: bytes = Entry.ENTRY_FORMAT_SHORT_NAME.build(dict(**kwargs))
+        entry_: bytes = Entry.ENTRY_CODEC.build(dict(**kwargs))
         return entry_
 
     @staticmethod
@@ -249,5 +268,77 @@ class Entry:
         and builds new binary entry.
         """
         parsed_entry = self._parse_entry(self.entry_bytes)
-        parsed_entry.DIR_FileSize = content_size  # type: ignore
-        self.entry_bytes = Entry.ENTRY_FORMAT_SHORT_NAME.build(parsed_entry)
+        parsed_entry['DIR_FileSize'] = content_size
+        self.entry_bytes = Entry.ENTRY_CODEC.build(parsed_entry)
+
+
+class EntryTable:
+    """
+    The entries of the directory, the slots are held in the compact form: the address and the number of slots
+    of every block (the root directory region or the cluster of the directory) and one byte per slot
+    marking it as used. The Entry objects are created only when the slot is accessed and kept only then.
+    """
+
+    def __init__(self, fatfs_state: FATFSState) -> None:
+        self.fatfs_state: FATFSState = fatfs_state
+        self._blocks_addresses: List[int] = []
+        self._blocks_starts: List[int] = []
+        self._slots_used: bytearray = bytearray()
+        self._entries: Dict[int, Entry] = {}
+
+    def add_block(self, address: int, entries_count: int) -> None:
+        """
+        Appends the slots of the next cluster of the directory.
+        """
+        self._blocks_addresses.append(address)
+        self._blocks_starts.append(len(self._slots_used))
+        self._slots_used += bytes(entries_count)
+
+    def __len__(self) -> int:
+        return len(self._slots_used)
+
+    def __getitem__(self, index: int) -> Entry:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Entry index out of range')
+        entry_: Optional[Entry] = self._entries.get(index)
+        if entry_ is None:
+            block_: int = bisect_right(self._blocks_starts, index) - 1
+            entry_ = Entry(entry_id=index - self._blocks_starts[block_],
+                           parent_dir_entries_address=self._blocks_addresses[block_],
+                           fatfs_state=self.fatfs_state)
+            self._entries[index] = entry_
+        return entry_
+
+    def __iter__(self) -> Iterator[Entry]:
+        for index_ in range(len(self)):
+            yield self[index_]
+
+    @property
+    def materialized_count(self) -> int:
+        return len(self._entries)
+
+    @property
+    def free_count(self) -> int:
+        count_: int = 0
+        index_: Optional[int] = self.find_free_entry_id()
+        while index_ is not None:
+            count_ += 1
+            index_ = self.find_free_entry_id(index_ + 1)
+        return count_
+
+    def find_free_entry_id(self, start: int = 0) -> Optional[int]:
+        """
+        :returns: index of the first empty slot from the `start`, None if there is no empty slot
+        """
+        while True:
+            index_: int = self._slots_used.find(0, start)
+            if index_ < 0:
+                return None
+            entry_: Optional[Entry] = self._entries.get(index_)
+            if entry_ is None or entry_.is_empty:
+                return index_
+            # the entry was allocated since the last search
+            self._slots_used[index_] = 1
+            start = index_ + 1
@@ -15,6 +15,13 @@ class NoFreeClusterException(Exception):
     pass
 
 
+class NoFreeBlockException(Exception):
+    """
+    Exception is raised when the content does not fit the blocks of the LittleFS partition
+    """
+    pass
+
+
 class LowerCaseException(Exception):
     """
     Exception is raised when the user tries to write file or directory with lower case
@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+from typing import Any, Dict, List, NamedTuple
+
+from .fat_image import FATImage, FATStat
+from .fatfs_state import BootSectorState
+from .utils import FULL_BYTE
+
+
+class ImageExtent(NamedTuple):
+    """
+    The populated region of the image, it is aligned to the sectors.
+    """
+    offset: int
+    length: int
+    kind: str
+    # the path of the directory or the file the extent belongs to
+    path: str = ''
+
+
+def fat_image_extents(image: Any, base_offset: int = 0) -> List[ImageExtent]:
+    """
+    Lists the populated extents of the plain FAT image: the boot sector, the FAT, the root directory
+    and the clusters of the directories and the files (the runs of the adjacent clusters).
+    The rest of the image is the erased data region.
+
+    :param image: the plain FAT image as bytes-like object or mmap
+    :param base_offset: the offset of the FAT image in the partition (the dummy sector of the wear levelling)
+    """
+    fat_image_: FATImage = FATImage(image)
+    state_: BootSectorState = fat_image_.boot_sector_state
+    extents_: List[ImageExtent] = [
+        ImageExtent(0, state_.fat_table_start_address, 'boot_sector'),
+        ImageExtent(state_.fat_table_start_address, state_.root_directory_start - state_.fat_table_start_address,
+                    'fat'),
+        ImageExtent(state_.root_directory_start, state_.data_region_start - state_.root_directory_start,
+                    'root_directory'),
+    ]
+    stack_: List[str] = ['']
+    while stack_:
+        for stat_ in fat_image_.scandir(stack_.pop()):  # type: FATStat
+            if stat_.is_dir:
+                stack_.append(stat_.path)
+            if not stat_.first_cluster:
+                continue
+            kind_: str = 'directory' if stat_.is_dir else 'file'
+            extents_ += [ImageExtent(address_, length_, kind_, stat_.path)
+                         for address_, length_ in fat_image_.fat.get_chain_runs(stat_.first_cluster)]
+    return sorted((extent_._replace(offset=extent_.offset + base_offset) for extent_ in extents_),
+                  key=lambda extent: extent.offset)
+
+
+class ExtentsManifest:
+    """
+    The sidecar of the image listing its populated extents with their hashes, the rest of the image is erased.
+    Flashers write only the extents (after erasing the partition), verifiers read back only them.
+    """
+    VERSION: int = 1
+    HASH_ALGORITHM: str = 'sha256'
+
+    def __init__(self, image: Any, extents: List[ImageExtent]) -> None:
+        self.image_size: int = len(image)
+        self.extents: List[ImageExtent] = extents
+        self.hashes: List[str] = [
+            hashlib.new(self.HASH_ALGORITHM, image[extent_.offset: extent_.offset + extent_.length]).hexdigest()
+            for extent_ in extents
+        ]
+
+    @property
+    def populated_size(self) -> int:
+        return sum(extent_.length for extent_ in self.extents)
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {
+            'version': self.VERSION,
+            'image_size': self.image_size,
+            'erased_byte': FULL_BYTE[0],
+            'hash': self.HASH_ALGORITHM,
+            'extents': [dict(offset=extent_.offset, length=extent_.length, kind=extent_.kind, path=extent_.path,
+                             digest=hash_)
+                        for extent_, hash_ in zip(self.extents, self.hashes)],
+        }
+
+    def write_manifest(self, path: str) -> None:
+        with open(path, 'w') as manifest_file:
+            json.dump(self.to_manifest(), manifest_file, indent=1)
+            manifest_file.write('\n')
+
+    @classmethod
+    def verify(cls, manifest: Dict[str, Any], image: Any) -> List[ImageExtent]:
+        """
+        Checks the image (e.g. read back from the flash) against the manifest.
+
+        :returns: the extents of the manifest which differ in the image
+        """
+        if manifest.get('version') != cls.VERSION:
+            raise ValueError(f'Unsupported version of the extents manifest: {manifest.get("version")}')
+        mismatches_: List[ImageExtent] = []
+        for extent_ in manifest['extents']:
+            offset_, length_ = extent_['offset'], extent_['length']
+            if hashlib.new(manifest['hash'], image[offset_: offset_ + length_]).hexdigest() != extent_['digest']:
+                mismatches_.append(ImageExtent(offset_, length_, extent_['kind'], extent_['path']))
+        return mismatches_
@@ -1,17 +1,99 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
-from typing import List, Optional
+import sys
+from array import array
+from collections import deque
+from typing import Any, BinaryIO, Deque, Iterable, Iterator, List, Optional, Tuple
 
 from .cluster import Cluster
-from .exceptions import NoFreeClusterException
+from .exceptions import FatalError, NoFreeClusterException
 from .fatfs_state import BootSectorState
+from .image_view import ImageView
+from .utils import FAT12, FAT16
+
+
+def unpack_fat12(raw: bytes, entries_cnt: int) -> array:
+    """
+    Decodes `entries_cnt` FAT12 entries from their on-disk form in bulk.
+
+    Every three bytes AB XC YZ store two entries CAB and YZX. The bytes are spread into 32-bit words
+    (AB XC YZ 00 -> 0xYZXCAB), the lower 12 bits of the word are the even entry, the upper 12 bits the odd one.
+    """
+    pairs_cnt: int = (entries_cnt + 1) // 2
+    raw = bytes(raw[:pairs_cnt * 3]).ljust(pairs_cnt * 3, b'\x00')
+    words_bytes = bytearray(pairs_cnt * 4)
+    for i in range(3):
+        words_bytes[i::4] = raw[i::3]
+    words = array('I', bytes(words_bytes))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    table = array('H', bytes(pairs_cnt * 4))
+    table[0::2] = array('H', [word & 0xFFF for word in words])
+    table[1::2] = array('H', [word >> 12 for word in words])
+    return table[:entries_cnt]
+
+
+def pack_fat12(table: array) -> bytes:
+    """
+    Encodes FAT12 entries to their on-disk form in bulk, the reverse of `unpack_fat12`.
+    Odd number of entries leaves the last half byte zero.
+    """
+    even, odd = table[0::2], table[1::2]
+    if len(odd) < len(even):
+        odd.append(0)
+    words = array('I', [even_ | (odd_ << 12) for even_, odd_ in zip(even, odd)])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    words_bytes = words.tobytes()
+    raw = bytearray(len(words) * 3)
+    for i in range(3):
+        raw[i::3] = words_bytes[i::4]
+    return bytes(raw[:(len(table) * 3 + 1) // 2])
+
+
+def unpack_fat16(raw: bytes, entries_cnt: int) -> array:
+    table = array('H', bytes(raw[:entries_cnt * 2]).ljust(entries_cnt * 2, b'\x00'))
+    if sys.byteorder == 'big':
+        table.byteswap()
+    return table
+
+
+def pack_fat16(table: array) -> bytes:
+    table_ = array('H', table)
+    if sys.byteorder == 'big':
+        table_.byteswap()
+    return table_.tobytes()
+
+
+class ClusterViews:
+    """
+    Read-only sequence of the clusters of the FAT. The `Cluster` objects are thin views
+    over the FAT table created only when indexed, so no per-cluster objects are kept in memory.
+    """
+
+    def __init__(self, fat):  # type: (FAT) -> None
+        self._fat = fat
+
+    def __len__(self) -> int:
+        return len(self._fat.table)
+
+    def __getitem__(self, cluster_id: int) -> Cluster:
+        if cluster_id < 0:
+            cluster_id += len(self)
+        if not 0 <= cluster_id < len(self):
+            raise IndexError('cluster index out of range')
+        return Cluster(cluster_id=cluster_id, boot_sector_state=self._fat.boot_sector_state, init_=False, fat=self._fat)
 
 
 class FAT:
     """
     The FAT represents the FAT region in file system. It is responsible for storing clusters
     and chaining them in case we need to extend file or directory to more clusters.
+
+    The values of the FAT are held in the array `table` (one item per cluster), every change
+    is written through to the FAT region of the binary image as well. The free clusters are tracked
+    by the bitmap `_allocated` (one byte per cluster), so the clusters freed in the existing image are reused.
     """
 
     def allocate_root_dir(self) -> None:
@@ -22,14 +104,78 @@ class FAT:
         self.clusters[Cluster.ROOT_BLOCK_ID].allocate_cluster()
 
     def __init__(self, boot_sector_state: BootSectorState, init_: bool) -> None:
-        self._first_free_cluster_id = 1
         self.boot_sector_state = boot_sector_state
-        self.clusters: List[Cluster] = [Cluster(cluster_id=i,
-                                                boot_sector_state=self.boot_sector_state,
-                                                init_=init_) for i in range(self.boot_sector_state.clusters)]
+        self.fatfs_type: int = self.boot_sector_state.fatfs_type
+        self.table: array = self._read_table()
+        self._allocated: bytearray = bytearray(value_ != 0 for value_ in self.table)
+        # clusters preceding the cursor are allocated, the first data cluster has id 2
+        self._free_cluster_cursor: int = Cluster.ROOT_BLOCK_ID + 1
+        # clusters planned for the object being allocated, see `plan_allocation`
+        self._planned: Deque[int] = deque()
+        self.clusters: ClusterViews = ClusterViews(self)
         if init_:
+            # First cluster in FAT is reserved, low 8 bits contains BPB_Media and the rest is filled with 1
+            # e.g. the esp32 media type is 0xF8 thus the FAT[0] = 0xFF8 for FAT12, 0xFFF8 for FAT16
+            self.set_cluster_value(Cluster.RESERVED_BLOCK_ID, Cluster.INITIAL_BLOCK_SWITCH[self.fatfs_type])
             self.allocate_root_dir()
 
+    def _read_table(self) -> array:
+        """
+        Decodes the whole FAT region of the binary image into the array of cluster values at once.
+        """
+        if self.fatfs_type not in (FAT12, FAT16):
+            raise NotImplementedError('Only valid fatfs types are FAT12 and FAT16.')
+        clusters_cnt: int = self.boot_sector_state.clusters
+        start_: int = self.boot_sector_state.fat_table_start_address
+        raw_: bytes = self.boot_sector_state.binary_image[start_: start_ + (clusters_cnt * self.fatfs_type + 7) // 8]
+        if self.fatfs_type == FAT12:
+            return unpack_fat12(raw_, clusters_cnt)
+        return unpack_fat16(raw_, clusters_cnt)
+
+    def pack_table(self) -> bytes:
+        """
+        Returns the FAT table in the on-disk form.
+        """
+        if self.fatfs_type == FAT12:
+            return pack_fat12(self.table)
+        return pack_fat16(self.table)
+
+    def write_table(self) -> None:
+        """
+        Writes the whole FAT table to the binary image in bulk.
+        """
+        packed_: bytes = self.pack_table()
+        start_: int = self.boot_sector_state.fat_table_start_address
+        bin_img_: bytearray = self.boot_sector_state.binary_image
+        if self.fatfs_type == FAT12 and len(self.table) % 2:
+            # keep the upper half of the last byte, it doesn't belong to any cluster
+            packed_ = packed_[:-1] + bytes([packed_[-1] | (bin_img_[start_ + len(packed_) - 1] & 0xF0)])
+        bin_img_[start_: start_ + len(packed_)] = packed_
+
+    def set_cluster_value(self, cluster_id_: int, value: int) -> None:
+        """
+        Sets the value of the cluster in the FAT table and in the FAT region of the binary image.
+        For FAT12 the cluster with even index owns the first byte and the low half of the second byte,
+        the odd one owns the high half of the first byte and the whole second byte.
+        """
+        # value must fit into number of bits of the fat (12, 16 or 32)
+        assert value <= (1 << self.fatfs_type) - 1
+        self.table[cluster_id_] = value
+        self._allocated[cluster_id_] = value != 0
+        if value == 0 and cluster_id_ < self._free_cluster_cursor:
+            self._free_cluster_cursor = max(cluster_id_, Cluster.ROOT_BLOCK_ID + 1)
+        bin_img_: bytearray = self.boot_sector_state.binary_image
+        address_: int = self.boot_sector_state.fat_table_start_address + (cluster_id_ * self.fatfs_type) // 8
+        if self.fatfs_type == FAT16:
+            bin_img_[address_] = value & 0xFF
+            bin_img_[address_ + 1] = value >> 8
+        elif cluster_id_ % 2 == 0:
+            bin_img_[address_] = value & 0xFF
+            bin_img_[address_ + 1] = (bin_img_[address_ + 1] & 0xF0) | (value >> 8)
+        else:
+            bin_img_[address_] = (bin_img_[address_] & 0x0F) | ((value & 0x0F) << 4)
+            bin_img_[address_ + 1] = value >> 4
+
     def get_cluster_value(self, cluster_id_: int) -> int:
         """
         The method retrieves the values of the FAT memory block.
@@ -39,7 +185,7 @@ class FAT:
         The reserved value is 0xFF8, the value of first cluster if 0xFFF, thus is last in chain,
         and the value of the second cluster is 0x555, so refers to the cluster number 0x555.
         """
-        fat_cluster_value_: int = self.clusters[cluster_id_].get_from_fat()
+        fat_cluster_value_: int = self.table[cluster_id_]
         return fat_cluster_value_
 
     def is_cluster_last(self, cluster_id_: int) -> bool:
@@ -48,46 +194,168 @@ class FAT:
         0xFFF for FAT12, 0xFFFF for FAT16 or 0xFFFFFFFF for FAT32, the cluster is the last.
         """
         value_ = self.get_cluster_value(cluster_id_)
-        is_cluster_last_: bool = value_ == (1 << self.boot_sector_state.fatfs_type) - 1
+        is_cluster_last_: bool = value_ == (1 << self.fatfs_type) - 1
         return is_cluster_last_
 
-    def get_chained_content(self, cluster_id_: int, size: Optional[int] = None) -> bytearray:
+    def get_next_cluster_id(self, cluster_id_: int) -> Optional[int]:
         """
-        The purpose of the method is retrieving the content from chain of clusters when the FAT FS partition
-        is analyzed. The file entry provides the reference to the first cluster, this method
-        traverses linked list of clusters and append partial results to the content.
+        Returns the id of the cluster following the given one in its chain,
+        None if the cluster is the last one or it is not allocated.
         """
-        binary_image: bytearray = self.boot_sector_state.binary_image
+        value_: int = self.table[cluster_id_]
+        if value_ in (0, (1 << self.fatfs_type) - 1) or value_ >= len(self.table):
+            return None
+        return value_
 
-        data_address_ = Cluster.compute_cluster_data_address(self.boot_sector_state, cluster_id_)
-        content_ = binary_image[data_address_: data_address_ + self.boot_sector_state.sector_size]
+    def get_cluster_chain(self, cluster_id_: int) -> List[int]:
+        """
+        Resolves the linked list of clusters starting with `cluster_id_` to the list of cluster ids.
+        The chain ends with the cluster marked as last in FAT.
 
+        :raises FatalError: the chain is cyclic
+        """
+        chain_: List[int] = [cluster_id_]
         while not self.is_cluster_last(cluster_id_):
             cluster_id_ = self.get_cluster_value(cluster_id_)
-            data_address_ = Cluster.compute_cluster_data_address(self.boot_sector_state, cluster_id_)
-            content_ += binary_image[data_address_: data_address_ + self.boot_sector_state.sector_size]
-        # the size is None if the object is directory
+            chain_.append(cluster_id_)
+            if len(chain_) > len(self.table):
+                raise FatalError(f'The cluster chain starting with cluster {chain_[0]} is cyclic!')
+        return chain_
+
+    def get_chain_runs(self, cluster_id_: int, size: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Translates the chain of clusters to the list of (address, length) runs of the binary image.
+        Clusters adjacent in the data region are coalesced to a single run.
+
+        :param cluster_id_: the first cluster of the chain
+        :param size: number of bytes of the content, the runs are trimmed to it. None for the whole chain.
+        """
+        sector_size_: int = self.boot_sector_state.sector_size
+        runs_: List[Tuple[int, int]] = []
+        previous_id_: Optional[int] = None
+        for id_ in self.get_cluster_chain(cluster_id_):
+            # the root directory cluster is not part of the data region
+            if previous_id_ is not None and id_ == previous_id_ + 1 and previous_id_ != Cluster.ROOT_BLOCK_ID:
+                address_, length_ = runs_[-1]
+                runs_[-1] = (address_, length_ + sector_size_)
+            else:
+                runs_.append((Cluster.compute_cluster_data_address(self.boot_sector_state, id_), sector_size_))
+            previous_id_ = id_
         if size is None:
-            return content_
-        return content_[:size]
+            return runs_
+        trimmed_runs_: List[Tuple[int, int]] = []
+        for address_, length_ in runs_:
+            if size <= 0:
+                break
+            trimmed_runs_.append((address_, min(length_, size)))
+            size -= length_
+        return trimmed_runs_
 
-    def find_free_cluster(self) -> Cluster:
+    def iter_chained_content(self, cluster_id_: int, size: Optional[int] = None) -> Iterator[memoryview]:
+        """
+        Yields the content of the chain of clusters as memoryviews of the binary image, one per run of
+        adjacent clusters, without copying the data.
         """
-        Returns the first free cluster and increments value of `self._first_free_cluster_id`.
-        The method works only in context of creating a partition from scratch.
-        In situations where the clusters are allocated and freed during the run of the program,
-        might the method cause `Out of space` error despite there would be free clusters.
+        image_: Any = self.boot_sector_state.binary_image
+        if isinstance(image_, ImageView):
+            # the run may span more extents of the remapped image
+            for address_, length_ in self.get_chain_runs(cluster_id_, size):
+                yield from image_.iter_slices(address_, address_ + length_)
+            return
+        image_view_: memoryview = memoryview(image_)
+        for address_, length_ in self.get_chain_runs(cluster_id_, size):
+            yield image_view_[address_: address_ + length_]
+
+    def write_chained_content(self, output: BinaryIO, cluster_id_: int, size: Optional[int] = None) -> int:
+        """
+        Streams the content of the chain of clusters directly into the output file.
+
+        :returns: number of bytes written
         """
+        written_: int = 0
+        for part_ in self.iter_chained_content(cluster_id_, size):
+            output.write(part_)
+            written_ += len(part_)
+        return written_
 
-        if self._first_free_cluster_id + 1 >= len(self.clusters):
-            raise NoFreeClusterException('No free cluster available!')
-        cluster = self.clusters[self._first_free_cluster_id + 1]
-        if not cluster.is_empty:
-            raise NoFreeClusterException('No free cluster available!')
+    def get_chained_content(self, cluster_id_: int, size: Optional[int] = None) -> bytearray:
+        """
+        The purpose of the method is retrieving the content from chain of clusters when the FAT FS partition
+        is analyzed. The file entry provides the reference to the first cluster, this method
+        resolves the chain to runs of adjacent clusters and gathers them into the content with a single copy.
+        """
+        # the size is None if the object is directory
+        return bytearray().join(self.iter_chained_content(cluster_id_, size))
+
+    @property
+    def free_clusters_count(self) -> int:
+        return len(self._allocated) - (Cluster.ROOT_BLOCK_ID + 1) - self._allocated.count(1, Cluster.ROOT_BLOCK_ID + 1)
+
+    def find_free_cluster(self, planned: bool = True) -> Cluster:
+        """
+        Allocates and returns the first free cluster according to the bitmap of the allocated clusters.
+        When the partition is created from scratch the clusters are allocated in their order,
+        the clusters freed later (e.g. by `free_chain`) are reused.
+
+        :param planned: take the next cluster planned by `plan_allocation` if there is any
+        """
+        if planned and self._planned:
+            cluster_id_: int = self._planned.popleft()
+            if self.table[cluster_id_] != 0:
+                raise FatalError(f'The planned cluster {cluster_id_} is not free!')
+        else:
+            cluster_id_ = self._allocated.find(0, self._free_cluster_cursor)
+            if cluster_id_ < 0:
+                self._free_cluster_cursor = len(self._allocated)
+                raise NoFreeClusterException('No free cluster available!')
+            self._free_cluster_cursor = cluster_id_ + 1
+        cluster = self.clusters[cluster_id_]
         cluster.allocate_cluster()
-        self._first_free_cluster_id += 1
         return cluster
 
+    def find_free_run(self, clusters_cnt: int) -> Optional[int]:
+        """
+        :returns: the first cluster of the first run of `clusters_cnt` consecutive free clusters, None if there is none
+        """
+        cluster_id_: int = self._allocated.find(bytes(clusters_cnt), self._free_cluster_cursor)
+        return None if cluster_id_ < 0 else cluster_id_
+
+    def reserve_clusters(self, cluster_ids: Iterable[int]) -> None:
+        """
+        Excludes the free clusters from the allocation by `find_free_cluster`, e.g. the slack kept for the growth
+        of the files. The clusters stay free in the FAT, only the planned allocations may use them.
+        """
+        for cluster_id_ in cluster_ids:
+            if self.table[cluster_id_] == 0:
+                self._allocated[cluster_id_] = 1
+
+    def release_clusters(self, cluster_ids: Iterable[int]) -> None:
+        """
+        Returns the reserved clusters which are still free back to the allocation.
+        """
+        for cluster_id_ in cluster_ids:
+            if self.table[cluster_id_] == 0:
+                self._allocated[cluster_id_] = 0
+                self._free_cluster_cursor = min(self._free_cluster_cursor, cluster_id_)
+
+    def plan_allocation(self, cluster_ids: List[int]) -> None:
+        """
+        The following allocations of the clusters of the object (`find_free_cluster` with `planned` set)
+        take the given clusters in their order instead of the first free ones.
+        """
+        self._planned = deque(cluster_ids)
+
+    def free_chain(self, cluster_id_: int) -> List[int]:
+        """
+        Marks all the clusters of the chain starting with `cluster_id_` as free, the data region is not changed.
+
+        :returns: ids of the freed clusters
+        """
+        chain_: List[int] = self.get_cluster_chain(cluster_id_)
+        for id_ in chain_:
+            self.set_cluster_value(id_, 0)
+        return chain_
+
     def allocate_chain(self, first_cluster: Cluster, size: int) -> None:
         """
         Allocates the linked list of clusters needed for the given file or directory.
@@ -95,6 +363,5 @@ class FAT:
         current = first_cluster
         for _ in range(size - 1):
             free_cluster = self.find_free_cluster()
-            current.next_cluster = free_cluster
             current.set_in_fat(free_cluster.id)
             current = free_cluster
@@ -0,0 +1,395 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import errno
+import mmap
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .cluster import Cluster
+from .entry import Entry
+from .exceptions import LowerCaseException, NoFreeClusterException, TooLongNameException
+from .fat_image import DELETED_ENTRY_MARK, FATImage, FATStat, split_path
+from .fs_object import Directory
+from .long_filename_utils import (MAXIMAL_FILES_SAME_PREFIX, build_lfn_full_name, get_required_lfn_entries_count,
+                                  split_name_to_lfn_entries, split_name_to_lfn_entry_blocks)
+from .utils import (FATFS_INCEPTION, INVALID_SFN_CHARS_PATTERN, MAX_EXT_SIZE, MAX_NAME_SIZE, SHORT_NAMES_ENCODING,
+                    FATDefaults, build_date_entry, build_lfn_short_entry_name, build_time_entry,
+                    is_valid_fatfs_name, lfn_checksum, pad_string, required_clusters_count_for_size,
+                    split_to_name_and_extension)
+
+FREE_ENTRY_MARK: int = 0x00
+
+
+class FATEditor(FATImage):
+    """
+    In-place modification of an existing FAT image (without wear levelling): files are added, replaced,
+    deleted and renamed and directories are created without regenerating the image.
+
+    Only the affected parts of the FAT, the directories and the data region are written. The clusters are
+    allocated by the bitmap allocator of the FAT, so the clusters freed by the previous changes are reused.
+    The flash sectors changed since the image was opened are reported by `dirty_sectors`,
+    only these have to be reflashed.
+    """
+    MMAP_ACCESS: int = mmap.ACCESS_WRITE
+
+    def __init__(self,
+                 image: Any,
+                 long_names_enabled: bool = True,
+                 flash_sector_size: int = FATDefaults.WL_SECTOR_SIZE) -> None:
+        """
+        :param image: writable plain FAT image, e.g. bytearray or mmap opened for writing
+        :param long_names_enabled: the names which don't fit 8.3 format are stored in long file name entries,
+            otherwise they are refused the same way as by the generator
+        :param flash_sector_size: size of the erase unit of the flash the dirty sectors are reported in
+        """
+        super().__init__(image)
+        self.long_names_enabled: bool = long_names_enabled
+        self.flash_sector_size: int = flash_sector_size
+        self._dirty: Set[int] = set()
+
+    @property
+    def dirty_sectors(self) -> List[int]:
+        """
+        Indexes of the flash sectors changed since the image was opened (or `clear_dirty` was called).
+        """
+        return sorted(self._dirty)
+
+    def dirty_extents(self) -> List[Tuple[int, int]]:
+        """
+        The dirty sectors merged to the (offset, length) ranges of the image in bytes.
+        """
+        extents_: List[Tuple[int, int]] = []
+        for sector_ in self.dirty_sectors:
+            offset_: int = sector_ * self.flash_sector_size
+            if extents_ and sum(extents_[-1]) == offset_:
+                extents_[-1] = (extents_[-1][0], extents_[-1][1] + self.flash_sector_size)
+            else:
+                extents_.append((offset_, self.flash_sector_size))
+        return extents_
+
+    def clear_dirty(self) -> None:
+        self._dirty = set()
+
+    def flush(self) -> None:
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def _mark_dirty(self, address: int, length: int) -> None:
+        self._dirty.update(range(address // self.flash_sector_size,
+                                 (address + length - 1) // self.flash_sector_size + 1))
+
+    def _mark_fat_dirty(self, cluster_ids: Iterable[int]) -> None:
+        for cluster_id_ in cluster_ids:
+            # the value of the cluster in FAT12 spans two bytes as well
+            self._mark_dirty(self.boot_sector_state.fat_table_start_address
+                             + (cluster_id_ * self.fat.fatfs_type) // 8, 2)
+
+    def _write(self, address: int, data: Any) -> None:
+        self._image[address: address + len(data)] = data
+        self._mark_dirty(address, len(data))
+
+    def _invalidate(self, parts: Tuple[str, ...], recursive: bool = False) -> None:
+        """
+        Drops the cached listing of the directory and if `recursive` also everything cached under the path.
+        """
+        self._dir_cache.pop(parts, None)
+        if not recursive:
+            return
+        for cache_ in (self._dir_cache, self._entry_slots):
+            for key_ in [key_ for key_ in cache_ if key_[:len(parts)] == parts]:
+                del cache_[key_]
+
+    def _directory_cluster(self, parts: Tuple[str, ...]) -> Optional[int]:
+        """
+        :returns: the first cluster of the directory, None for the root directory
+        """
+        if not parts:
+            return None
+        stat_: FATStat = self._lookup(parts)
+        if not stat_.is_dir:
+            raise NotADirectoryError(f'Not a directory: {"/".join(parts)}')
+        return stat_.first_cluster
+
+    def _slot_address(self, first_cluster: Optional[int], index: int) -> int:
+        if first_cluster is None:
+            return self.boot_sector_state.root_directory_start + index * FATDefaults.ENTRY_SIZE
+        slots_per_cluster_: int = self.boot_sector_state.sector_size // FATDefaults.ENTRY_SIZE
+        cluster_id_: int = self.fat.get_cluster_chain(first_cluster)[index // slots_per_cluster_]
+        return (Cluster.compute_cluster_data_address(self.boot_sector_state, cluster_id_)
+                + (index % slots_per_cluster_) * FATDefaults.ENTRY_SIZE)
+
+    def _resize_chain(self, first_cluster: int, clusters_cnt: int) -> int:
+        """
+        Shrinks or extends the chain of clusters to `clusters_cnt` clusters, the clusters kept keep their content.
+
+        :param first_cluster: the first cluster of the chain, 0 if the object has no cluster
+        :returns: the first cluster of the resized chain, 0 if `clusters_cnt` is 0
+        :raises NoFreeClusterException: there is not enough free clusters, nothing is changed
+        """
+        chain_: List[int] = self.fat.get_cluster_chain(first_cluster) if first_cluster else []
+        if clusters_cnt - len(chain_) > self.fat.free_clusters_count:
+            raise NoFreeClusterException('No free cluster available!')
+        if clusters_cnt < len(chain_):
+            self._mark_fat_dirty(self.fat.free_chain(chain_[clusters_cnt]))
+            del chain_[clusters_cnt:]
+            if chain_:
+                self.fat.set_cluster_value(chain_[-1], Cluster.ALLOCATED_BLOCK_SWITCH[self.fat.fatfs_type])
+                self._mark_fat_dirty(chain_[-1:])
+            return chain_[0] if chain_ else 0
+        while len(chain_) < clusters_cnt:
+            # the new cluster is marked as the last one in FAT and its data are cleaned
+            cluster_: Cluster = self.fat.find_free_cluster()
+            self._mark_dirty(cluster_.cluster_data_address, self.boot_sector_state.sector_size)
+            if chain_:
+                self.fat.set_cluster_value(chain_[-1], cluster_.id)
+                self._mark_fat_dirty(chain_[-1:])
+            self._mark_fat_dirty([cluster_.id])
+            chain_.append(cluster_.id)
+        return chain_[0] if chain_ else 0
+
+    def _write_content(self, first_cluster: int, content: bytes) -> None:
+        offset_: int = 0
+        with memoryview(content) as content_view_:
+            for address_, length_ in self.fat.get_chain_runs(first_cluster, len(content)) if content else []:
+                self._write(address_, content_view_[offset_: offset_ + length_])
+                offset_ += length_
+
+    def _short_names(self, first_cluster: Optional[int]) -> Set[bytes]:
+        """
+        Names (including the extension) recorded in the short entries of the directory.
+        """
+        names_: Set[bytes] = set()
+        directory_bytes_: bytes = self._directory_bytes(first_cluster)
+        usable_size_: int = len(directory_bytes_) - len(directory_bytes_) % FATDefaults.ENTRY_SIZE
+        for values_ in Entry.ENTRY_CODEC.iter_unpack(directory_bytes_[:usable_size_]):
+            if values_[0][0] not in (FREE_ENTRY_MARK, DELETED_ENTRY_MARK) and values_[2] != Entry.ATTR_LONG_NAME:
+                names_.add(values_[0] + values_[1])
+        return names_
+
+    def _build_entries(self, first_cluster: Optional[int], full_name: str, **fields: Any) -> List[bytes]:
+        """
+        Builds the entries of the object named `full_name` in the directory the same way the generator does,
+        the long file name entries (if required) followed by the short entry.
+
+        :param first_cluster: the first cluster of the parent directory, None for the root directory
+        :param fields: the fields of the short entry except the name
+        """
+        name_, extension_ = split_to_name_and_extension(full_name)
+        fits_short_: bool = (len(name_) <= MAX_NAME_SIZE and len(extension_) <= MAX_EXT_SIZE
+                             and not INVALID_SFN_CHARS_PATTERN.search(name_)
+                             and not INVALID_SFN_CHARS_PATTERN.search(extension_))
+        is_upper_: bool = is_valid_fatfs_name(name_) and is_valid_fatfs_name(extension_)
+        if not self.long_names_enabled:
+            if not fits_short_:
+                raise TooLongNameException(
+                    'Maximal length of the object name is {} characters and {} characters for extension!'.format(
+                        MAX_NAME_SIZE, MAX_EXT_SIZE
+                    )
+                )
+            if not is_upper_:
+                raise LowerCaseException('Lower case is not supported in short name entry, use upper case.')
+        if fits_short_ and is_upper_:
+            return [Entry._build_entry(DIR_Name=pad_string(name_, size=MAX_NAME_SIZE),
+                                       DIR_Name_ext=pad_string(extension_, size=MAX_EXT_SIZE),
+                                       DIR_NTRes=Entry.LDIR_DIR_NTRES if self.long_names_enabled else 0x00,
+                                       **fields)]
+
+        existing_names_: Set[bytes] = self._short_names(first_cluster)
+        order_: int = 1
+        while build_lfn_short_entry_name(name_, extension_, order_).encode(SHORT_NAMES_ENCODING) in existing_names_:
+            order_ += 1
+            if order_ > MAXIMAL_FILES_SAME_PREFIX:
+                raise NoFreeClusterException('Maximal number of files with the same prefix is 127')
+        short_name_: str = build_lfn_short_entry_name(name_, extension_, order_)
+        checksum_: int = lfn_checksum(short_name_)
+        lfn_full_name_: str = build_lfn_full_name(name_, extension_)
+        entries_count_: int = get_required_lfn_entries_count(lfn_full_name_)
+        entries_: List[bytes] = []
+        # entries in long file name entries chain starts with the last entry
+        for i, name_part_ in reversed(list(enumerate(split_name_to_lfn_entries(lfn_full_name_, entries_count_)))):
+            lfn_names_: List[bytes] = [block_.lower() for block_ in split_name_to_lfn_entry_blocks(name_part_)]
+            entries_.append(Entry._build_entry_long(lfn_names_, checksum_, i + 1, i + 1 == entries_count_))
+        entries_.append(Entry._build_entry(DIR_Name=short_name_[:MAX_NAME_SIZE],
+                                           DIR_Name_ext=short_name_[MAX_NAME_SIZE:],
+                                           DIR_NTRes=0x00,
+                                           **fields))
+        return entries_
+
+    def _allocate_slots(self, first_cluster: Optional[int], count: int) -> int:
+        """
+        Finds `count` consecutive free entries in the directory, the directory is extended if necessary.
+
+        :returns: index of the first entry
+        """
+        directory_bytes_: bytes = self._directory_bytes(first_cluster)
+        slots_cnt_: int = len(directory_bytes_) // FATDefaults.ENTRY_SIZE
+        run_start_: int = 0
+        run_length_: int = 0
+        for index_ in range(slots_cnt_):
+            if directory_bytes_[index_ * FATDefaults.ENTRY_SIZE] in (FREE_ENTRY_MARK, DELETED_ENTRY_MARK):
+                if run_length_ == 0:
+                    run_start_ = index_
+                run_length_ += 1
+                if run_length_ == count:
+                    return run_start_
+            else:
+                run_length_ = 0
+        if first_cluster is None:
+            raise NoFreeClusterException('Not enough space in root!')
+        if run_length_ == 0:
+            run_start_ = slots_cnt_
+        slots_per_cluster_: int = self.boot_sector_state.sector_size // FATDefaults.ENTRY_SIZE
+        clusters_cnt_: int = len(self.fat.get_cluster_chain(first_cluster))
+        self._resize_chain(first_cluster,
+                           clusters_cnt_ + required_clusters_count_for_size(slots_per_cluster_, count - run_length_))
+        return run_start_
+
+    def _add_entries(self, parent: Tuple[str, ...], name: str, **fields: Any) -> None:
+        first_cluster_: Optional[int] = self._directory_cluster(parent)
+        entries_: List[bytes] = self._build_entries(first_cluster_, name, **fields)
+        start_: int = self._allocate_slots(first_cluster_, len(entries_))
+        for i, entry_ in enumerate(entries_):
+            self._write(self._slot_address(first_cluster_, start_ + i), entry_)
+        self._invalidate(parent)
+
+    def _remove_entries(self, parts: Tuple[str, ...]) -> None:
+        first_cluster_: Optional[int] = self._directory_cluster(parts[:-1])
+        first_slot_, short_slot_ = self._entry_slots[parts]
+        for index_ in range(first_slot_, short_slot_ + 1):
+            self._write(self._slot_address(first_cluster_, index_), bytes([DELETED_ENTRY_MARK]))
+        self._invalidate(parts[:-1])
+
+    def _short_entry_address(self, parts: Tuple[str, ...]) -> int:
+        self._lookup(parts)
+        return self._slot_address(self._directory_cluster(parts[:-1]), self._entry_slots[parts][1])
+
+    def _new_object_path(self, path: str) -> Tuple[Tuple[str, ...], str]:
+        """
+        :returns: the resolved path of the parent directory and the name of the new object
+        """
+        parts_: List[str] = split_path(path)
+        if not parts_:
+            raise FileExistsError('The root directory already exists')
+        parent_: Tuple[str, ...] = self._resolve('/'.join(parts_[:-1]))
+        self._directory_cluster(parent_)
+        if self.exists('/'.join(parent_ + (parts_[-1],))):
+            raise FileExistsError(f'File exists: {path}')
+        return parent_, parts_[-1]
+
+    @staticmethod
+    def _timestamp_fields(timestamp: datetime) -> Dict[str, int]:
+        date_: int = build_date_entry(timestamp.year, timestamp.month, timestamp.day)
+        time_: int = build_time_entry(timestamp.hour, timestamp.minute, timestamp.second)
+        return dict(DIR_CrtDate=date_, DIR_LstAccDate=date_, DIR_WrtDate=date_, DIR_CrtTime=time_, DIR_WrtTime=time_)
+
+    def add_file(self, path: str, content: bytes, timestamp: datetime = FATFS_INCEPTION) -> None:
+        """
+        Creates the file with the content, the parent directory must exist.
+        """
+        parent_, name_ = self._new_object_path(path)
+        first_cluster_: int = self._resize_chain(0, required_clusters_count_for_size(
+            self.boot_sector_state.sector_size, len(content)))
+        self._write_content(first_cluster_, content)
+        try:
+            self._add_entries(parent_, name_,
+                              DIR_Attr=Entry.ATTR_ARCHIVE,
+                              DIR_FstClusLO=first_cluster_,
+                              DIR_FileSize=len(content),
+                              **self._timestamp_fields(timestamp))
+        except Exception:
+            if first_cluster_:
+                self._mark_fat_dirty(self.fat.free_chain(first_cluster_))
+            raise
+
+    def replace_file(self, path: str, content: bytes, timestamp: Optional[datetime] = None) -> None:
+        """
+        Replaces the content of the existing file, its clusters are reused as far as possible.
+
+        :param timestamp: new modification time, the original one is kept if None
+        """
+        parts_: Tuple[str, ...] = self._resolve(path)
+        stat_: FATStat = self.stat(path)
+        if stat_.is_dir:
+            raise IsADirectoryError(f'Is a directory: {path}')
+        first_cluster_: int = self._resize_chain(stat_.first_cluster, required_clusters_count_for_size(
+            self.boot_sector_state.sector_size, len(content)))
+        self._write_content(first_cluster_, content)
+        entry_address_: int = self._short_entry_address(parts_)
+        fields_: Dict[str, Any] = Entry.ENTRY_CODEC.parse(
+            self._image[entry_address_: entry_address_ + FATDefaults.ENTRY_SIZE])
+        fields_.update(DIR_FstClusLO=first_cluster_, DIR_FileSize=len(content))
+        if timestamp is not None:
+            fields_.update(self._timestamp_fields(timestamp))
+        self._write(entry_address_, Entry.ENTRY_CODEC.build(fields_))
+        self._invalidate(parts_[:-1])
+
+    def mkdir(self, path: str, timestamp: datetime = FATFS_INCEPTION) -> None:
+        """
+        Creates the directory, the parent directory must exist.
+        """
+        parent_, name_ = self._new_object_path(path)
+        first_cluster_: int = self._resize_chain(0, 1)
+        try:
+            # the link to the root directory refers to its cluster the same way as in the generated images
+            parent_cluster_: int = self._directory_cluster(parent_) or Cluster.ROOT_BLOCK_ID
+            for i, (name_link_, cluster_id_) in enumerate(((Directory.CURRENT_DIRECTORY, first_cluster_),
+                                                          (Directory.PARENT_DIRECTORY, parent_cluster_))):
+                self._write(self._slot_address(first_cluster_, i),
+                            Entry._build_entry(DIR_Name=pad_string(name_link_, size=MAX_NAME_SIZE),
+                                               DIR_Name_ext=pad_string('', size=MAX_EXT_SIZE),
+                                               DIR_Attr=Entry.ATTR_DIRECTORY,
+                                               DIR_NTRes=0x00,
+                                               DIR_FstClusLO=cluster_id_,
+                                               DIR_FileSize=0,
+                                               **self._timestamp_fields(timestamp)))
+            self._add_entries(parent_, name_,
+                              DIR_Attr=Entry.ATTR_DIRECTORY,
+                              DIR_FstClusLO=first_cluster_,
+                              DIR_FileSize=0,
+                              **self._timestamp_fields(timestamp))
+        except Exception:
+            self._mark_fat_dirty(self.fat.free_chain(first_cluster_))
+            raise
+
+    def delete(self, path: str) -> None:
+        """
+        Deletes the file or the empty directory, its entries are marked as deleted and its clusters are freed.
+        """
+        parts_: Tuple[str, ...] = self._resolve(path)
+        if not parts_:
+            raise PermissionError('The root directory cannot be deleted')
+        stat_: FATStat = self._lookup(parts_)
+        if stat_.is_dir and self._listing(parts_):
+            raise OSError(errno.ENOTEMPTY, 'Directory not empty', path)
+        self._remove_entries(parts_)
+        if stat_.first_cluster:
+            self._mark_fat_dirty(self.fat.free_chain(stat_.first_cluster))
+        self._invalidate(parts_, recursive=True)
+
+    def rename(self, source: str, destination: str) -> None:
+        """
+        Renames or moves the file or directory, the content stays in its clusters.
+        """
+        source_parts_: Tuple[str, ...] = self._resolve(source)
+        if not source_parts_:
+            raise PermissionError('The root directory cannot be renamed')
+        stat_: FATStat = self._lookup(source_parts_)
+        parent_, name_ = self._new_object_path(destination)
+        if stat_.is_dir and parent_[:len(source_parts_)] == source_parts_:
+            raise OSError(errno.EINVAL, 'The directory cannot be moved into itself', destination)
+        entry_address_: int = self._short_entry_address(source_parts_)
+        fields_: Dict[str, Any] = Entry.ENTRY_CODEC.parse(
+            self._image[entry_address_: entry_address_ + FATDefaults.ENTRY_SIZE])
+        for key_ in ('DIR_Name', 'DIR_Name_ext', 'DIR_NTRes', 'DIR_CrtTimeTenth', 'DIR_FstClusHI'):
+            del fields_[key_]
+        # the new entries are written first, the object is not lost if there is no space for them
+        self._add_entries(parent_, name_, **fields_)
+        self._remove_entries(source_parts_)
+        if stat_.is_dir and parent_ != source_parts_[:-1]:
+            link_address_: int = self._slot_address(stat_.first_cluster, 1)
+            link_fields_: Dict[str, Any] = Entry.ENTRY_CODEC.parse(
+                self._image[link_address_: link_address_ + FATDefaults.ENTRY_SIZE])
+            link_fields_['DIR_FstClusLO'] = self._directory_cluster(parent_) or Cluster.ROOT_BLOCK_ID
+            self._write(link_address_, Entry.ENTRY_CODEC.build(link_fields_))
+        self._invalidate(source_parts_, recursive=True)
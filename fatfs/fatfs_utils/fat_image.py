@@ -0,0 +1,335 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import mmap
+import os
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .boot_sector import BootSector
+from .entry import Entry
+from .fat import FAT
+from .fatfs_state import BootSectorState
+from .utils import (FATFS_INCEPTION, FATFS_INCEPTION_YEAR, FATFS_SECONDS_GRANULARITY, FULL_BYTE,
+                    LONG_NAMES_ENCODING, PAD_CHAR, FATDefaults, lfn_checksum)
+
+DELETED_ENTRY_MARK: int = 0xE5
+
+
+class FATStat(NamedTuple):
+    """
+    Metadata of a file or directory in the FAT image.
+    """
+    path: str
+    name: str
+    is_dir: bool
+    size: int
+    first_cluster: int
+    attributes: int
+    mtime: datetime
+
+
+def build_file_name(name1: bytes, name2: bytes, name3: bytes) -> str:
+    full_name_ = name1 + name2 + name3
+    # need to strip empty bytes and null-terminating char ('\x00')
+    return full_name_.rstrip(FULL_BYTE).decode(LONG_NAMES_ENCODING).rstrip('\x00')
+
+
+def decode_datetime(date_: int, time_: int) -> datetime:
+    """
+    Decodes date and time of the directory entry, invalid values are replaced by the FATFS inception.
+    """
+    try:
+        return datetime(FATFS_INCEPTION_YEAR + (date_ >> 9), (date_ >> 5) & 0x0F, date_ & 0x1F,
+                        time_ >> 11, (time_ >> 5) & 0x3F, (time_ & 0x1F) * FATFS_SECONDS_GRANULARITY)
+    except ValueError:
+        return FATFS_INCEPTION
+
+
+def split_path(path: str) -> List[str]:
+    return [part for part in path.replace(os.sep, '/').split('/') if part not in ('', '.')]
+
+
+class FATFile(io.RawIOBase):
+    """
+    Read-only file object over the content of one file in the image, supports `read` and `seek`.
+    The file's clusters are resolved to runs once, reads are served directly from the image.
+    """
+
+    def __init__(self, image: Any, runs: List[Tuple[int, int]], size: int) -> None:
+        super().__init__()
+        self._image = image
+        self._runs = runs
+        # offset of each run within the file, used to locate the run of the current position
+        self._run_offsets: List[int] = []
+        offset_: int = 0
+        for _, length_ in runs:
+            self._run_offsets.append(offset_)
+            offset_ += length_
+        self._size: int = size
+        self._position: int = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position_ = offset
+        elif whence == io.SEEK_CUR:
+            position_ = self._position + offset
+        elif whence == io.SEEK_END:
+            position_ = self._size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if position_ < 0:
+            raise ValueError('Negative seek position')
+        self._position = position_
+        return self._position
+
+    def readinto(self, buffer: Any) -> int:
+        view_ = memoryview(buffer).cast('B')
+        wanted_: int = min(len(view_), self._size - self._position)
+        done_: int = 0
+        while done_ < wanted_:
+            run_index_: int = bisect_right(self._run_offsets, self._position) - 1
+            address_, length_ = self._runs[run_index_]
+            offset_in_run_: int = self._position - self._run_offsets[run_index_]
+            chunk_: int = min(wanted_ - done_, length_ - offset_in_run_)
+            view_[done_: done_ + chunk_] = self._image[address_ + offset_in_run_: address_ + offset_in_run_ + chunk_]
+            done_ += chunk_
+            self._position += chunk_
+        return done_
+
+
+class FATImage:
+    """
+    Random-access read-only view of a FAT image without extracting it.
+
+    The image is accessed in place (e.g. mmap of the image file), directories are parsed only when
+    they are visited for the first time and the result is cached.
+    """
+    MMAP_ACCESS: int = mmap.ACCESS_READ
+
+    def __init__(self, image: Any) -> None:
+        """
+        :param image: plain FAT image (without wear levelling) as bytes-like object or mmap
+        """
+        self._image = image
+        self._mmap: Optional[mmap.mmap] = None
+        boot_sector_ = BootSector()
+        # parse the header only, the parser would copy the whole image otherwise
+        boot_sector_.parse_boot_sector(bytes(image[:BootSector.BOOT_HEADER_SIZE]))
+        boot_sector_.boot_sector_state.binary_image = image
+        self.boot_sector_state: BootSectorState = boot_sector_.boot_sector_state
+        self.fat: FAT = FAT(self.boot_sector_state, init_=False)
+        self._dir_cache: Dict[Tuple[str, ...], Dict[str, FATStat]] = {}
+        # indexes of the first (LFN) and the last (short) entry of the objects in their directories
+        self._entry_slots: Dict[Tuple[str, ...], Tuple[int, int]] = {}
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs: Any) -> 'FATImage':
+        """
+        Opens the image file as mmap, read-only unless the class requires otherwise.
+        """
+        with open(path, 'rb' if cls.MMAP_ACCESS == mmap.ACCESS_READ else 'r+b') as image_file:
+            mapped_ = mmap.mmap(image_file.fileno(), 0, access=cls.MMAP_ACCESS)
+        fat_image_ = cls(mapped_, **kwargs)
+        fat_image_._mmap = mapped_
+        return fat_image_
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self) -> 'FATImage':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    @property
+    def volume_label(self) -> str:
+        return self.boot_sector_state.volume_label.rstrip(chr(PAD_CHAR))
+
+    def _directory_bytes(self, first_cluster: Optional[int]) -> bytes:
+        if first_cluster is None:
+            start_: int = self.boot_sector_state.root_directory_start
+            return self._image[start_: start_ + self.boot_sector_state.root_dir_sectors_cnt
+                               * self.boot_sector_state.sector_size]
+        return self.fat.get_chained_content(first_cluster)
+
+    def _parse_directory(self, parent: Tuple[str, ...], first_cluster: Optional[int]) -> Dict[str, FATStat]:
+        """
+        Parses the entries of the directory, long file names are assembled from the LFN entries
+        preceding the short entry if their checksum matches.
+        """
+        directory_bytes_: bytes = self._directory_bytes(first_cluster)
+        listing_: Dict[str, FATStat] = {}
+        lfn_parts_: Dict[int, bytes] = {}
+        lfn_start_: int = 0
+        usable_size_: int = len(directory_bytes_) - len(directory_bytes_) % FATDefaults.ENTRY_SIZE
+        # the whole directory is unpacked at once, only the LFN entries are sliced from the raw bytes
+        for index_, values_ in enumerate(Entry.ENTRY_CODEC.iter_unpack(directory_bytes_[:usable_size_])):
+            attributes_: int = values_[2]
+            if attributes_ == 0 or values_[0][0] == DELETED_ENTRY_MARK:
+                lfn_parts_ = {}
+                continue
+            if attributes_ == Entry.ATTR_LONG_NAME:
+                if not lfn_parts_:
+                    lfn_start_ = index_
+                position_: int = index_ * FATDefaults.ENTRY_SIZE
+                order_: int = values_[0][0]
+                lfn_parts_[order_ & ~Entry.LAST_RECORD_LFN_ENTRY] = directory_bytes_[
+                    position_: position_ + FATDefaults.ENTRY_SIZE]
+                continue
+            if attributes_ & Entry.ATTR_VOLUME_ID:
+                lfn_parts_ = {}
+                continue
+            obj_: Optional[dict] = Entry.ENTRY_CODEC.decode(values_)
+            if obj_ is None:
+                lfn_parts_ = {}
+                continue
+            name_: str = self._entry_name(obj_, lfn_parts_)
+            if name_ in ('.', '..'):
+                lfn_parts_ = {}
+                continue
+            self._entry_slots[parent + (name_,)] = (lfn_start_ if lfn_parts_ else index_, index_)
+            lfn_parts_ = {}
+            is_dir_: bool = bool(attributes_ & Entry.ATTR_DIRECTORY)
+            listing_[name_] = FATStat(path='/'.join(parent + (name_,)),
+                                      name=name_,
+                                      is_dir=is_dir_,
+                                      size=0 if is_dir_ else obj_['DIR_FileSize'],
+                                      first_cluster=Entry.get_cluster_id(obj_),
+                                      attributes=attributes_,
+                                      mtime=decode_datetime(obj_['DIR_WrtDate'], obj_['DIR_WrtTime']))
+        return listing_
+
+    @staticmethod
+    def _entry_name(obj_: dict, lfn_parts_: Dict[int, bytes]) -> str:
+        obj_ext_: str = obj_['DIR_Name_ext'].rstrip(chr(PAD_CHAR))
+        short_name_: str = obj_['DIR_Name'].rstrip(chr(PAD_CHAR)) + (f'.{obj_ext_}' if obj_ext_ else '')
+        if not lfn_parts_ or obj_['DIR_NTRes'] == Entry.LDIR_DIR_NTRES:
+            return short_name_
+        checksum_: int = lfn_checksum(obj_['DIR_Name'] + obj_['DIR_Name_ext'])
+        full_name_: List[str] = []
+        for order_ in sorted(lfn_parts_):
+            struct_: dict = Entry.parse_entry_long(lfn_parts_[order_], checksum_)
+            if not struct_:
+                return short_name_
+            full_name_.append(build_file_name(struct_['name1'], struct_['name2'], struct_['name3']))
+        return ''.join(full_name_) or short_name_
+
+    def _listing(self, parts: Tuple[str, ...]) -> Dict[str, FATStat]:
+        if parts not in self._dir_cache:
+            if not parts:
+                self._dir_cache[parts] = self._parse_directory(parts, None)
+            else:
+                stat_: FATStat = self._lookup(parts)
+                if not stat_.is_dir:
+                    raise NotADirectoryError(f'Not a directory: {"/".join(parts)}')
+                self._dir_cache[parts] = self._parse_directory(parts, stat_.first_cluster)
+        return self._dir_cache[parts]
+
+    def _lookup(self, parts: Tuple[str, ...]) -> FATStat:
+        listing_: Dict[str, FATStat] = self._listing(parts[:-1])
+        stat_: Optional[FATStat] = listing_.get(parts[-1])
+        if stat_ is None:
+            # FAT names are case insensitive
+            wanted_: str = parts[-1].upper()
+            stat_ = next((item for name, item in listing_.items() if name.upper() == wanted_), None)
+        if stat_ is None:
+            raise FileNotFoundError(f'No such file or directory: {"/".join(parts)}')
+        return stat_
+
+    def _resolve(self, path: str) -> Tuple[str, ...]:
+        """
+        Translates the path to the tuple of the actual names (the cache key).
+        """
+        resolved_: Tuple[str, ...] = ()
+        for part_ in split_path(path):
+            resolved_ += (self._lookup(resolved_ + (part_,)).name,)
+        return resolved_
+
+    def stat(self, path: str) -> FATStat:
+        parts_: Tuple[str, ...] = self._resolve(path)
+        if not parts_:
+            return FATStat(path='', name='', is_dir=True, size=0, first_cluster=0,
+                           attributes=Entry.ATTR_DIRECTORY, mtime=FATFS_INCEPTION)
+        return self._lookup(parts_)
+
+    def exists(self, path: str) -> bool:
+        try:
+            self.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def listdir(self, path: str = '') -> List[str]:
+        return list(self._listing(self._resolve(path)))
+
+    def scandir(self, path: str = '') -> List[FATStat]:
+        return list(self._listing(self._resolve(path)).values())
+
+    def walk(self, top: str = '') -> Iterator[Tuple[str, List[str], List[str]]]:
+        """
+        Generates the directory tree like `os.walk` (top-down), paths are separated by '/'.
+        """
+        parts_: Tuple[str, ...] = self._resolve(top)
+        stack_: List[Tuple[str, ...]] = [parts_]
+        while stack_:
+            current_: Tuple[str, ...] = stack_.pop()
+            listing_: Dict[str, FATStat] = self._listing(current_)
+            dirs_: List[str] = [name for name, item in listing_.items() if item.is_dir]
+            files_: List[str] = [name for name, item in listing_.items() if not item.is_dir]
+            yield '/'.join(current_), dirs_, files_
+            stack_.extend(current_ + (name,) for name in reversed(dirs_))
+
+    def open(self, path: str) -> FATFile:
+        stat_: FATStat = self.stat(path)
+        if stat_.is_dir:
+            raise IsADirectoryError(f'Is a directory: {path}')
+        runs_: List[Tuple[int, int]] = self.fat.get_chain_runs(stat_.first_cluster, stat_.size) if stat_.size else []
+        return FATFile(self._image, runs_, stat_.size)
+
+    def read_file(self, path: str) -> bytes:
+        with self.open(path) as file_:
+            content_: bytes = file_.read()
+        return content_
+
+    def extract(self, output_directory: str, jobs: Optional[int] = None) -> None:
+        """
+        Extracts the whole image into the output directory. The directory tree is created first,
+        the files are then written in parallel by a thread pool, straight from the image.
+
+        :param output_directory: the directory to extract to, it is created and must not exist
+        :param jobs: number of threads, None for the default of `ThreadPoolExecutor`
+        """
+        os.makedirs(output_directory)
+        files_: List[Tuple[str, FATStat]] = []
+        for dir_path_, dir_names_, file_names_ in self.walk():
+            for dir_name_ in dir_names_:
+                os.makedirs(os.path.join(output_directory, *split_path(dir_path_), dir_name_))
+            listing_: Dict[str, FATStat] = self._listing(tuple(split_path(dir_path_)))
+            files_ += [(os.path.join(output_directory, *split_path(dir_path_), name), listing_[name])
+                       for name in file_names_]
+
+        def _write_file(item: Tuple[str, FATStat]) -> None:
+            target_path_, stat_ = item
+            with open(target_path_, 'wb') as target_:
+                if stat_.size > 0:
+                    self.fat.write_chained_content(target_, stat_.first_cluster, stat_.size)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # consume the results to propagate exceptions
+            list(executor.map(_write_file, files_))
@@ -3,9 +3,10 @@
 
 import os
 from datetime import datetime
-from typing import List, Optional, Tuple, Union
+from collections import Counter
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
 
-from .entry import Entry
+from .entry import Entry, EntryTable
 from .exceptions import FatalError, WriteDirectoryException
 from .fat import FAT, Cluster
 from .fatfs_state import FATFSState
@@ -14,7 +15,7 @@ from .long_filename_utils import (build_lfn_full_name, build_lfn_unique_entry_na
                                   split_name_to_lfn_entry_blocks)
 from .utils import (DATETIME, INVALID_SFN_CHARS_PATTERN, MAX_EXT_SIZE, MAX_NAME_SIZE, FATDefaults,
                     build_lfn_short_entry_name, build_name, lfn_checksum, required_clusters_count,
-                    split_content_into_sectors, split_to_name_and_extension)
+                    required_clusters_count_for_size, split_content_into_sectors, split_to_name_and_extension)
 
 
 class File:
@@ -62,6 +63,29 @@ class File:
             self.fatfs_state.binary_image[address: address + len(content_part)] = content_as_list
             current_cluster = current_cluster.next_cluster
 
+    def write_from_file(self, source: BinaryIO, size: int, chunk_size: int = 0x10000) -> None:
+        """
+        Copies `size` bytes of the source file into the clusters of the file chunk by chunk,
+        the data are read directly into the binary image (e.g. mmap of the output file).
+        """
+        self.entry.update_content_size(size)
+        if size == 0:
+            return
+        # we assume that the correct amount of clusters is allocated
+        if self._first_cluster is None:
+            raise FatalError('No free space left!')
+        runs_: List[Tuple[int, int]] = self.fat.get_chain_runs(self._first_cluster.id, size)
+        if sum(length_ for _, length_ in runs_) < size:
+            raise FatalError('No free space left!')
+        with memoryview(self.fatfs_state.binary_image) as image_view_:
+            for address_, length_ in runs_:
+                end_: int = address_ + length_
+                while address_ < end_:
+                    read_: int = source.readinto(image_view_[address_: min(end_, address_ + chunk_size)])
+                    if not read_:
+                        raise FatalError('The source file is shorter than its expected size!')
+                    address_ += read_
+
 
 class Directory:
     """
@@ -97,8 +121,17 @@ class Directory:
         self._first_cluster: Cluster = cluster
 
         # entries will be initialized after the cluster allocation
-        self.entries: List[Entry] = []
+        self.entries: EntryTable = EntryTable(fatfs_state)
         self.entities: List[Union[File, Directory]] = []  # type: ignore
+        # entities by their full name and the number of entities sharing the 6 characters prefix of the name,
+        # both are maintained by `add_entity`
+        self._entities_index: Dict[str, Union[File, Directory]] = {}  # type: ignore
+        self.prefix_counter: Counter = Counter()
+        # entries preceding the cursor are not empty, allocated entries are never freed
+        self._free_entry_cursor: int = 0
+        # directories by their path, used by the root directory to resolve `path_from_root`,
+        # it is populated when the directories are created
+        self._directories_cache: Dict[Tuple[str, ...], Directory] = {}
         self._entry = entry  # currently not in use (will use later for e.g. modification time, etc.)
 
     @property
@@ -122,11 +155,10 @@ class Directory:
         entries_count_: int = self.size // FATDefaults.ENTRY_SIZE
         return entries_count_
 
-    def create_entries(self, cluster: Cluster) -> List[Entry]:
-        return [Entry(entry_id=i,
-                      parent_dir_entries_address=cluster.cluster_data_address,
-                      fatfs_state=self.fatfs_state)
-                for i in range(self.entries_count)]
+    def create_entries(self, cluster: Cluster) -> EntryTable:
+        entries_: EntryTable = EntryTable(self.fatfs_state)
+        entries_.add_block(cluster.cluster_data_address, self.entries_count)
+        return entries_
 
     def init_directory(self) -> None:
         self.entries = self.create_entries(self._first_cluster)
@@ -142,11 +174,15 @@ class Directory:
                                     entity_extension='',
                                     entity_type=dir_id.ENTITY_TYPE)
 
+    def add_entity(self, entity):
+        # type: (Union[File, Directory]) -> None
+        self.entities.append(entity)
+        # the first entity of the name is the one found, the same as by the scan of the entities
+        self._entities_index.setdefault(build_name(entity.name, entity.extension), entity)
+        self.prefix_counter[entity.name[:6]] += 1
+
     def lookup_entity(self, object_name: str, extension: str):  # type: ignore
-        for entity in self.entities:
-            if build_name(entity.name, entity.extension) == build_name(object_name, extension):
-                return entity
-        return None
+        return self._entities_index.get(build_name(object_name, extension))
 
     @staticmethod
     def _is_end_of_path(path_as_list: List[str]) -> bool:
@@ -168,21 +204,46 @@ class Directory:
             return next_obj
         return self.recursive_search(path_as_list[1:], next_obj)
 
+    def search_directory(self, path_as_list: List[str]) -> 'Directory':
+        """
+        Same as `recursive_search` from this directory, but the directories found are cached by the path.
+        """
+        key_: Tuple[str, ...] = tuple(path_as_list)
+        directory_: Optional[Directory] = self._directories_cache.get(key_)
+        if directory_ is None:
+            directory_ = self.recursive_search(path_as_list, self)
+            if isinstance(directory_, Directory):
+                self._directories_cache[key_] = directory_
+        return directory_
+
+    def search_entity(self, path_as_list: List[str]):  # type: ignore
+        """
+        Finds the file or directory, its parent directory is resolved using `search_directory`.
+        """
+        parent_: Directory = self.search_directory(path_as_list[:-1]) if len(path_as_list) > 1 else self
+        entity_ = parent_.lookup_entity(*split_to_name_and_extension(path_as_list[-1]))
+        if entity_ is None:
+            raise FileNotFoundError('No such file or directory!')
+        return entity_
+
     def find_free_entry(self) -> Optional[Entry]:
-        for entry in self.entries:
-            if entry.is_empty:
-                return entry
-        return None
+        entry_id_: Optional[int] = self.entries.find_free_entry_id(self._free_entry_cursor)
+        if entry_id_ is None:
+            self._free_entry_cursor = len(self.entries)
+            return None
+        self._free_entry_cursor = entry_id_
+        return self.entries[entry_id_]
 
     def _extend_directory(self) -> None:
         current: Cluster = self.first_cluster
         while current.next_cluster is not None:
             current = current.next_cluster
-        new_cluster: Cluster = self.fat.find_free_cluster()
+        # the clusters planned for the object being created are not used for its parent directory
+        new_cluster: Cluster = self.fat.find_free_cluster(planned=False)
         current.set_in_fat(new_cluster.id)
         assert current is not new_cluster
         current.next_cluster = new_cluster
-        self.entries += self.create_entries(new_cluster)
+        self.entries.add_block(new_cluster.cluster_data_address, self.entries_count)
 
     def chain_directory(self) -> Entry:
         """
@@ -207,7 +268,8 @@ class Directory:
                                   time):
         # type: (Entry, str, str, Directory, int, int, DATETIME, DATETIME) -> Entry
         lfn_full_name: str = build_lfn_full_name(name, extension)
-        lfn_unique_entry_order: int = build_lfn_unique_entry_name_order(target_dir.entities, name)
+        lfn_unique_entry_order: int = build_lfn_unique_entry_name_order(target_dir.entities, name,
+                                                                        target_dir.prefix_counter)
         lfn_short_entry_name: str = build_lfn_short_entry_name(name, extension, lfn_unique_entry_order)
         checksum: int = lfn_checksum(lfn_short_entry_name)
         entries_count: int = get_required_lfn_entries_count(lfn_full_name)
@@ -263,7 +325,7 @@ class Directory:
             free_cluster = self.fat.find_free_cluster()
             free_cluster_id = free_cluster.id
 
-        target_dir: Directory = self if not path_from_root else self.recursive_search(path_from_root, self)
+        target_dir: Directory = self if not path_from_root else self.search_directory(path_from_root)
         free_entry: Entry = target_dir.find_free_entry() or target_dir.chain_directory()
 
         fatfs_date_ = (object_timestamp_.year, object_timestamp_.month, object_timestamp_.day)
@@ -306,7 +368,7 @@ class Directory:
                           fatfs_state=self.fatfs_state,
                           entry=free_entry)
         file.first_cluster = free_cluster
-        target_dir.entities.append(file)
+        target_dir.add_entity(file)
 
     def new_directory(self, name, parent, path_from_root, object_timestamp_):
         # type: (str, Directory, Optional[List[str]], datetime) -> None
@@ -322,7 +384,8 @@ class Directory:
                                          entry=free_entry)
         directory.first_cluster = free_cluster
         directory.init_directory()
-        target_dir.entities.append(directory)
+        target_dir.add_entity(directory)
+        self._directories_cache.setdefault(tuple(path_from_root or []) + (name,), directory)
 
     def write_to_file(self, path: List[str], content: bytes) -> None:
         """
@@ -333,7 +396,7 @@ class Directory:
         :returns: None
         :raises WriteDirectoryException: raised is the target object for writing is a directory
         """
-        entity_to_write: Entry = self.recursive_search(path, self)
+        entity_to_write: Entry = self.search_entity(path)
         if isinstance(entity_to_write, File):
             clusters_cnt: int = required_clusters_count(cluster_size=self.fatfs_state.boot_sector_state.sector_size,
                                                         content=content)
@@ -341,3 +404,20 @@ class Directory:
             entity_to_write.write(content)
         else:
             raise WriteDirectoryException(f'`{os.path.join(*path)}` is a directory!')
+
+    def write_file_from_source(self, path: List[str], source: BinaryIO, size: int) -> None:
+        """
+        Same as `write_to_file`, but the content is copied from the source file of the known size in chunks.
+
+        :param path: path split into the list
+        :param source: file object opened for reading in the binary mode
+        :param size: number of bytes to copy from the source
+        :raises WriteDirectoryException: raised is the target object for writing is a directory
+        """
+        entity_to_write: Entry = self.search_entity(path)
+        if isinstance(entity_to_write, File):
+            clusters_cnt: int = required_clusters_count_for_size(self.fatfs_state.boot_sector_state.sector_size, size)
+            self.fat.allocate_chain(entity_to_write.first_cluster, clusters_cnt)
+            entity_to_write.write_from_file(source, size)
+        else:
+            raise WriteDirectoryException(f'`{os.path.join(*path)}` is a directory!')
@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import math
+from typing import List, NamedTuple, Optional
+
+from .exceptions import NoFreeClusterException
+from .partition_plan import PartitionGeometry, PartitionPlan
+from .utils import ALLOWED_SECTOR_SIZES, FAT12, FATDefaults
+
+
+class GeometryCandidate(NamedTuple):
+    geometry: PartitionGeometry
+    # the sectors differing from the erased flash, the data region of the empty image is erased (0xFF),
+    # the boot sector, the FAT and the root directory are not
+    non_blank_sectors: int
+    flash_bytes: int
+    # unused bytes in the last clusters of the objects
+    slack_bytes: int
+    free_bytes: int
+
+
+def root_entry_counts(root_entries: int, sector_size: int) -> List[int]:
+    """
+    The sizes of the root directory worth trying: the smallest one for the entries of the plan
+    and the default one if it is larger. The root directory must occupy an even number of sectors.
+    """
+    entries_per_sector_: int = sector_size // FATDefaults.ENTRY_SIZE
+    sectors_: int = max(2, math.ceil(root_entries / entries_per_sector_))
+    sectors_ += sectors_ % 2
+    counts_: List[int] = [sectors_ * entries_per_sector_]
+    if FATDefaults.ROOT_ENTRIES_COUNT > counts_[0]:
+        counts_.append(FATDefaults.ROOT_ENTRIES_COUNT)
+    return counts_
+
+
+def evaluate_candidate(plan: PartitionPlan,
+                       sector_size: int,
+                       root_entry_count: int,
+                       partition_size: Optional[int] = None) -> GeometryCandidate:
+    geometry_: PartitionGeometry = plan.geometry(root_entry_count=root_entry_count,
+                                                 sector_size=sector_size,
+                                                 partition_size=partition_size)
+    non_blank_sectors_: int = (FATDefaults.RESERVED_SECTORS_COUNT
+                               + geometry_.fat_sectors
+                               + geometry_.root_dir_sectors
+                               + geometry_.used_clusters)
+    return GeometryCandidate(geometry=geometry_,
+                             non_blank_sectors=non_blank_sectors_,
+                             flash_bytes=non_blank_sectors_ * sector_size,
+                             slack_bytes=geometry_.used_clusters * sector_size - plan.content_size,
+                             free_bytes=(geometry_.data_clusters - geometry_.used_clusters) * sector_size)
+
+
+def optimize_geometry(plan: PartitionPlan,
+                      partition_size: Optional[int] = None,
+                      sector_sizes: Optional[List[int]] = None) -> List[GeometryCandidate]:
+    """
+    Evaluates the geometries for the plan, the clusters are of the sector size in the generated images,
+    so the sector size and the size of the root directory are the parameters chosen. The FAT type follows
+    from the number of clusters, the geometries requiring FAT32 are skipped as it is not supported.
+
+    :param partition_size: if defined, the candidates are ranked by the free space of the partition of this size,
+        otherwise by the size of the minimal image
+    :returns: the candidates which fit, the best one first; the flash bytes break the ties
+    """
+    candidates_: List[GeometryCandidate] = []
+    for sector_size_ in sector_sizes or ALLOWED_SECTOR_SIZES:
+        for root_entry_count_ in root_entry_counts(plan.root_entries, sector_size_):
+            try:
+                candidates_.append(evaluate_candidate(plan, sector_size_, root_entry_count_, partition_size))
+            except (NoFreeClusterException, NotImplementedError):
+                continue
+    if partition_size is not None:
+        candidates_.sort(key=lambda candidate: (-candidate.free_bytes, candidate.flash_bytes))
+    else:
+        candidates_.sort(key=lambda candidate: (candidate.geometry.size, candidate.flash_bytes))
+    return candidates_
+
+
+def format_candidates(candidates: List[GeometryCandidate]) -> str:
+    header_: str = f'{"sector":>7} {"root":>6} {"FAT":>5} {"clusters":>9} {"image":>11} ' \
+                   f'{"flash":>11} {"non-blank":>10} {"slack":>10} {"free":>11}'
+    lines_: List[str] = [header_]
+    for candidate_ in candidates:
+        geometry_: PartitionGeometry = candidate_.geometry
+        fatfs_type_: str = 'FAT12' if geometry_.fatfs_type == FAT12 else 'FAT16'
+        lines_.append(f'{geometry_.sector_size:>7} {geometry_.root_entry_count:>6} {fatfs_type_:>5} '
+                      f'{geometry_.data_clusters:>9} {geometry_.size:>11} {candidate_.flash_bytes:>11} '
+                      f'{candidate_.non_blank_sectors:>10} {candidate_.slack_bytes:>10} {candidate_.free_bytes:>11}')
+    return '\n'.join(lines_)
@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+from bisect import bisect_right
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+
+class ImageView:
+    """
+    Read-only view of the binary image assembled from byte ranges (extents) of the source buffer.
+
+    Slicing the view with `view()` and concatenating views with `+` only rearranges the extents,
+    hence transformations of the image (e.g. removing the wear levelling layer) do not copy the data.
+    Indexing and slicing with `[]` returns `bytes` the same way as slicing of mmap does.
+    """
+
+    def __init__(self, source: Any, extents: Optional[List[Tuple[int, int]]] = None) -> None:
+        """
+        :param source: bytes-like object or mmap the view refers to
+        :param extents: list of (offset in the source, length) pairs, the whole source if not defined
+        """
+        self.source = source
+        self._extents: List[Tuple[int, int]] = []
+        # offsets of the extents within the view, used to locate the extent of the position
+        self._offsets: List[int] = []
+        self._size: int = 0
+        for offset_, length_ in [(0, len(source))] if extents is None else extents:
+            if length_ <= 0:
+                continue
+            if self._extents and sum(self._extents[-1]) == offset_:
+                # adjacent ranges of the source are merged
+                self._extents[-1] = (self._extents[-1][0], self._extents[-1][1] + length_)
+            else:
+                self._extents.append((offset_, length_))
+                self._offsets.append(self._size)
+            self._size += length_
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def extents(self) -> List[Tuple[int, int]]:
+        return list(self._extents)
+
+    def _iter_extents(self, start: int, stop: int) -> Iterator[Tuple[int, int]]:
+        position_: int = start
+        while position_ < stop:
+            index_: int = bisect_right(self._offsets, position_) - 1
+            offset_, length_ = self._extents[index_]
+            offset_in_extent_: int = position_ - self._offsets[index_]
+            chunk_: int = min(stop - position_, length_ - offset_in_extent_)
+            yield offset_ + offset_in_extent_, chunk_
+            position_ += chunk_
+
+    def view(self, start: Optional[int] = None, stop: Optional[int] = None) -> 'ImageView':
+        """
+        Returns the view of the range, `start` and `stop` have the same meaning as in the slice notation.
+        """
+        start_, stop_, _ = slice(start, stop).indices(self._size)
+        return ImageView(self.source, list(self._iter_extents(start_, stop_)))
+
+    def iter_slices(self, start: int, stop: int) -> Iterator[memoryview]:
+        """
+        Yields the content of the range as memoryviews of the source, one per extent.
+        """
+        source_view_: memoryview = memoryview(self.source)
+        for offset_, length_ in self._iter_extents(start, min(stop, self._size)):
+            yield source_view_[offset_: offset_ + length_]
+
+    def __add__(self, other: 'ImageView') -> 'ImageView':
+        if other.source is not self.source:
+            raise ValueError('Only views of the same source can be concatenated!')
+        return ImageView(self.source, self._extents + other._extents)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[int, bytes]:
+        if isinstance(key, int):
+            if key < 0:
+                key += self._size
+            if not 0 <= key < self._size:
+                raise IndexError('ImageView index out of range')
+            offset_, _ = next(self._iter_extents(key, key + 1))
+            source_value_: int = self.source[offset_]
+            return source_value_
+        start_, stop_, step_ = key.indices(self._size)
+        if step_ != 1:
+            raise ValueError('ImageView supports only contiguous slices!')
+        return b''.join(self.iter_slices(start_, stop_))
+
+    def __bytes__(self) -> bytes:
+        return self[:]  # type: ignore
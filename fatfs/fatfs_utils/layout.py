@@ -0,0 +1,169 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .fat import FAT
+from .fat_image import FATImage, FATStat
+
+# the extent of the object: the first cluster and the number of clusters
+EXTENT = Tuple[int, int]
+
+
+class StableLayout:
+    """
+    Placement of the files and directories in the data region kept stable across the builds.
+
+    Every object gets an extent of consecutive clusters, its content followed by the slack reserved for its growth.
+    The extents of the previous build (taken from its image or layout manifest) are kept for the objects which still
+    fit them and the new objects are placed to the free space around them. The clusters of the unchanged files thus
+    stay at the same addresses and the consecutive images differ only in the sectors of the changed objects.
+    """
+    MANIFEST_VERSION: int = 1
+    # the volume ID of the images built without the previous build
+    DEFAULT_VOLUME_ID: int = 0
+
+    def __init__(self,
+                 extents: Optional[Dict[str, EXTENT]] = None,
+                 slack: float = 0.0,
+                 volume_uuid: int = DEFAULT_VOLUME_ID,
+                 cluster_size: Optional[int] = None) -> None:
+        """
+        :param extents: extents of the previous build by the paths of the objects (see `key`)
+        :param slack: size of the slack reserved for the growth of the newly placed files
+            as a fraction of their size, e.g. 0.1 for 10 %
+        :param volume_uuid: the volume ID written to the boot sector
+        :param cluster_size: cluster size of the previous build, the extents are dropped if it differs
+        """
+        self.extents: Dict[str, EXTENT] = dict(extents or {})
+        self.slack: float = slack
+        self.volume_uuid: int = volume_uuid
+        self.cluster_size: Optional[int] = cluster_size
+        # extents of the objects placed in this build
+        self.placed: Dict[str, EXTENT] = {}
+
+    @staticmethod
+    def key(path_as_list: List[str]) -> str:
+        """
+        The objects are identified by their path from the root, FAT names are case insensitive.
+        """
+        return '/'.join(path_as_list).upper()
+
+    @classmethod
+    def from_manifest(cls, path: str, slack: float = 0.0) -> 'StableLayout':
+        with open(path) as manifest_file:
+            manifest_: Dict[str, Any] = json.load(manifest_file)
+        if manifest_.get('version') != cls.MANIFEST_VERSION:
+            raise ValueError(f'Unsupported version of the layout manifest: {manifest_.get("version")}')
+        return cls(extents={key_: (first_, count_) for key_, (first_, count_) in manifest_['extents'].items()},
+                   slack=slack,
+                   volume_uuid=manifest_['volume_id'],
+                   cluster_size=manifest_['cluster_size'])
+
+    @classmethod
+    def from_image(cls, path: str, slack: float = 0.0) -> 'StableLayout':
+        """
+        Takes the extents from the plain FAT image of the previous build. Every object with the consecutive chain
+        of clusters gets the extent over its chain and the free clusters following it (the slack of the previous
+        build) up to `slack`, the objects with fragmented chains are placed again.
+        """
+        extents_: Dict[str, EXTENT] = {}
+        # the image is read as a whole here, it may be overwritten by the new build
+        with FATImage.from_file(path) as image_:
+            stack_: List[str] = ['']
+            while stack_:
+                directory_: str = stack_.pop()
+                for stat_ in image_.scandir(directory_):  # type: FATStat
+                    if stat_.is_dir:
+                        stack_.append(stat_.path)
+                    if not stat_.first_cluster:
+                        continue
+                    chain_: List[int] = image_.fat.get_cluster_chain(stat_.first_cluster)
+                    if chain_ != list(range(chain_[0], chain_[0] + len(chain_))):
+                        continue
+                    # the free clusters following the chain are taken as its slack up to the current ratio
+                    end_: int = chain_[-1] + 1
+                    slack_end_: int = min(end_ + math.ceil(len(chain_) * slack), len(image_.fat.table))
+                    while end_ < slack_end_ and image_.fat.table[end_] == 0:
+                        end_ += 1
+                    extents_[cls.key(stat_.path.split('/'))] = (chain_[0], end_ - chain_[0])
+            return cls(extents=extents_,
+                       slack=slack,
+                       volume_uuid=image_.boot_sector_state.volume_uuid,
+                       cluster_size=image_.boot_sector_state.sector_size)
+
+    @classmethod
+    def load(cls, path: str, slack: float = 0.0) -> 'StableLayout':
+        """
+        Loads the layout manifest (the file with the extension .json) or the image of the previous build.
+        """
+        if path.lower().endswith('.json'):
+            return cls.from_manifest(path, slack)
+        return cls.from_image(path, slack)
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {
+            'version': self.MANIFEST_VERSION,
+            'volume_id': self.volume_uuid,
+            'cluster_size': self.cluster_size,
+            'extents': {key_: list(extent_) for key_, extent_ in sorted(self.placed.items())},
+        }
+
+    def write_manifest(self, path: str) -> None:
+        with open(path, 'w') as manifest_file:
+            json.dump(self.to_manifest(), manifest_file, indent=1)
+            manifest_file.write('\n')
+
+    def retain(self, keys: Iterable[str]) -> None:
+        """
+        Drops the extents of the objects which are not part of the new build, their space is free for the new objects.
+        """
+        keys_ = set(keys)
+        self.extents = {key_: extent_ for key_, extent_ in self.extents.items() if key_ in keys_}
+
+    def reserve(self, fat: FAT) -> None:
+        """
+        Excludes the extents of the previous build from the allocation of the clusters of the new objects.
+        """
+        if self.cluster_size not in (None, fat.boot_sector_state.sector_size):
+            # the layout of the different geometry is useless
+            self.extents = {}
+        self.cluster_size = fat.boot_sector_state.sector_size
+        self.extents = {key_: (first_, count_) for key_, (first_, count_) in self.extents.items()
+                        if first_ + count_ <= len(fat.table)}
+        for first_, count_ in self.extents.values():
+            fat.reserve_clusters(range(first_, first_ + count_))
+
+    def place(self, fat: FAT, key: str, clusters_cnt: int, slack: bool = True) -> None:
+        """
+        Plans the clusters of the object for its allocation. The object keeps its extent from the previous build
+        if it fits, otherwise it gets the first free extent large enough. If there is none the clusters are not
+        planned and the object is allocated in the first free clusters.
+
+        :param key: the path of the object (see `key`)
+        :param clusters_cnt: the number of clusters of the object
+        :param slack: reserve the slack for the growth of the object (not useful for directories)
+        """
+        if clusters_cnt == 0:
+            return
+        extent_: Optional[EXTENT] = self.extents.pop(key, None)
+        if extent_ is not None:
+            first_, count_ = extent_
+            if clusters_cnt <= count_:
+                fat.plan_allocation(list(range(first_, first_ + clusters_cnt)))
+                self.placed[key] = extent_
+                return
+            # the object outgrew its extent, the extent is free for the others
+            fat.release_clusters(range(first_, first_ + count_))
+        reserved_cnt_: int = clusters_cnt + (math.ceil(clusters_cnt * self.slack) if slack else 0)
+        first_cluster_: Optional[int] = fat.find_free_run(reserved_cnt_)
+        if first_cluster_ is None:
+            reserved_cnt_ = clusters_cnt
+            first_cluster_ = fat.find_free_run(clusters_cnt)
+        if first_cluster_ is None:
+            return
+        fat.reserve_clusters(range(first_cluster_, first_cluster_ + reserved_cnt_))
+        fat.plan_allocation(list(range(first_cluster_, first_cluster_ + clusters_cnt)))
+        self.placed[key] = (first_cluster_, reserved_cnt_)
@@ -0,0 +1,178 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import struct
+import zlib
+from typing import List, Tuple
+
+# the on-disk format of LittleFS v2 (see SPEC.md of littlefs) shared by the generator and the parser
+
+LFS_MAGIC: bytes = b'littlefs'
+# the minor version 0 is mounted by all the releases of littlefs v2
+LFS_DISK_VERSION: int = 0x00020000
+LFS_NAME_MAX: int = 255
+LFS_FILE_MAX: int = 2147483647
+LFS_ATTR_MAX: int = 1022
+LFS_BLOCK_NULL: int = 0xffffffff
+
+# the tags: valid bit (0 for valid), 11-bit type, 10-bit id, 10-bit size
+LFS_TYPE_REG: int = 0x001
+LFS_TYPE_DIR: int = 0x002
+LFS_TYPE_SUPERBLOCK: int = 0x0ff
+LFS_TYPE_NAME: int = 0x000
+LFS_TYPE_STRUCT: int = 0x200
+LFS_TYPE_DIRSTRUCT: int = 0x200
+LFS_TYPE_INLINESTRUCT: int = 0x201
+LFS_TYPE_CTZSTRUCT: int = 0x202
+LFS_TYPE_USERATTR: int = 0x300
+LFS_TYPE_SPLICE: int = 0x400
+LFS_TYPE_CREATE: int = 0x401
+LFS_TYPE_DELETE: int = 0x4ff
+LFS_TYPE_CRC: int = 0x500
+# the CRC of the erased area behind the commit, written by littlefs 2.6 and newer
+LFS_TYPE_FCRC: int = 0x5ff
+LFS_TYPE_TAIL: int = 0x600
+LFS_TYPE_SOFTTAIL: int = 0x600
+LFS_TYPE_HARDTAIL: int = 0x601
+LFS_TYPE_GLOBALS: int = 0x700
+LFS_TYPE_MOVESTATE: int = 0x7ff
+
+LFS_ID_NONE: int = 0x3ff
+LFS_SIZE_DELETED: int = 0x3ff
+# the largest size of the tag's data
+LFS_TAG_SIZE_MAX: int = 0x3fe
+# the entries of one metadata block, the littlefs splits the directory before reaching it
+LFS_ENTRIES_MAX: int = 0xff
+
+TAG_SIZE: int = 4
+SUPERBLOCK_FORMAT: str = '<6I'
+REVISION_FORMAT: str = '<I'
+PAIR_FORMAT: str = '<2I'
+CTZ_FORMAT: str = '<2I'
+# the tag of the pending move (and the orphans count) and the metadata pair of the moved entry
+GSTATE_FORMAT: str = '<3I'
+
+
+def lfs_crc(crc: int, data: bytes) -> int:
+    """
+    CRC-32 of littlefs: the polynomial 0x04c11db7 (reflected) without the final inversion.
+    """
+    return zlib.crc32(data, crc ^ 0xffffffff) ^ 0xffffffff
+
+
+def make_tag(type_: int, id_: int, size: int) -> int:
+    return (type_ << 20) | (id_ << 10) | size
+
+
+def tag_type1(tag: int) -> int:
+    return (tag & 0x70000000) >> 20
+
+
+def tag_type2(tag: int) -> int:
+    return (tag & 0x78000000) >> 20
+
+
+def tag_type3(tag: int) -> int:
+    return (tag & 0x7ff00000) >> 20
+
+
+def tag_chunk(tag: int) -> int:
+    return (tag & 0x0ff00000) >> 20
+
+
+def tag_id(tag: int) -> int:
+    return (tag & 0x000ffc00) >> 10
+
+
+def tag_size(tag: int) -> int:
+    return tag & 0x000003ff
+
+
+def tag_is_valid(tag: int) -> bool:
+    return not tag & 0x80000000
+
+
+def tag_is_delete(tag: int) -> bool:
+    return tag_size(tag) == LFS_SIZE_DELETED
+
+
+def tag_dsize(tag: int) -> int:
+    """
+    The size of the tag with its data, the deleted tags have no data.
+    """
+    return TAG_SIZE + (0 if tag_is_delete(tag) else tag_size(tag))
+
+
+def align_up(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+
+def ctz_pointers_count(index: int) -> int:
+    """
+    The blocks of the files form the CTZ skip-list, the block n > 0 starts with the pointers
+    to the blocks n - 2^i for i in 0..ctz(n).
+    """
+    if index == 0:
+        return 0
+    return (index & -index).bit_length()
+
+
+def ctz_block_capacity(index: int, block_size: int) -> int:
+    return block_size - TAG_SIZE * ctz_pointers_count(index)
+
+
+def ctz_blocks_count(size: int, block_size: int) -> int:
+    blocks_: int = 0
+    while size > 0:
+        size -= ctz_block_capacity(blocks_, block_size)
+        blocks_ += 1
+    return blocks_
+
+
+def ctz_index(offset: int, block_size: int) -> Tuple[int, int]:
+    """
+    The index of the block of the skip-list holding the byte of the file and the offset of the byte in the block,
+    the same computation as `lfs_ctz_index` of littlefs.
+    """
+    b_: int = block_size - 2 * TAG_SIZE
+    i_: int = offset // b_
+    if i_ == 0:
+        return 0, offset
+    i_ = (offset - TAG_SIZE * (bin(i_ - 1).count('1') + 2)) // b_
+    return i_, offset - b_ * i_ - TAG_SIZE * bin(i_).count('1')
+
+
+def build_metadata_block(revision: int,
+                         attributes: List[Tuple[int, bytes]],
+                         block_size: int,
+                         prog_size: int) -> bytearray:
+    """
+    Builds the metadata block with the single compacted commit of the attributes, the rest of the block is erased.
+    The commit is closed by the CRC tags padding it to the program size, as `lfs_dir_commitcrc` does.
+
+    :param attributes: the tags (without the valid bit) and their data
+    """
+    block_: bytearray = bytearray(struct.pack(REVISION_FORMAT, revision))
+    ptag_: int = 0xffffffff
+    for tag_, data_ in attributes:
+        block_ += struct.pack('>I', (tag_ & 0x7fffffff) ^ ptag_) + data_
+        ptag_ = tag_ & 0x7fffffff
+    crc_: int = lfs_crc(0xffffffff, bytes(block_))
+    end_: int = align_up(len(block_) + 2 * TAG_SIZE, prog_size)
+    while len(block_) < end_:
+        offset_: int = len(block_) + TAG_SIZE
+        next_offset_: int = min(end_ - offset_, LFS_TAG_SIZE_MAX) + offset_
+        if next_offset_ < end_:
+            next_offset_ = min(next_offset_, end_ - 2 * TAG_SIZE)
+        # the next program unit is erased, so the valid bit of the next commit is not reset
+        tag_ = make_tag(LFS_TYPE_CRC, LFS_ID_NONE, next_offset_ - offset_)
+        raw_tag_: bytes = struct.pack('>I', tag_ ^ ptag_)
+        crc_ = lfs_crc(crc_, raw_tag_)
+        block_ += raw_tag_ + struct.pack('<I', crc_)
+        # the padding is not covered by the CRC and stays erased
+        block_ += b'\xff' * (next_offset_ - len(block_))
+        ptag_ = tag_
+        crc_ = 0xffffffff
+    if len(block_) > block_size:
+        raise ValueError('The metadata does not fit the block!')
+    return block_ + b'\xff' * (block_size - len(block_))
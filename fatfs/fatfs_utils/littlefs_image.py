@@ -0,0 +1,424 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .fat_image import FATFile, split_path
+from .littlefs_format import (CTZ_FORMAT, GSTATE_FORMAT, LFS_BLOCK_NULL, LFS_ID_NONE, LFS_MAGIC, LFS_TYPE_CREATE,
+                              LFS_TYPE_CRC, LFS_TYPE_CTZSTRUCT, LFS_TYPE_DELETE, LFS_TYPE_DIR, LFS_TYPE_DIRSTRUCT,
+                              LFS_TYPE_GLOBALS, LFS_TYPE_INLINESTRUCT, LFS_TYPE_NAME, LFS_TYPE_REG, LFS_TYPE_SPLICE,
+                              LFS_TYPE_STRUCT, LFS_TYPE_SUPERBLOCK, LFS_TYPE_TAIL, LFS_TYPE_USERATTR, PAIR_FORMAT,
+                              REVISION_FORMAT, SUPERBLOCK_FORMAT, TAG_SIZE, ctz_index, ctz_pointers_count, lfs_crc,
+                              tag_chunk, tag_dsize, tag_id, tag_is_delete, tag_is_valid, tag_size, tag_type1,
+                              tag_type2, tag_type3)
+
+# the block sizes tried when the first block of the superblock pair holds no valid commit
+CANDIDATE_BLOCK_SIZES: Tuple[int, ...] = (512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+ROOT_PAIR: Tuple[int, int] = (0, 1)
+# the tag and the address of its data in the image
+TagRecord = Tuple[int, int]
+
+
+class LittleFSStat(NamedTuple):
+    """
+    Metadata of a file or directory in the LittleFS image.
+    """
+    path: str
+    name: str
+    is_dir: bool
+    size: int
+    # the first metadata pair of the directory
+    pair: Optional[Tuple[int, int]]
+    # the last block of the skip-list of the file stored outside of the metadata, None for the inline files
+    head: Optional[int]
+    # the address of the content of the inline file in the image
+    inline_address: Optional[int]
+
+
+class MetadataPair(NamedTuple):
+    """
+    The state of the metadata pair after replaying its valid commits.
+    """
+    pair: Tuple[int, int]
+    block: int
+    revision: int
+    # the attributes of the entries by their ids: the tag family (or the type of the user attribute) -> the tag
+    entries: List[Dict[int, TagRecord]]
+    tail: Optional[Tuple[int, int]]
+    # the tail is the next pair of the same directory (hard tail)
+    split: bool
+    gstate_delta: Tuple[int, int, int]
+
+
+def revision_newer(revision: int, other: int) -> bool:
+    """
+    Compares the revision counts as littlefs does (`lfs_scmp`), i.e. the overflow of the counter is handled.
+    """
+    difference_: int = (revision - other) & 0xffffffff
+    return 0 < difference_ < 0x80000000
+
+
+def pairs_overlap(pair: Tuple[int, int], other: Tuple[int, int]) -> bool:
+    return bool(set(pair) & set(other))
+
+
+def pair_is_null(pair: Tuple[int, int]) -> bool:
+    return LFS_BLOCK_NULL in pair
+
+
+class LittleFSImage:
+    """
+    Random-access read-only view of a LittleFS v2 image (e.g. mct.bin or the partition dumped from the device)
+    without extracting it.
+
+    The metadata pairs are fetched the same way as by littlefs: the block of the pair with the newer revision
+    is preferred, its commits are replayed up to the last one with the valid CRC (the commit interrupted
+    by the power loss is ignored) and the pending move of the global state hides the moved entry.
+    The directories are parsed only when they are visited for the first time and the result is cached.
+    """
+
+    def __init__(self, image: Any, block_size: Optional[int] = None) -> None:
+        """
+        :param image: LittleFS image as bytes-like object or mmap
+        :param block_size: the size of the erase block, detected from the superblock if not given
+        """
+        self._image = image
+        self._mmap: Optional[mmap.mmap] = None
+        self._pair_cache: Dict[Tuple[int, int], MetadataPair] = {}
+        self._dir_cache: Dict[Tuple[str, ...], Dict[str, LittleFSStat]] = {}
+        self.block_size: int = block_size or self._detect_block_size()
+        self.block_count: int = len(image) // self.block_size
+        superblock_: Optional[Tuple[int, ...]] = self._superblock(self._fetch(ROOT_PAIR, self.block_size))
+        if superblock_ is None:
+            raise ValueError('The image has no LittleFS superblock!')
+        self.disk_version: int = superblock_[0]
+        if superblock_[1] != self.block_size:
+            raise ValueError(f'The superblock declares the block size {superblock_[1]}, not {self.block_size}!')
+        if superblock_[2] > self.block_count:
+            raise ValueError(f'The superblock declares {superblock_[2]} blocks, the image has {self.block_count}!')
+        self.block_count = superblock_[2]
+        self.name_max: int = superblock_[3]
+        self.file_max: int = superblock_[4]
+        # the pending move of the global state: (id, the metadata pair of the moved entry)
+        self.pending_move: Optional[Tuple[int, Tuple[int, int]]] = self._pending_move()
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs: Any) -> 'LittleFSImage':
+        with open(path, 'rb') as image_file:
+            mapped_ = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+        littlefs_image_ = cls(mapped_, **kwargs)
+        littlefs_image_._mmap = mapped_
+        return littlefs_image_
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self) -> 'LittleFSImage':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _replay_block(self, block: int, block_size: int) -> Optional[Tuple[int, List[TagRecord]]]:
+        """
+        Reads the commits of the metadata block, as `lfs_dir_fetchmatch` does.
+
+        :returns: the revision count and the tags of the valid commits in their order, None if there is no valid commit
+        """
+        address_: int = block * block_size
+        data_: bytes = bytes(self._image[address_: address_ + block_size])
+        if len(data_) < block_size:
+            return None
+        revision_: int = struct.unpack_from(REVISION_FORMAT, data_)[0]
+        crc_: int = lfs_crc(0xffffffff, data_[:TAG_SIZE])
+        offset_: int = TAG_SIZE
+        ptag_: int = 0xffffffff
+        pending_: List[TagRecord] = []
+        committed_: Optional[List[TagRecord]] = None
+        while offset_ + TAG_SIZE <= block_size:
+            raw_tag_: bytes = data_[offset_: offset_ + TAG_SIZE]
+            crc_ = lfs_crc(crc_, raw_tag_)
+            tag_: int = struct.unpack('>I', raw_tag_)[0] ^ ptag_
+            if not tag_is_valid(tag_) or offset_ + tag_dsize(tag_) > block_size:
+                break
+            ptag_ = tag_
+            if tag_type2(tag_) == LFS_TYPE_CRC:
+                if offset_ + 2 * TAG_SIZE > block_size \
+                        or struct.unpack_from('<I', data_, offset_ + TAG_SIZE)[0] != crc_:
+                    break
+                # the valid bit of the next commit is flipped if the program unit was not erased
+                ptag_ ^= (tag_chunk(tag_) & 1) << 31
+                committed_ = list(pending_) if committed_ is None else committed_ + pending_
+                pending_ = []
+                crc_ = 0xffffffff
+                offset_ += tag_dsize(tag_)
+                continue
+            crc_ = lfs_crc(crc_, data_[offset_ + TAG_SIZE: offset_ + tag_dsize(tag_)])
+            pending_.append((tag_, address_ + offset_ + TAG_SIZE))
+            offset_ += tag_dsize(tag_)
+        if committed_ is None:
+            return None
+        return revision_, committed_
+
+    def _fetch(self, pair: Tuple[int, int], block_size: int) -> MetadataPair:
+        """
+        :raises ValueError: the pair is out of the image or none of its blocks holds a valid commit
+        """
+        if pair in self._pair_cache:
+            return self._pair_cache[pair]
+        if max(pair) * block_size >= len(self._image):
+            raise ValueError(f'The metadata pair {pair} is out of the image!')
+        revisions_: List[int] = [struct.unpack_from(REVISION_FORMAT, self._image, block_ * block_size)[0]
+                                 for block_ in pair]
+        order_: List[int] = [pair[1], pair[0]] if revision_newer(revisions_[1], revisions_[0]) else list(pair)
+        for block_ in order_:
+            replayed_: Optional[Tuple[int, List[TagRecord]]] = self._replay_block(block_, block_size)
+            if replayed_ is not None:
+                metadata_pair_: MetadataPair = self._apply(pair, block_, replayed_[0], replayed_[1])
+                self._pair_cache[pair] = metadata_pair_
+                return metadata_pair_
+        raise ValueError(f'The metadata pair {pair} has no valid commit!')
+
+    def _apply(self, pair: Tuple[int, int], block: int, revision: int, tags: List[TagRecord]) -> MetadataPair:
+        """
+        Replays the tags in their order: the splices insert and remove the ids, the newer attributes replace
+        the older ones of the same family.
+        """
+        entries_: List[Dict[int, TagRecord]] = []
+        tail_: Optional[Tuple[int, int]] = None
+        split_: bool = False
+        gstate_delta_: Tuple[int, int, int] = (0, 0, 0)
+        for tag_, address_ in tags:
+            type1_: int = tag_type1(tag_)
+            id_: int = tag_id(tag_)
+            if type1_ == LFS_TYPE_SPLICE:
+                if tag_type3(tag_) == LFS_TYPE_CREATE:
+                    entries_.insert(id_, {})
+                elif tag_type3(tag_) == LFS_TYPE_DELETE and id_ < len(entries_):
+                    del entries_[id_]
+            elif type1_ == LFS_TYPE_TAIL:
+                split_ = bool(tag_chunk(tag_) & 1)
+                tail_ = struct.unpack_from(PAIR_FORMAT, self._image, address_)
+            elif type1_ == LFS_TYPE_GLOBALS:
+                gstate_delta_ = struct.unpack_from(GSTATE_FORMAT, self._image, address_)
+            elif type1_ in (LFS_TYPE_NAME, LFS_TYPE_STRUCT, LFS_TYPE_USERATTR) and id_ != LFS_ID_NONE:
+                entries_.extend({} for _ in range(id_ + 1 - len(entries_)))
+                key_: int = tag_type3(tag_) if type1_ == LFS_TYPE_USERATTR else type1_
+                if tag_is_delete(tag_):
+                    entries_[id_].pop(key_, None)
+                else:
+                    entries_[id_][key_] = (tag_, address_)
+        return MetadataPair(pair=pair,
+                            block=block,
+                            revision=revision,
+                            entries=entries_,
+                            tail=None if tail_ is None or pair_is_null(tail_) else tail_,
+                            split=split_,
+                            gstate_delta=gstate_delta_)
+
+    def _superblock(self, metadata_pair: MetadataPair) -> Optional[Tuple[int, ...]]:
+        attributes_: Dict[int, TagRecord] = metadata_pair.entries[0] if metadata_pair.entries else {}
+        name_: Optional[TagRecord] = attributes_.get(LFS_TYPE_NAME)
+        struct_: Optional[TagRecord] = attributes_.get(LFS_TYPE_STRUCT)
+        if name_ is None or struct_ is None or tag_type3(name_[0]) != LFS_TYPE_SUPERBLOCK \
+                or self._image[name_[1]: name_[1] + len(LFS_MAGIC)] != LFS_MAGIC \
+                or tag_size(struct_[0]) < struct.calcsize(SUPERBLOCK_FORMAT):
+            return None
+        return struct.unpack_from(SUPERBLOCK_FORMAT, self._image, struct_[1])
+
+    def _detect_block_size(self) -> int:
+        """
+        Reads the block size from the superblock in the first block of the superblock pair, the size of the first
+        block is not known yet, so its commits are read up to the first invalid tag. If that block is erased,
+        the superblock is looked up in the second block at the common block sizes.
+        """
+        replayed_: Optional[Tuple[int, List[TagRecord]]] = self._replay_block(0, len(self._image))
+        if replayed_ is not None:
+            superblock_ = self._superblock(self._apply(ROOT_PAIR, 0, replayed_[0], replayed_[1]))
+            if superblock_ is not None:
+                return superblock_[1]
+        for block_size_ in CANDIDATE_BLOCK_SIZES:
+            replayed_ = self._replay_block(1, block_size_)
+            if replayed_ is not None:
+                superblock_ = self._superblock(self._apply(ROOT_PAIR, 1, replayed_[0], replayed_[1]))
+                if superblock_ is not None and superblock_[1] == block_size_:
+                    return block_size_
+        raise ValueError('The image has no LittleFS superblock!')
+
+    def _pending_move(self) -> Optional[Tuple[int, Tuple[int, int]]]:
+        """
+        Collects the global state from all the metadata pairs (linked by the tails) as the mount of littlefs does.
+        """
+        gstate_: List[int] = [0, 0, 0]
+        visited_: set = set()
+        pair_: Optional[Tuple[int, int]] = ROOT_PAIR
+        while pair_ is not None:
+            if pair_ in visited_:
+                raise ValueError(f'The tails of the metadata pairs form a cycle at {pair_}!')
+            visited_.add(pair_)
+            metadata_pair_: MetadataPair = self._fetch(pair_, self.block_size)
+            gstate_ = [value_ ^ delta_ for value_, delta_ in zip(gstate_, metadata_pair_.gstate_delta)]
+            pair_ = metadata_pair_.tail
+        if not tag_type1(gstate_[0]):
+            return None
+        return tag_id(gstate_[0]), (gstate_[1], gstate_[2])
+
+    def _parse_directory(self, parent: Tuple[str, ...], pair: Tuple[int, int]) -> Dict[str, LittleFSStat]:
+        listing_: Dict[str, LittleFSStat] = {}
+        pair_: Optional[Tuple[int, int]] = pair
+        while pair_ is not None:
+            metadata_pair_: MetadataPair = self._fetch(pair_, self.block_size)
+            for id_, attributes_ in enumerate(metadata_pair_.entries):
+                if self.pending_move is not None and self.pending_move[0] == id_ \
+                        and pairs_overlap(self.pending_move[1], pair_):
+                    continue
+                stat_: Optional[LittleFSStat] = self._entry_stat(parent, attributes_)
+                if stat_ is not None:
+                    listing_[stat_.name] = stat_
+            pair_ = metadata_pair_.tail if metadata_pair_.split else None
+        return listing_
+
+    def _entry_stat(self, parent: Tuple[str, ...], attributes: Dict[int, TagRecord]) -> Optional[LittleFSStat]:
+        name_: Optional[TagRecord] = attributes.get(LFS_TYPE_NAME)
+        if name_ is None or tag_type3(name_[0]) not in (LFS_TYPE_REG, LFS_TYPE_DIR):
+            return None
+        name_str_: str = bytes(self._image[name_[1]: name_[1] + tag_size(name_[0])]).decode(errors='surrogateescape')
+        path_: str = '/'.join(parent + (name_str_,))
+        struct_: Optional[TagRecord] = attributes.get(LFS_TYPE_STRUCT)
+        if tag_type3(name_[0]) == LFS_TYPE_DIR:
+            if struct_ is None or tag_type3(struct_[0]) != LFS_TYPE_DIRSTRUCT:
+                raise ValueError(f'The directory `{path_}` has no metadata pair!')
+            return LittleFSStat(path=path_, name=name_str_, is_dir=True, size=0,
+                                pair=struct.unpack_from(PAIR_FORMAT, self._image, struct_[1]),
+                                head=None, inline_address=None)
+        if struct_ is not None and tag_type3(struct_[0]) == LFS_TYPE_CTZSTRUCT:
+            head_, size_ = struct.unpack_from(CTZ_FORMAT, self._image, struct_[1])
+            return LittleFSStat(path=path_, name=name_str_, is_dir=False, size=size_, pair=None, head=head_,
+                                inline_address=None)
+        if struct_ is not None and tag_type3(struct_[0]) == LFS_TYPE_INLINESTRUCT:
+            return LittleFSStat(path=path_, name=name_str_, is_dir=False, size=tag_size(struct_[0]), pair=None,
+                                head=None, inline_address=struct_[1])
+        # the file created without the content
+        return LittleFSStat(path=path_, name=name_str_, is_dir=False, size=0, pair=None, head=None,
+                            inline_address=None)
+
+    def _listing(self, parts: Tuple[str, ...]) -> Dict[str, LittleFSStat]:
+        if parts not in self._dir_cache:
+            if not parts:
+                self._dir_cache[parts] = self._parse_directory(parts, ROOT_PAIR)
+            else:
+                stat_: LittleFSStat = self._lookup(parts)
+                if not stat_.is_dir or stat_.pair is None:
+                    raise NotADirectoryError(f'Not a directory: {"/".join(parts)}')
+                self._dir_cache[parts] = self._parse_directory(parts, stat_.pair)
+        return self._dir_cache[parts]
+
+    def _lookup(self, parts: Tuple[str, ...]) -> LittleFSStat:
+        stat_: Optional[LittleFSStat] = self._listing(parts[:-1]).get(parts[-1])
+        if stat_ is None:
+            raise FileNotFoundError(f'No such file or directory: {"/".join(parts)}')
+        return stat_
+
+    def stat(self, path: str) -> LittleFSStat:
+        parts_: Tuple[str, ...] = tuple(split_path(path))
+        if not parts_:
+            return LittleFSStat(path='', name='', is_dir=True, size=0, pair=ROOT_PAIR, head=None, inline_address=None)
+        return self._lookup(parts_)
+
+    def exists(self, path: str) -> bool:
+        try:
+            self.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def listdir(self, path: str = '') -> List[str]:
+        return list(self._listing(tuple(split_path(path))))
+
+    def scandir(self, path: str = '') -> List[LittleFSStat]:
+        return list(self._listing(tuple(split_path(path))).values())
+
+    def walk(self, top: str = '') -> Iterator[Tuple[str, List[str], List[str]]]:
+        """
+        Generates the directory tree like `os.walk` (top-down), paths are separated by '/'.
+        """
+        stack_: List[Tuple[str, ...]] = [tuple(split_path(top))]
+        while stack_:
+            current_: Tuple[str, ...] = stack_.pop()
+            listing_: Dict[str, LittleFSStat] = self._listing(current_)
+            dirs_: List[str] = [name for name, item in listing_.items() if item.is_dir]
+            files_: List[str] = [name for name, item in listing_.items() if not item.is_dir]
+            yield '/'.join(current_), dirs_, files_
+            stack_.extend(current_ + (name,) for name in reversed(dirs_))
+
+    def get_runs(self, stat: LittleFSStat) -> List[Tuple[int, int]]:
+        """
+        The address and the length of each part of the content of the file in the image. The skip-list is walked
+        from its head by the first pointers of the blocks, all the blocks but the last one are full.
+        """
+        if stat.size == 0:
+            return []
+        if stat.head is None:
+            assert stat.inline_address is not None
+            return [(stat.inline_address, stat.size)]
+        last_index_, _ = ctz_index(stat.size - 1, self.block_size)
+        blocks_: List[int] = [0] * (last_index_ + 1)
+        block_: int = stat.head
+        for index_ in range(last_index_, -1, -1):
+            if block_ >= self.block_count:
+                raise ValueError(f'The skip-list of `{stat.path}` points out of the image (block {block_})!')
+            blocks_[index_] = block_
+            if index_:
+                block_ = struct.unpack_from('<I', self._image, block_ * self.block_size)[0]
+        runs_: List[Tuple[int, int]] = []
+        remaining_: int = stat.size
+        for index_, block_ in enumerate(blocks_):
+            pointers_size_: int = TAG_SIZE * ctz_pointers_count(index_)
+            length_: int = min(remaining_, self.block_size - pointers_size_)
+            runs_.append((block_ * self.block_size + pointers_size_, length_))
+            remaining_ -= length_
+        return runs_
+
+    def open(self, path: str) -> FATFile:
+        stat_: LittleFSStat = self.stat(path)
+        if stat_.is_dir:
+            raise IsADirectoryError(f'Is a directory: {path}')
+        return FATFile(self._image, self.get_runs(stat_), stat_.size)
+
+    def read_file(self, path: str) -> bytes:
+        with self.open(path) as file_:
+            content_: bytes = file_.read()
+        return content_
+
+    def extract(self, output_directory: str, jobs: Optional[int] = None) -> None:
+        """
+        Extracts the whole image into the output directory. The directory tree is created first,
+        the files are then written in parallel by a thread pool, straight from the image.
+
+        :param output_directory: the directory to extract to, it is created and must not exist
+        :param jobs: number of threads, None for the default of `ThreadPoolExecutor`
+        """
+        os.makedirs(output_directory)
+        files_: List[Tuple[str, LittleFSStat]] = []
+        for dir_path_, dir_names_, file_names_ in self.walk():
+            for dir_name_ in dir_names_:
+                os.makedirs(os.path.join(output_directory, *split_path(dir_path_), dir_name_))
+            listing_: Dict[str, LittleFSStat] = self._listing(tuple(split_path(dir_path_)))
+            files_ += [(os.path.join(output_directory, *split_path(dir_path_), name), listing_[name])
+                       for name in file_names_]
+
+        def _write_file(item: Tuple[str, LittleFSStat]) -> None:
+            target_path_, stat_ = item
+            with open(target_path_, 'wb') as target_:
+                for address_, length_ in self.get_runs(stat_):
+                    target_.write(self._image[address_: address_ + length_])
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # consume the results to propagate exceptions
+            list(executor.map(_write_file, files_))
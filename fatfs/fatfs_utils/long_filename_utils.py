@@ -1,6 +1,7 @@
 # SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
-from typing import List
+from collections import Counter
+from typing import List, Optional
 
 from .entry import Entry
 from .exceptions import NoFreeClusterException
@@ -66,7 +67,8 @@ def split_name_to_lfn_entry_blocks(name: str) -> List[bytes]:
     return blocks_
 
 
-def build_lfn_unique_entry_name_order(entities: list, lfn_entry_name: str) -> int:
+def build_lfn_unique_entry_name_order(entities: list, lfn_entry_name: str,
+                                      prefix_counter: Optional[Counter] = None) -> int:
     """
     The short entry contains only the first 6 characters of the file name,
     and we have to distinguish it from other names within the directory starting with the same 6 characters.
@@ -75,11 +77,17 @@ def build_lfn_unique_entry_name_order(entities: list, lfn_entry_name: str) -> in
 
     E.g. the file in directory 'thisisverylongfilenama.txt' will be named 'THISIS~1TXT' in its short entry.
     If we add another file 'thisisverylongfilenamax.txt' its name in the short entry will be 'THISIS~2TXT'.
+
+    If the directory keeps `prefix_counter` (count of the entities by the 6 characters prefix of their names),
+    the order is taken from it instead of scanning the entities.
     """
     preceding_entries: int = 1
-    for entity in entities:
-        if entity.name[:6] == lfn_entry_name[:6]:
-            preceding_entries += 1
+    if prefix_counter is not None:
+        preceding_entries += prefix_counter[lfn_entry_name[:6]]
+    else:
+        for entity in entities:
+            if entity.name[:6] == lfn_entry_name[:6]:
+                preceding_entries += 1
     if preceding_entries > MAXIMAL_FILES_SAME_PREFIX:
         raise NoFreeClusterException('Maximal number of files with the same prefix is 127')
     return preceding_entries
@@ -0,0 +1,213 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import copy
+import fnmatch
+import os
+from typing import BinaryIO, Callable, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from .exceptions import NoFreeClusterException
+from .fs_object import Directory
+from .long_filename_utils import build_lfn_full_name, get_required_lfn_entries_count
+from .utils import (FATFS_MIN_ALLOC_UNIT, RESERVED_CLUSTERS_COUNT, FATDefaults, get_fat_sectors_count,
+                    get_fatfs_type, get_non_data_sectors_cnt, required_clusters_count_for_size,
+                    split_to_name_and_extension)
+from .virtual_tree import VirtualEntry, VirtualTree
+
+
+class PlannedObject(NamedTuple):
+    """
+    File or directory of the input directory in the order of the generation.
+    """
+    real_path: str
+    # path from the root of the partition, the names are in upper case as they are generated
+    path: Tuple[str, ...]
+    is_dir: bool
+    # size of the content (files) or of the entries (directories)
+    size: int
+    ctime: float
+    clusters: int
+    # opens the content of the file from the virtual tree, the files on the disk are opened by `real_path`
+    opener: Optional[Callable[[], BinaryIO]] = None
+
+
+class PartitionGeometry(NamedTuple):
+    sector_size: int
+    root_entry_count: int
+    size: int
+    sectors_count: int
+    fatfs_type: int
+    fat_sectors: int
+    root_dir_sectors: int
+    # all clusters of the data region and the clusters used by the planned objects
+    data_clusters: int
+    used_clusters: int
+
+
+def directory_entries_count(name: str, long_names_enabled: bool) -> int:
+    """
+    Number of the entries of the object in its parent directory, the long file name entries included.
+    The same rule as by `Directory.allocate_object` is applied.
+    """
+    name_, extension_ = split_to_name_and_extension(name)
+    if not long_names_enabled or Directory._is_valid_sfn(name_, extension_):  # pylint: disable=protected-access
+        return 1
+    return get_required_lfn_entries_count(build_lfn_full_name(name_, extension_)) + 1
+
+
+class PartitionPlan:
+    """
+    The objects of the input directory with their sizes and the clusters they require, gathered in a single walk
+    of the tree using only the metadata of the files. The plan determines the minimal geometry of the partition
+    and the generator creates the objects from it without scanning the tree again.
+    """
+
+    def __init__(self,
+                 input_directory: Union[str, VirtualTree],
+                 sector_size: int = FATDefaults.SECTOR_SIZE,
+                 long_names_enabled: bool = False,
+                 ignore_patterns: Optional[Iterable[str]] = None) -> None:
+        """
+        :param input_directory: the directory on the disk or the virtual tree
+        :param ignore_patterns: glob-style patterns of the names or of the paths relative to the input directory
+            (separated by '/') of the objects left out of the partition, the ignored directories are not scanned
+        """
+        self.input_directory: Union[str, VirtualTree] = input_directory
+        self.sector_size: int = sector_size
+        self.long_names_enabled: bool = long_names_enabled
+        self.ignore_patterns: List[str] = list(ignore_patterns or [])
+        self.objects: List[PlannedObject] = []
+        # entries of the root directory, it has no '.' and '..' entries and its size is fixed
+        if isinstance(input_directory, VirtualTree):
+            self.root_entries: int = self._scan('', (), '')
+        else:
+            self.root_entries = self._scan(input_directory, (), '')
+
+    def _ignored(self, name: str, relative_path: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern_) or fnmatch.fnmatch(relative_path, pattern_)
+                   for pattern_ in self.ignore_patterns)
+
+    def _scan(self, real_path: str, path: Tuple[str, ...], relative_path: str) -> int:
+        """
+        Appends the objects of the directory in the order of the generation (sorted, depth-first).
+
+        :returns: number of the entries of the directory
+        """
+        entries_cnt_: int = 0
+        children_: List[Union[os.DirEntry, VirtualEntry]]
+        if isinstance(self.input_directory, VirtualTree):
+            children_ = sorted(self.input_directory.scandir(real_path), key=lambda child: child.name)
+        else:
+            with os.scandir(real_path) as scanned_:
+                children_ = sorted(scanned_, key=lambda child: child.name)
+        for child_ in children_:
+            is_dir_: bool = child_.is_dir()
+            if not is_dir_ and not child_.is_file():
+                continue
+            child_relative_path_: str = f'{relative_path}/{child_.name}' if relative_path else child_.name
+            if self._ignored(child_.name, child_relative_path_):
+                continue
+            name_: str = child_.name.upper()
+            entries_cnt_ += directory_entries_count(name_, self.long_names_enabled)
+            stat_: os.stat_result = child_.stat()
+            if is_dir_:
+                index_: int = len(self.objects)
+                self.objects.append(PlannedObject(real_path=child_.path, path=path + (name_,), is_dir=True, size=0,
+                                                  ctime=stat_.st_ctime, clusters=0))
+                # '.' and '..'
+                child_size_: int = (self._scan(child_.path, path + (name_,), child_relative_path_) + 2) \
+                    * FATDefaults.ENTRY_SIZE
+                self.objects[index_] = self.objects[index_]._replace(
+                    size=child_size_, clusters=required_clusters_count_for_size(self.sector_size, child_size_))
+            else:
+                self.objects.append(PlannedObject(real_path=child_.path, path=path + (name_,), is_dir=False,
+                                                  size=stat_.st_size, ctime=stat_.st_ctime,
+                                                  clusters=required_clusters_count_for_size(self.sector_size,
+                                                                                            stat_.st_size),
+                                                  opener=child_.open if isinstance(child_, VirtualEntry) else None))
+        return entries_cnt_
+
+    @property
+    def file_clusters(self) -> int:
+        return sum(object_.clusters for object_ in self.objects if not object_.is_dir)
+
+    @property
+    def directory_clusters(self) -> int:
+        return sum(object_.clusters for object_ in self.objects if object_.is_dir)
+
+    @property
+    def clusters(self) -> int:
+        return self.file_clusters + self.directory_clusters
+
+    @property
+    def content_size(self) -> int:
+        return sum(object_.size for object_ in self.objects)
+
+    def with_sector_size(self, sector_size: int) -> 'PartitionPlan':
+        """
+        Copy of the plan for the different sector (cluster) size, the folder is not scanned again.
+        """
+        plan_: PartitionPlan = copy.copy(self)
+        plan_.sector_size = sector_size
+        plan_.objects = [object_._replace(clusters=required_clusters_count_for_size(sector_size, object_.size))
+                         for object_ in self.objects]
+        return plan_
+
+    def clusters_for(self, sector_size: int) -> int:
+        """
+        Number of clusters the objects require with the different sector (cluster) size.
+        """
+        if sector_size == self.sector_size:
+            return self.clusters
+        return sum(required_clusters_count_for_size(sector_size, object_.size) for object_ in self.objects)
+
+    def geometry(self,
+                 root_entry_count: int = FATDefaults.ROOT_ENTRIES_COUNT,
+                 reserved_sectors_cnt: int = FATDefaults.RESERVED_SECTORS_COUNT,
+                 extra_clusters: int = 0,
+                 sector_size: Optional[int] = None,
+                 partition_size: Optional[int] = None,
+                 extra_root_entries: int = 0) -> PartitionGeometry:
+        """
+        Computes the minimal partition holding the planned objects, the FAT grows with the partition,
+        so its size is iterated until it covers the whole partition.
+
+        :param extra_clusters: clusters required on top of the planned objects, e.g. for the growth of the files
+        :param extra_root_entries: root directory entries required on top of the planned objects,
+            e.g. for the content manifest
+        :param sector_size: the sector (cluster) size of the partition if it differs from the one of the plan
+        :param partition_size: if defined, the geometry of the partition of this size is computed instead
+        :raises NoFreeClusterException: the objects don't fit the partition of the given size
+            or the entries don't fit the root directory
+        """
+        sector_size_: int = sector_size or self.sector_size
+        if self.root_entries + extra_root_entries > root_entry_count:
+            raise NoFreeClusterException('Not enough space in root!')
+        root_dir_sectors_: int = (root_entry_count * FATDefaults.ENTRY_SIZE) // sector_size_
+        used_clusters_: int = self.clusters_for(sector_size_) + extra_clusters
+        if partition_size is not None:
+            sectors_count_: int = partition_size // sector_size_
+            fat_sectors_: int = get_fat_sectors_count(sectors_count_, sector_size_)
+        else:
+            sectors_count_ = max(FATFS_MIN_ALLOC_UNIT, reserved_sectors_cnt + root_dir_sectors_ + used_clusters_)
+            while True:
+                # the FAT is sized by the number of sectors the same way as by the generator
+                fat_sectors_ = get_fat_sectors_count(sectors_count_, sector_size_)
+                required_: int = get_non_data_sectors_cnt(reserved_sectors_cnt, fat_sectors_, root_dir_sectors_) \
+                    + used_clusters_
+                if required_ <= sectors_count_:
+                    break
+                sectors_count_ = required_
+        data_clusters_: int = sectors_count_ - get_non_data_sectors_cnt(reserved_sectors_cnt, fat_sectors_,
+                                                                        root_dir_sectors_)
+        if data_clusters_ < used_clusters_:
+            raise NoFreeClusterException('The partition is too small for the content!')
+        return PartitionGeometry(sector_size=sector_size_,
+                                 root_entry_count=root_entry_count,
+                                 size=sectors_count_ * sector_size_,
+                                 sectors_count=sectors_count_,
+                                 fatfs_type=get_fatfs_type(data_clusters_ + RESERVED_CLUSTERS_COUNT),
+                                 fat_sectors=fat_sectors_,
+                                 root_dir_sectors=root_dir_sectors_,
+                                 data_clusters=data_clusters_,
+                                 used_clusters=used_clusters_)
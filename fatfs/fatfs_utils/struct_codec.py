@@ -0,0 +1,98 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import struct
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from construct import Const, Struct
+
+from .utils import SHORT_NAMES_ENCODING
+
+
+class StructCodec:
+    """
+    Fast (de)serializer equivalent to the construct `Struct` definition with fixed size fields,
+    which are integers, padded strings and constants. The data are packed and unpacked by the precompiled
+    `struct.Struct`, construct is used only for validation: whenever the fast path cannot handle the data
+    (constant mismatch, invalid encoding, value out of range, missing field, short buffer),
+    the construct definition processes them and raises its usual exception.
+    """
+
+    def __init__(self, definition: Struct, fields: List[Tuple[str, str]], encoding: str = SHORT_NAMES_ENCODING) -> None:
+        """
+        :param definition: the construct definition the codec is equivalent to
+        :param fields: name and `struct` format of every field of the definition in the same order,
+            the fields with format `<n>s` which are not constants are padded strings
+        :param encoding: encoding of the padded strings
+        """
+        self.definition: Struct = definition
+        self._struct: struct.Struct = struct.Struct('<' + ''.join(format_ for _, format_ in fields))
+        names_: List[str] = [subcon.name for subcon in definition.subcons]
+        assert names_ == [name_ for name_, _ in fields], 'The fields do not match the definition!'
+        assert self._struct.size == definition.sizeof(), 'The size does not match the definition!'
+        self._names: List[str] = names_
+        self._encoding: str = encoding
+        self._constants: Dict[int, bytes] = {i: subcon.subcon.value for i, subcon in enumerate(definition.subcons)
+                                             if isinstance(subcon.subcon, Const)}
+        # index and size of the padded strings
+        self._strings: List[Tuple[int, int]] = [(i, int(format_[:-1])) for i, (_, format_) in enumerate(fields)
+                                                if format_.endswith('s') and i not in self._constants]
+
+    @property
+    def size(self) -> int:
+        return self._struct.size
+
+    def decode(self, values: Tuple[Any, ...]) -> Optional[Dict[str, Any]]:
+        """
+        Converts the unpacked values to the dictionary of fields.
+
+        :returns: the fields, None if the values are not valid for the definition
+        """
+        for i, value_ in self._constants.items():
+            if values[i] != value_:
+                return None
+        decoded_: List[Any] = list(values)
+        try:
+            for i, _ in self._strings:
+                decoded_[i] = values[i].rstrip(b'\x00').decode(self._encoding)
+        except UnicodeDecodeError:
+            return None
+        return dict(zip(self._names, decoded_))
+
+    def parse(self, data: bytes) -> Dict[str, Any]:
+        try:
+            parsed_: Optional[Dict[str, Any]] = self.decode(self._struct.unpack_from(data))
+        except struct.error:
+            parsed_ = None
+        if parsed_ is None:
+            # construct reports what is wrong with the data
+            container_: Dict[str, Any] = self.definition.parse(data)
+            return {name_: value_ for name_, value_ in container_.items() if name_ in self._names}
+        return parsed_
+
+    def iter_unpack(self, data: bytes) -> Iterator[Tuple[Any, ...]]:
+        """
+        Unpacks consecutive records in bulk (e.g. the whole directory cluster), the values are not decoded.
+        """
+        return self._struct.iter_unpack(data)
+
+    def iter_parse(self, data: bytes) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        Parses consecutive records in bulk, invalid records are yielded as None.
+        """
+        for values_ in self._struct.iter_unpack(data):
+            yield self.decode(values_)
+
+    def build(self, fields: Dict[str, Any]) -> bytes:
+        try:
+            values_: List[Any] = [self._constants[i] if i in self._constants else fields[name_]
+                                  for i, name_ in enumerate(self._names)]
+            for i, size_ in self._strings:
+                values_[i] = values_[i].encode(self._encoding)
+                if len(values_[i]) > size_:
+                    raise ValueError('The string does not fit the field')
+            return self._struct.pack(*values_)
+        except (KeyError, ValueError, TypeError, AttributeError, struct.error):
+            # construct reports what is wrong with the fields
+            built_: bytes = self.definition.build(fields)
+            return built_
@@ -3,6 +3,7 @@
 
 import argparse
 import binascii
+import mmap
 import os
 import re
 import uuid
@@ -55,6 +56,9 @@ ALLOWED_SECTOR_SIZES: List[int] = [512, 1024, 2048, 4096]
 
 ALLOWED_SECTORS_PER_CLUSTER: List[int] = [1, 2, 4, 8, 16, 32, 64, 128]
 
+# the name is a valid short name, so the manifest is readable with the long names disabled as well
+CONTENT_MANIFEST_NAME: str = 'MANIFEST.SHA'
+
 
 def crc32(input_values: List[int], crc: int) -> int:
     """
@@ -93,7 +97,11 @@ def get_fat_sectors_count(clusters_count: int, sector_size: int) -> int:
 
 def required_clusters_count(cluster_size: int, content: bytes) -> int:
     # compute number of required clusters for file text
-    return (len(content) + cluster_size - 1) // cluster_size
+    return required_clusters_count_for_size(cluster_size, len(content))
+
+
+def required_clusters_count_for_size(cluster_size: int, size: int) -> int:
+    return (size + cluster_size - 1) // cluster_size
 
 
 def generate_4bytes_random() -> int:
@@ -169,7 +177,8 @@ def split_content_into_sectors(content: bytes, sector_size: int) -> List[bytes]:
 def get_args_for_partition_generator(desc: str, wl: bool) -> argparse.Namespace:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description=desc)
     parser.add_argument('input_directory',
-                        help='Path to the directory that will be encoded into fatfs image')
+                        help='Path to the directory that will be encoded into fatfs image' +
+                             ('' if wl else ', the tar or zip archive, or the git repository (see --git_revision)'))
     parser.add_argument('--output_file',
                         default='fatfs_image.img',
                         help='Filename of the generated fatfs image')
@@ -190,6 +199,7 @@ def get_args_for_partition_generator(desc: str, wl: bool) -> argparse.Namespace:
                         help='Number of sectors per cluster')
     parser.add_argument('--root_entry_count',
                         default=FATDefaults.ROOT_ENTRIES_COUNT,
+                        type=int,
                         help='Number of entries in the root directory')
     parser.add_argument('--long_name_support',
                         action='store_true',
@@ -207,13 +217,51 @@ def get_args_for_partition_generator(desc: str, wl: bool) -> argparse.Namespace:
                         calculation using cluster size and partition size.
                         """)
 
+    parser.add_argument('--extents_manifest',
+                        default=None,
+                        help='Write the manifest of the populated extents of the image with their hashes to the file')
+    parser.add_argument('--content_manifest',
+                        nargs='?',
+                        const=CONTENT_MANIFEST_NAME,
+                        default=None,
+                        help='Write the manifest of the files with their sizes and hashes and the hash of the tree '
+                             f'into the root directory of the image (`{CONTENT_MANIFEST_NAME}` by default)')
+
+    if not wl:
+        parser.add_argument('--base_layout',
+                            default=None,
+                            help='Image or layout manifest (.json) of the previous build. Enables the stable layout: '
+                                 'the unchanged files keep their clusters and the timestamps are set to the default.')
+        parser.add_argument('--layout_slack',
+                            default=0,
+                            type=int,
+                            help='Percentage of the file size reserved for its growth in the stable layout')
+        parser.add_argument('--layout_manifest',
+                            default=None,
+                            help='Write the layout manifest of the generated image to the file, '
+                                 'enables the stable layout')
+        parser.add_argument('--ignore',
+                            action='append',
+                            default=[],
+                            help='Glob-style pattern of the names or the relative paths of the files and directories '
+                                 'left out of the image, can be repeated')
+        parser.add_argument('--git_revision',
+                            default=None,
+                            help='Build the image from the revision of the git repository given as the input '
+                                 'directory (using `git archive`) instead of its working tree')
+        parser.add_argument('--optimize_geometry',
+                            action='store_true',
+                            help='Choose the sector size and the root directory size for the content and print '
+                                 'the evaluated geometries. With `--partition_size detect` the smallest image '
+                                 'is chosen, otherwise the one with the most free space in the partition.')
+
     args = parser.parse_args()
     if args.fat_type == 0:
         args.fat_type = None
     if args.partition_size == 'detect' and not wl:
         args.partition_size = -1
     args.partition_size = int(str(args.partition_size), 0)
-    if not os.path.isdir(args.input_directory):
+    if not os.path.isdir(args.input_directory) and (wl or not os.path.isfile(args.input_directory)):
         raise NotADirectoryError(f'The target directory `{args.input_directory}` does not exist!')
     return args
 
@@ -223,6 +271,14 @@ def read_filesystem(path: str) -> bytearray:
         return bytearray(fs_file.read())
 
 
+def map_filesystem(path: str) -> mmap.mmap:
+    """
+    Maps the image file to memory as read-only, the content is paged in by the OS only when it is accessed.
+    """
+    with open(path, 'rb') as fs_file:
+        return mmap.mmap(fs_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 DATE_ENTRY = BitStruct(
     'year' / BitsInteger(7),
     'month' / BitsInteger(4),
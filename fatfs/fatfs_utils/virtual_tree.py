@@ -0,0 +1,306 @@
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import os
+import posixpath
+import stat
+import subprocess
+import tarfile
+import zipfile
+from datetime import datetime
+from typing import Any, BinaryIO, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+from .utils import FATFS_INCEPTION
+
+# the default modification time of the objects without one
+DEFAULT_MTIME: float = FATFS_INCEPTION.timestamp()
+
+
+class VirtualFile(NamedTuple):
+    # returns the binary stream of the content positioned at its start, the caller closes it
+    opener: Callable[[], BinaryIO]
+    size: int
+    mtime: float
+
+
+class VirtualDirectory:
+    def __init__(self, mtime: float = DEFAULT_MTIME) -> None:
+        self.children: Dict[str, Union['VirtualDirectory', VirtualFile]] = {}
+        self.mtime: float = mtime
+
+
+class VirtualEntry:
+    """
+    The object of the virtual tree with the subset of the interface of `os.DirEntry` used by `PartitionPlan`.
+    """
+
+    def __init__(self, name: str, path: str, node: Union[VirtualDirectory, VirtualFile]) -> None:
+        self.name: str = name
+        self.path: str = path
+        self.node: Union[VirtualDirectory, VirtualFile] = node
+
+    def is_dir(self) -> bool:
+        return isinstance(self.node, VirtualDirectory)
+
+    def is_file(self) -> bool:
+        return isinstance(self.node, VirtualFile)
+
+    def stat(self) -> os.stat_result:
+        size_: int = 0 if isinstance(self.node, VirtualDirectory) else self.node.size
+        mode_: int = stat.S_IFDIR if isinstance(self.node, VirtualDirectory) else stat.S_IFREG
+        return os.stat_result((mode_, 0, 0, 1, 0, 0, size_, self.node.mtime, self.node.mtime, self.node.mtime))
+
+    def open(self) -> BinaryIO:
+        assert isinstance(self.node, VirtualFile)
+        return self.node.opener()
+
+
+class SharedStream(io.RawIOBase):
+    """
+    The stream given to `VirtualTree.add_file` returned by each opening of the file,
+    closing it leaves the stream open for the next reader.
+    """
+
+    def __init__(self, stream: BinaryIO) -> None:
+        super().__init__()
+        self.stream: BinaryIO = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        data_: bytes = self.stream.read(len(buffer))
+        buffer[:len(data_)] = data_
+        return len(data_)
+
+
+def split_virtual_path(path: str) -> List[str]:
+    parts_: List[str] = [part_ for part_ in path.replace(os.sep, '/').split('/') if part_ not in ('', '.')]
+    if '..' in parts_:
+        raise ValueError(f'The path `{path}` leads out of the tree!')
+    return parts_
+
+
+def symlink_target(path: str, target: str) -> str:
+    """
+    The path of the target of the symbolic link relative to the root of the tree.
+    """
+    if posixpath.isabs(target):
+        raise ValueError(f'The link `{path}` points out of the tree to `{target}`!')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(path.replace(os.sep, '/')), target))
+
+
+class VirtualTree:
+    """
+    The tree of files and directories the FAT image is generated from instead of the directory on the disk.
+    It is populated from the memory or from the archives, e.g. the output of `git archive`,
+    so the image can be built without extracting the files to the disk.
+    The content of the files is read only when the file is written to the image, except for the streamed archives.
+    The tree read from the archive keeps it open until the tree is closed, e.g. by using it as the context manager.
+    """
+
+    def __init__(self) -> None:
+        self.root: VirtualDirectory = VirtualDirectory()
+        # the archives the content of the files is read from
+        self._archives: List[Union[tarfile.TarFile, zipfile.ZipFile]] = []
+
+    def __enter__(self) -> 'VirtualTree':
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the archives the tree was read from, the content of their files can not be read afterwards.
+        """
+        for archive_ in self._archives:
+            archive_.close()
+        self._archives = []
+
+    def _directory(self, parts: List[str], mtime: Optional[float] = None) -> VirtualDirectory:
+        directory_: VirtualDirectory = self.root
+        for part_ in parts:
+            child_ = directory_.children.setdefault(part_, VirtualDirectory())
+            if not isinstance(child_, VirtualDirectory):
+                raise NotADirectoryError(f'`{part_}` is a file!')
+            directory_ = child_
+        if mtime is not None:
+            directory_.mtime = mtime
+        return directory_
+
+    def add_directory(self, path: str, mtime: Optional[float] = None) -> None:
+        """
+        Adds the directory, the missing parent directories are created as well.
+        """
+        self._directory(split_virtual_path(path), mtime)
+
+    def add_file(self,
+                 path: str,
+                 content: Union[bytes, BinaryIO, Callable[[], BinaryIO]],
+                 size: Optional[int] = None,
+                 mtime: float = DEFAULT_MTIME) -> None:
+        """
+        :param content: the content, the seekable binary stream or the function opening it
+        :param size: the size of the content, required for the function opening the content
+        """
+        parts_: List[str] = split_virtual_path(path)
+        if not parts_:
+            raise ValueError('The file has no name!')
+        if isinstance(content, (bytes, bytearray)):
+            content_: bytes = bytes(content)
+            opener_: Callable[[], BinaryIO] = lambda: io.BytesIO(content_)  # noqa: E731
+            size = len(content_)
+        elif callable(content):
+            if size is None:
+                raise ValueError('The size of the content is required for the opener!')
+            opener_ = content
+        else:
+            stream_: BinaryIO = content
+            size = stream_.seek(0, io.SEEK_END)
+
+            def opener_() -> BinaryIO:
+                stream_.seek(0)
+                return SharedStream(stream_)  # type: ignore
+        self._directory(parts_[:-1]).children[parts_[-1]] = VirtualFile(opener=opener_, size=size, mtime=mtime)
+
+    def add_links(self, links: List[Tuple[str, str]]) -> None:
+        """
+        Adds the links the same way the directory on the disk is read, i.e. following them, so the link
+        is the copy of its target. The links may point to other links or through the linked directories.
+
+        :param links: the paths of the links with the paths of their targets relative to the root of the tree
+        """
+        pending_: List[Tuple[str, str]] = list(links)
+        while pending_:
+            unresolved_: List[Tuple[str, str]] = []
+            for path_, target_ in pending_:
+                parts_: List[str] = split_virtual_path(path_)
+                if not parts_:
+                    raise ValueError('The link has no name!')
+                node_: Union[VirtualDirectory, VirtualFile, None] = self.root
+                for part_ in split_virtual_path(target_):
+                    node_ = node_.children.get(part_) if isinstance(node_, VirtualDirectory) else None
+                if node_ is None:
+                    unresolved_.append((path_, target_))
+                    continue
+                # the directory containing itself would make the tree infinite
+                parents_: List[VirtualDirectory] = [self.root] + [self._directory(parts_[:i_])
+                                                                  for i_ in range(1, len(parts_))]
+                if any(parent_ is node_ for parent_ in parents_):
+                    raise ValueError(f'The link `{path_}` points to its own parent directory!')
+                parents_[-1].children[parts_[-1]] = node_
+            if len(unresolved_) == len(pending_):
+                raise FileNotFoundError('The targets of the links are not in the tree: '
+                                        + ', '.join(f'`{path_}` -> `{target_}`' for path_, target_ in unresolved_))
+            pending_ = unresolved_
+
+    def scandir(self, path: str = '') -> List[VirtualEntry]:
+        """
+        The entries of the directory, the same as `os.scandir` does for the directory on the disk.
+        """
+        parts_: List[str] = split_virtual_path(path)
+        directory_: Union[VirtualDirectory, VirtualFile] = self.root
+        for part_ in parts_:
+            if not isinstance(directory_, VirtualDirectory) or part_ not in directory_.children:
+                raise FileNotFoundError(f'`{path}` is not in the tree!')
+            directory_ = directory_.children[part_]
+        if not isinstance(directory_, VirtualDirectory):
+            raise NotADirectoryError(f'`{path}` is a file!')
+        return [VirtualEntry(name_, '/'.join(parts_ + [name_]), node_) for name_, node_ in directory_.children.items()]
+
+    @classmethod
+    def from_dict(cls, files: Mapping[str, Union[bytes, BinaryIO]], mtime: float = DEFAULT_MTIME) -> 'VirtualTree':
+        """
+        :param files: the content by the path of the file, the directories are created for the paths
+        """
+        tree_: VirtualTree = cls()
+        for path_, content_ in files.items():
+            tree_.add_file(path_, content_, mtime=mtime)
+        return tree_
+
+    @classmethod
+    def from_tar(cls, source: Union[str, BinaryIO]) -> 'VirtualTree':
+        """
+        Reads the tar archive (possibly compressed) from the path or the binary stream. The content is read lazily
+        from the archive on the disk or the seekable stream, otherwise the archive is streamed and the content of
+        the files is kept in the memory. The links are followed, the same as in the directory on the disk.
+        """
+        streamed_: bool = not isinstance(source, str) and not source.seekable()
+        if isinstance(source, str):
+            archive_: tarfile.TarFile = tarfile.open(source, mode='r:*')
+        else:
+            archive_ = tarfile.open(fileobj=source, mode='r|*' if streamed_ else 'r:*')
+        tree_: VirtualTree = cls()
+        tree_._archives.append(archive_)
+        links_: List[Tuple[str, str]] = []
+        try:
+            for member_ in archive_:
+                if member_.issym():
+                    links_.append((member_.name, symlink_target(member_.name, member_.linkname)))
+                elif member_.islnk():
+                    # the hard links point to the earlier member of the archive
+                    links_.append((member_.name, member_.linkname))
+                elif member_.isdir():
+                    tree_.add_directory(member_.name, mtime=member_.mtime)
+                elif member_.isfile():
+                    if streamed_:
+                        tree_.add_file(member_.name, archive_.extractfile(member_).read(), mtime=member_.mtime)
+                    else:
+                        tree_.add_file(member_.name, lambda member=member_: archive_.extractfile(member),
+                                       size=member_.size, mtime=member_.mtime)
+            tree_.add_links(links_)
+        except BaseException:
+            tree_.close()
+            raise
+        if streamed_:
+            # the content of the streamed archive is in the memory already
+            tree_.close()
+        return tree_
+
+    @classmethod
+    def from_zip(cls, source: Union[str, BinaryIO]) -> 'VirtualTree':
+        """
+        Reads the zip archive from the path or the seekable binary stream, the content is read lazily.
+        """
+        archive_: zipfile.ZipFile = zipfile.ZipFile(source)
+        tree_: VirtualTree = cls()
+        tree_._archives.append(archive_)
+        links_: List[Tuple[str, str]] = []
+        try:
+            for info_ in archive_.infolist():
+                mtime_: float = datetime(*info_.date_time).timestamp()
+                if stat.S_ISLNK(info_.external_attr >> 16):
+                    # the target of the symbolic link is stored as its content, e.g. by `git archive --format=zip`
+                    links_.append((info_.filename, symlink_target(info_.filename, archive_.read(info_).decode())))
+                elif info_.is_dir():
+                    tree_.add_directory(info_.filename, mtime=mtime_)
+                else:
+                    tree_.add_file(info_.filename, lambda info=info_: archive_.open(info), size=info_.file_size,
+                                   mtime=mtime_)
+            tree_.add_links(links_)
+        except BaseException:
+            tree_.close()
+            raise
+        return tree_
+
+    @classmethod
+    def from_archive(cls, path: str) -> 'VirtualTree':
+        """
+        Reads the zip or the tar archive, the format is detected from the content.
+        The tree keeps the archive open until it is closed.
+        """
+        if zipfile.is_zipfile(path):
+            return cls.from_zip(path)
+        return cls.from_tar(path)
+
+    @classmethod
+    def from_git(cls, repository: str, revision: str = 'HEAD', paths: Optional[List[str]] = None) -> 'VirtualTree':
+        """
+        Reads the tree of the revision of the git repository using `git archive`, so only the committed files
+        are included and the timestamps are the time of the commit.
+        """
+        archive_: bytes = subprocess.run(['git', '-C', repository, 'archive', '--format=tar', revision] + (paths or []),
+                                         check=True, stdout=subprocess.PIPE).stdout
+        return cls.from_tar(io.BytesIO(archive_))
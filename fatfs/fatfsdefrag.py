@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+from typing import Any
+
+from fatfs_utils.defragmenter import FATDefragmenter, same_content
+from fatfs_utils.exceptions import FatalError
+from fatfs_utils.utils import read_filesystem
+from fatfsparse import remove_wear_levelling_if_exists
+from wl_fatfsgen import add_wl, remove_wl_view, wl_parameters
+
+if __name__ == '__main__':
+    desc = 'Tool for defragmenting fatfs image, the files are made contiguous and the free space is moved to the end.'
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description=desc)
+    argument_parser.add_argument('input_image',
+                                 help='Path to the image (e.g. read back from the device).')
+    argument_parser.add_argument('output_image',
+                                 help='Path to the defragmented image, it may be the same as the input image.')
+    argument_parser.add_argument('--wl-layer',
+                                 choices=['detect', 'enabled', 'disabled'],
+                                 default='detect',
+                                 help="If detection doesn't work correctly, "
+                                      'you can force analyzer to or not to assume WL.')
+    argument_parser.add_argument('--report-only',
+                                 action='store_true',
+                                 help='Only print the fragmentation of the image.')
+    args = argument_parser.parse_args()
+
+    partition: bytearray = read_filesystem(args.input_image)
+    plain_image: Any = partition
+    if args.wl_layer == 'enabled':
+        plain_image = remove_wl_view(partition)
+    elif args.wl_layer == 'detect':
+        plain_image = remove_wear_levelling_if_exists(partition)
+    has_wl: bool = plain_image is not partition
+
+    fat_image = FATDefragmenter(plain_image)
+    print('Before:')
+    print(fat_image.fragmentation().format())
+    if args.report_only:
+        raise SystemExit(0)
+
+    defragmented_image: bytearray = fat_image.defragment()
+    defragmented_fat_image = FATDefragmenter(defragmented_image)
+    if not same_content(fat_image, defragmented_fat_image):
+        raise FatalError('The content of the defragmented image differs, the image is not written!')
+    print('After:')
+    print(defragmented_fat_image.fragmentation().format())
+
+    output: Any = defragmented_image
+    if has_wl:
+        output = add_wl(defragmented_image, len(partition), **wl_parameters(partition))
+    with open(args.output_image, 'wb') as output_file:
+        output_file.write(output)
@@ -2,20 +2,28 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
+import math
+import mmap
 import os
+import shutil
+import tempfile
 from datetime import datetime
-from typing import Any, List, Optional
+from typing import Any, List, Optional, Union
 
 from fatfs_utils.boot_sector import BootSector
+from fatfs_utils.content_manifest import ContentManifest
 from fatfs_utils.exceptions import NoFreeClusterException
+from fatfs_utils.extents import ExtentsManifest, fat_image_extents
 from fatfs_utils.fat import FAT
+from fatfs_utils.fat_image import FATImage
 from fatfs_utils.fatfs_state import FATFSState
 from fatfs_utils.fs_object import Directory
-from fatfs_utils.long_filename_utils import get_required_lfn_entries_count
-from fatfs_utils.utils import (BYTES_PER_DIRECTORY_ENTRY, FATFS_INCEPTION, FATFS_MIN_ALLOC_UNIT,
-                               RESERVED_CLUSTERS_COUNT, FATDefaults, get_args_for_partition_generator,
-                               get_fat_sectors_count, get_non_data_sectors_cnt, read_filesystem,
-                               required_clusters_count)
+from fatfs_utils.geometry_optimizer import format_candidates, optimize_geometry
+from fatfs_utils.layout import StableLayout
+from fatfs_utils.partition_plan import PartitionPlan, directory_entries_count
+from fatfs_utils.utils import (BYTES_PER_DIRECTORY_ENTRY, CONTENT_MANIFEST_NAME, FATFS_INCEPTION, FATDefaults,
+                               get_args_for_partition_generator, read_filesystem, required_clusters_count_for_size)
+from fatfs_utils.virtual_tree import VirtualTree
 
 
 class FATFS:
@@ -41,13 +49,24 @@ class FATFS:
                  file_sys_type: str = FATDefaults.FILE_SYS_TYPE,
                  root_entry_count: int = FATDefaults.ROOT_ENTRIES_COUNT,
                  explicit_fat_type: int = None,
-                 media_type: int = FATDefaults.MEDIA_TYPE) -> None:
+                 media_type: int = FATDefaults.MEDIA_TYPE,
+                 output_path: Optional[str] = None,
+                 layout: Optional[StableLayout] = None) -> None:
+        """
+        :param output_path: if defined, the image is built directly in the memory mapped output file
+            instead of the memory, the content of the source files is then copied into it in chunks
+        :param layout: if defined, `generate` places the objects according to the stable layout
+            and the volume ID is taken from it, the default date and time are always used then
+        """
         # root directory bytes should be aligned by sector size
         assert (root_entry_count * BYTES_PER_DIRECTORY_ENTRY) % sector_size == 0
         # number of bytes in the root dir must be even multiple of BPB_BytsPerSec
         assert ((root_entry_count * BYTES_PER_DIRECTORY_ENTRY) // sector_size) % 2 == 0
 
         root_dir_sectors_cnt: int = (root_entry_count * BYTES_PER_DIRECTORY_ENTRY) // sector_size
+        if layout is not None:
+            # the metadata must not depend on the time of the build
+            use_default_datetime = True
 
         self.state: FATFSState = FATFSState(sector_size=sector_size,
                                             explicit_fat_type=explicit_fat_type,
@@ -65,9 +84,18 @@ class FATFS:
                                             volume_label=volume_label,
                                             oem_name=oem_name,
                                             use_default_datetime=use_default_datetime)
-        binary_image: bytes = bytearray(
-            read_filesystem(binary_image_path) if binary_image_path else self.create_empty_fatfs())
-        self.state.binary_image = binary_image
+        self.layout: Optional[StableLayout] = layout
+        if layout is not None:
+            self.state.boot_sector_state.volume_uuid = layout.volume_uuid
+        self._output_path: Optional[str] = os.path.realpath(output_path) if output_path else None
+        self._mapped_image: Optional[mmap.mmap] = None
+        if output_path is not None:
+            self._mapped_image = self.map_output_file(output_path, binary_image_path)
+            self.state.binary_image = self._mapped_image
+        else:
+            binary_image: bytes = bytearray(
+                read_filesystem(binary_image_path) if binary_image_path else self.create_empty_fatfs())
+            self.state.binary_image = binary_image
 
         self.fat: FAT = FAT(boot_sector_state=self.state.boot_sector_state, init_=True)
 
@@ -119,7 +147,7 @@ class FATFS:
         """
         parent_dir = self.root_directory
         if path_from_root:
-            parent_dir = self.root_directory.recursive_search(path_from_root, self.root_directory)
+            parent_dir = self.root_directory.search_directory(path_from_root)
 
         self.root_directory.new_directory(name=name,
                                           parent=parent_dir,
@@ -132,113 +160,197 @@ class FATFS:
         """
         self.root_directory.write_to_file(path_from_root, content)
 
+    def write_content_from_file(self, path_from_root: List[str], source_path: str) -> None:
+        """
+        Same as `write_content`, but the content is streamed from the source file, the clusters are allocated
+        according to its size, so the content of the file is never held in memory as a whole.
+        """
+        with open(source_path, 'rb') as source:
+            self.root_directory.write_file_from_source(path_from_root, source, os.fstat(source.fileno()).st_size)
+
     def create_empty_fatfs(self) -> Any:
         boot_sector_ = BootSector(boot_sector_state=self.state.boot_sector_state)
         boot_sector_.generate_boot_sector()
         return boot_sector_.binary_image
 
+    def map_output_file(self, output_path: str, binary_image_path: Optional[str] = None) -> mmap.mmap:
+        """
+        Creates the output file with the empty file system (or the copy of the existing image)
+        and maps it to the memory.
+        """
+        if binary_image_path is not None:
+            if os.path.realpath(binary_image_path) != os.path.realpath(output_path):
+                shutil.copyfile(binary_image_path, output_path)
+            mode_: str = 'r+b'
+        else:
+            mode_ = 'w+b'
+        with open(output_path, mode_) as output:
+            if binary_image_path is None:
+                BootSector(boot_sector_state=self.state.boot_sector_state).write_empty_image(output)
+                output.flush()
+            return mmap.mmap(output.fileno(), 0)
+
     def write_filesystem(self, output_path: str) -> None:
+        if self._mapped_image is not None and os.path.realpath(output_path) == self._output_path:
+            self._mapped_image.flush()
+            return
         with open(output_path, 'wb') as output:
-            output.write(bytearray(self.state.binary_image))
+            output.write(self.state.binary_image)
 
-    def _generate_partition_from_folder(self,
-                                        folder_relative_path: str,
-                                        folder_path: str = '',
-                                        is_dir: bool = False) -> None:
+    def close(self) -> None:
         """
-        Given path to folder and folder name recursively encodes folder into binary image.
-        Used by method generate.
+        Flushes and unmaps the output file if the image is built in it.
         """
-        real_path: str = os.path.join(folder_path, folder_relative_path)
-        lower_path: str = folder_relative_path
-
-        folder_relative_path = folder_relative_path.upper()
-
-        normal_path = os.path.normpath(folder_relative_path)
-        split_path = normal_path.split(os.sep)
-        object_timestamp = datetime.fromtimestamp(os.path.getctime(real_path))
+        if self._mapped_image is not None:
+            self._mapped_image.flush()
+            self._mapped_image.close()
+            self._mapped_image = None
+
+    def generate(self,
+                 input_directory: Union[str, VirtualTree],
+                 plan: Optional[PartitionPlan] = None,
+                 ignore_patterns: Optional[List[str]] = None) -> None:
+        """
+        Encodes the folder into the binary image.
 
-        if os.path.isfile(real_path):
-            with open(real_path, 'rb') as file:
-                content = file.read()
-            file_name, extension = os.path.splitext(split_path[-1])
+        :param input_directory: the directory on the disk or the virtual tree (e.g. the content of the archive)
+        :param plan: the plan of the folder, if defined, the folder is not scanned again
+        :param ignore_patterns: the patterns of the names or the paths of the objects left out (see `PartitionPlan`)
+        """
+        if plan is None:
+            plan = PartitionPlan(input_directory,
+                                 sector_size=self.state.boot_sector_state.sector_size,
+                                 long_names_enabled=self.state.long_names_enabled,
+                                 ignore_patterns=ignore_patterns)
+        if self.layout is not None:
+            self.layout.retain(StableLayout.key(list(object_.path)) for object_ in plan.objects)
+            self.layout.reserve(self.fat)
+        for object_ in plan.objects:
+            path_: List[str] = list(object_.path)
+            object_timestamp = datetime.fromtimestamp(object_.ctime)
+            if object_.is_dir:
+                if self.layout is not None:
+                    self.layout.place(self.fat, StableLayout.key(path_), 1, slack=False)
+                self.create_directory(name=path_[-1],
+                                      path_from_root=path_[:-1],
+                                      object_timestamp_=object_timestamp)
+                continue
+            file_name, extension = os.path.splitext(path_[-1])
             extension = extension[1:]  # remove the dot from the extension
+            if self.layout is not None:
+                self.layout.place(self.fat, StableLayout.key(path_), object_.clusters)
             self.create_file(name=file_name,
                              extension=extension,
-                             path_from_root=split_path[1:-1] or None,
+                             path_from_root=path_[:-1] or None,
                              object_timestamp_=object_timestamp,
-                             is_empty=len(content) == 0)
-            self.write_content(split_path[1:], content)
-        elif os.path.isdir(real_path):
-            if not is_dir:
-                self.create_directory(name=split_path[-1],
-                                      path_from_root=split_path[1:-1],
-                                      object_timestamp_=object_timestamp)
-
-            # sorting files for better testability
-            dir_content = list(sorted(os.listdir(real_path)))
-            for path in dir_content:
-                self._generate_partition_from_folder(os.path.join(lower_path, path), folder_path=folder_path)
-
-    def generate(self, input_directory: str) -> None:
-        """
-        Normalize path to folder and recursively encode folder to binary image
-        """
-        path_to_folder, folder_name = os.path.split(input_directory)
-        self._generate_partition_from_folder(folder_name, folder_path=path_to_folder, is_dir=True)
-
-
-def calculate_min_space(path: List[str],
-                        fs_entity: str,
-                        sector_size: int = 0x1000,
-                        long_file_names: bool = False,
-                        is_root: bool = False) -> int:
-    if os.path.isfile(os.path.join(*path, fs_entity)):
-        with open(os.path.join(*path, fs_entity), 'rb') as file_:
-            content = file_.read()
-        res: int = required_clusters_count(sector_size, content)
-        return res
-    buff: int = 0
-    dir_size = 2 * FATDefaults.ENTRY_SIZE  # record for symlinks "." and ".."
-    for file in sorted(os.listdir(os.path.join(*path, fs_entity))):
-        if long_file_names and True:
-            # LFN entries + one short entry
-            dir_size += (get_required_lfn_entries_count(fs_entity) + 1) * FATDefaults.ENTRY_SIZE
-        else:
-            dir_size += FATDefaults.ENTRY_SIZE
-        buff += calculate_min_space(path + [fs_entity], file, sector_size, long_file_names, is_root=False)
-    if is_root and dir_size // FATDefaults.ENTRY_SIZE > FATDefaults.ROOT_ENTRIES_COUNT:
-        raise NoFreeClusterException('Not enough space in root!')
+                             is_empty=object_.size == 0)
+            # the clusters are allocated according to the size, the content is copied in chunks
+            if object_.opener is not None:
+                with object_.opener() as source_:
+                    self.root_directory.write_file_from_source(path_, source_, object_.size)
+            else:
+                self.write_content_from_file(path_, object_.real_path)
+
+    def add_content_manifest(self, manifest_name: str = CONTENT_MANIFEST_NAME) -> ContentManifest:
+        """
+        Hashes the files of the generated image and writes the manifest of them into the root directory.
+        It is the last file created, so the manifest covers the whole partition.
 
-    # roundup sectors, at least one is required
-    buff += (dir_size + sector_size - 1) // sector_size
-    return buff
+        :param manifest_name: the name of the manifest in the root directory, it must not exist
+        :raises NoFreeClusterException: the root directory has no space left for the manifest
+        """
+        required_entries_: int = directory_entries_count(manifest_name.upper(), self.state.long_names_enabled)
+        if self.root_directory.entries.free_count < required_entries_:
+            raise NoFreeClusterException('Not enough space in root for the content manifest!')
+        manifest_: ContentManifest = ContentManifest.from_image(FATImage(self.state.binary_image), manifest_name)
+        name_, extension_ = os.path.splitext(manifest_name)
+        self.create_file(name=name_, extension=extension_[1:])
+        self.write_content([manifest_name], manifest_.to_text().encode())
+        return manifest_
 
 
 def main() -> None:
     args = get_args_for_partition_generator('Create a FAT filesystem and populate it with directory content', wl=False)
 
+    layout: Optional[StableLayout] = None
+    if args.base_layout or args.layout_manifest:
+        slack = args.layout_slack / 100
+        layout = StableLayout.load(args.base_layout, slack) if args.base_layout else StableLayout(slack=slack)
+
+    input_directory: Union[str, VirtualTree] = args.input_directory
+    if args.git_revision:
+        input_directory = VirtualTree.from_git(args.input_directory, args.git_revision)
+    elif os.path.isfile(args.input_directory):
+        input_directory = VirtualTree.from_archive(args.input_directory)
+    try:
+        generate_image(args, input_directory, layout)
+    finally:
+        if isinstance(input_directory, VirtualTree):
+            input_directory.close()
+
+
+def generate_image(args: Any, input_directory: Union[str, VirtualTree], layout: Optional[StableLayout]) -> None:
+    """
+    Generates the image of the input directory (or the virtual tree) according to the command line arguments.
+    """
+    # the folder is scanned only once, the plan is used for the size as well as for the generation
+    plan = PartitionPlan(input_directory,
+                         sector_size=args.sector_size,
+                         long_names_enabled=args.long_name_support,
+                         ignore_patterns=args.ignore)
+    if args.optimize_geometry:
+        candidates = optimize_geometry(plan, partition_size=None if args.partition_size == -1 else args.partition_size)
+        print(format_candidates(candidates))
+        if not candidates:
+            raise NoFreeClusterException('No geometry fits the content!')
+        args.sector_size = candidates[0].geometry.sector_size
+        args.root_entry_count = candidates[0].geometry.root_entry_count
+        plan = plan.with_sector_size(args.sector_size)
     if args.partition_size == -1:
-        clusters = calculate_min_space([], args.input_directory, args.sector_size, long_file_names=True, is_root=True)
-        fats = get_fat_sectors_count(clusters, args.sector_size)
-        root_dir_sectors = (FATDefaults.ROOT_ENTRIES_COUNT * FATDefaults.ENTRY_SIZE) // args.sector_size
-        args.partition_size = max(FATFS_MIN_ALLOC_UNIT * args.sector_size,
-                                  (clusters + fats + get_non_data_sectors_cnt(RESERVED_CLUSTERS_COUNT,
-                                                                              fats,
-                                                                              root_dir_sectors)
-                                   ) * args.sector_size
-                                  )
-
-    fatfs = FATFS(sector_size=args.sector_size,
-                  sectors_per_cluster=args.sectors_per_cluster,
-                  size=args.partition_size,
-                  root_entry_count=args.root_entry_count,
-                  explicit_fat_type=args.fat_type,
-                  long_names_enabled=args.long_name_support,
-                  use_default_datetime=args.use_default_datetime)
-
-    fatfs.generate(args.input_directory)
-    fatfs.write_filesystem(args.output_file)
+        extra_clusters = math.ceil(plan.file_clusters * layout.slack) if layout is not None else 0
+        extra_root_entries = 0
+        if args.content_manifest:
+            extra_clusters += required_clusters_count_for_size(args.sector_size, ContentManifest.planned_size(plan))
+            extra_root_entries = directory_entries_count(args.content_manifest.upper(), args.long_name_support)
+        geometry = plan.geometry(root_entry_count=args.root_entry_count, extra_clusters=extra_clusters,
+                                 extra_root_entries=extra_root_entries)
+        args.partition_size = geometry.size
+
+    # the image is built next to the output file and moved over it only when it is complete,
+    # so a failed generation does not leave a partial image behind
+    descriptor_, temporary_path_ = tempfile.mkstemp(prefix='.fatfs_', suffix='.tmp',
+                                                    dir=os.path.dirname(os.path.abspath(args.output_file)))
+    os.close(descriptor_)
+    try:
+        fatfs = FATFS(sector_size=args.sector_size,
+                      sectors_per_cluster=args.sectors_per_cluster,
+                      size=args.partition_size,
+                      root_entry_count=args.root_entry_count,
+                      explicit_fat_type=args.fat_type,
+                      long_names_enabled=args.long_name_support,
+                      use_default_datetime=args.use_default_datetime,
+                      output_path=temporary_path_,
+                      layout=layout)
+        try:
+            fatfs.generate(input_directory, plan)
+            if args.content_manifest:
+                fatfs.add_content_manifest(args.content_manifest)
+            fatfs.write_filesystem(temporary_path_)
+            if args.extents_manifest:
+                ExtentsManifest(fatfs.state.binary_image,
+                                fat_image_extents(fatfs.state.binary_image)).write_manifest(args.extents_manifest)
+        finally:
+            fatfs.close()
+        # mkstemp creates the file readable only by the owner
+        umask_ = os.umask(0)
+        os.umask(umask_)
+        os.chmod(temporary_path_, 0o666 & ~umask_)
+        os.replace(temporary_path_, args.output_file)
+    except BaseException:
+        os.remove(temporary_path_)
+        raise
+    if layout is not None and args.layout_manifest:
+        layout.write_manifest(args.layout_manifest)
 
 
 if __name__ == '__main__':
@@ -2,92 +2,20 @@
 # SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 import argparse
-import os
+import sys
+from typing import Any, List, Optional
 
 import construct
 from fatfs_utils.boot_sector import BootSector
-from fatfs_utils.entry import Entry
-from fatfs_utils.fat import FAT
-from fatfs_utils.fatfs_state import BootSectorState
-from fatfs_utils.utils import FULL_BYTE, LONG_NAMES_ENCODING, PAD_CHAR, FATDefaults, lfn_checksum, read_filesystem
-from wl_fatfsgen import remove_wl
+from fatfs_utils.content_manifest import ContentManifest
+from fatfs_utils.fat_image import FATImage
+from fatfs_utils.image_view import ImageView
+from fatfs_utils.partition_plan import PartitionPlan
+from fatfs_utils.utils import map_filesystem
+from wl_fatfsgen import remove_wl_view
 
 
-def build_file_name(name1: bytes, name2: bytes, name3: bytes) -> str:
-    full_name_ = name1 + name2 + name3
-    # need to strip empty bytes and null-terminating char ('\x00')
-    return full_name_.rstrip(FULL_BYTE).decode(LONG_NAMES_ENCODING).rstrip('\x00')
-
-
-def get_obj_name(obj_: dict, directory_bytes_: bytes, entry_position_: int, lfn_checksum_: int) -> str:
-    obj_ext_ = obj_['DIR_Name_ext'].rstrip(chr(PAD_CHAR))
-    ext_ = f'.{obj_ext_}' if len(obj_ext_) > 0 else ''
-    obj_name_: str = obj_['DIR_Name'].rstrip(chr(PAD_CHAR)) + ext_  # short entry name
-
-    # if LFN was detected, the record is considered as single SFN record only if DIR_NTRes == 0x18 (LDIR_DIR_NTRES)
-    # if LFN was not detected, the record cannot be part of the LFN, no matter the value of DIR_NTRes
-    if not args.long_name_support or obj_['DIR_NTRes'] == Entry.LDIR_DIR_NTRES:
-        return obj_name_
-
-    full_name = {}
-
-    for pos in range(entry_position_ - 1, -1, -1):  # loop from the current entry back to the start
-        obj_address_: int = FATDefaults.ENTRY_SIZE * pos
-        entry_bytes_: bytes = directory_bytes_[obj_address_: obj_address_ + FATDefaults.ENTRY_SIZE]
-        struct_ = Entry.parse_entry_long(entry_bytes_, lfn_checksum_)
-        if len(struct_.items()) > 0:
-            full_name[struct_['order']] = build_file_name(struct_['name1'], struct_['name2'], struct_['name3'])
-            if struct_['is_last']:
-                break
-    return ''.join(map(lambda x: x[1], sorted(full_name.items()))) or obj_name_
-
-
-def traverse_folder_tree(directory_bytes_: bytes,
-                         name: str,
-                         state_: BootSectorState,
-                         fat_: FAT,
-                         binary_array_: bytes) -> None:
-    os.makedirs(name)
-
-    assert len(directory_bytes_) % FATDefaults.ENTRY_SIZE == 0
-    entries_count_: int = len(directory_bytes_) // FATDefaults.ENTRY_SIZE
-
-    for i in range(entries_count_):
-        obj_address_: int = FATDefaults.ENTRY_SIZE * i
-        try:
-            obj_: dict = Entry.ENTRY_FORMAT_SHORT_NAME.parse(
-                directory_bytes_[obj_address_: obj_address_ + FATDefaults.ENTRY_SIZE])
-        except (construct.core.ConstError, UnicodeDecodeError, construct.core.StringError):
-            args.long_name_support = True
-            continue
-
-        if obj_['DIR_Attr'] == 0:  # empty entry
-            continue
-
-        obj_name_: str = get_obj_name(obj_,
-                                      directory_bytes_,
-                                      entry_position_=i,
-                                      lfn_checksum_=lfn_checksum(obj_['DIR_Name'] + obj_['DIR_Name_ext']))
-        if obj_['DIR_Attr'] == Entry.ATTR_ARCHIVE:
-            content_ = b''
-            if obj_['DIR_FileSize'] > 0:
-                content_ = fat_.get_chained_content(cluster_id_=Entry.get_cluster_id(obj_),
-                                                    size=obj_['DIR_FileSize'])
-            with open(os.path.join(name, obj_name_), 'wb') as new_file:
-                new_file.write(content_)
-        elif obj_['DIR_Attr'] == Entry.ATTR_DIRECTORY:
-            # avoid creating symlinks to itself and parent folder
-            if obj_name_ in ('.', '..'):
-                continue
-            child_directory_bytes_ = fat_.get_chained_content(cluster_id_=obj_['DIR_FstClusLO'])
-            traverse_folder_tree(directory_bytes_=child_directory_bytes_,
-                                 name=os.path.join(name, obj_name_),
-                                 state_=state_,
-                                 fat_=fat_,
-                                 binary_array_=binary_array_)
-
-
-def remove_wear_levelling_if_exists(fs_: bytes) -> bytes:
+def remove_wear_levelling_if_exists(fs_: Any) -> Any:
     """
     Detection of the wear levelling layer is performed in two steps:
     1) check if the first sector is a valid boot sector
@@ -97,15 +25,34 @@ def remove_wear_levelling_if_exists(fs_: bytes) -> bytes:
     """
     try:
         boot_sector__ = BootSector()
-        boot_sector__.parse_boot_sector(fs_)
+        # only the header is parsed, the image may be mmap of the whole partition
+        boot_sector__.parse_boot_sector(fs_[:BootSector.BOOT_HEADER_SIZE])
         if boot_sector__.boot_sector_state.size == len(fs_):
             return fs_
     except construct.core.ConstError:
         pass
-    plain_fs: bytes = remove_wl(fs_)
+    plain_fs: ImageView = remove_wl_view(fs_)
     return plain_fs
 
 
+def verify_image(fat_image: FATImage, directory: str, ignore_patterns: List[str], jobs: Optional[int] = None) -> bool:
+    """
+    Compares the files of the image with the files of the directory by their hashes and prints the differences.
+    The files are hashed straight from the image, nothing is extracted.
+    """
+    plan_: PartitionPlan = PartitionPlan(directory, long_names_enabled=True, ignore_patterns=ignore_patterns)
+    missing_, extra_, different_ = ContentManifest.verify(fat_image, plan_, jobs=jobs)
+    for title_, paths_ in (('Missing in the image', missing_), ('Not in the directory', extra_),
+                           ('Different content', different_)):
+        if paths_:
+            print(f'{title_}:')
+            print('\n'.join(f'    {path_}' for path_ in paths_))
+    if missing_ or extra_ or different_:
+        return False
+    print(f'The image matches the directory `{directory}`.')
+    return True
+
+
 if __name__ == '__main__':
     desc = 'Tool for parsing fatfs image and extracting directory structure on host.'
     argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description=desc)
@@ -114,6 +61,21 @@ if __name__ == '__main__':
     argument_parser.add_argument('--long-name-support',
                                  action='store_true',
                                  help=argparse.SUPPRESS)
+    argument_parser.add_argument('--jobs',
+                                 type=int,
+                                 default=None,
+                                 help='Number of threads writing the extracted files or hashing the files.')
+    argument_parser.add_argument('--verify',
+                                 metavar='DIRECTORY',
+                                 default=None,
+                                 help='Compare the files of the image with the directory by their hashes '
+                                      'instead of extracting the image.')
+    argument_parser.add_argument('--ignore',
+                                 action='append',
+                                 default=[],
+                                 help='Glob-style pattern of the names or the relative paths of the files and '
+                                      'directories of the verified directory which are not in the image, '
+                                      'can be repeated')
 
     # ensures backward compatibility
     argument_parser.add_argument('--wear-leveling',
@@ -138,7 +100,9 @@ if __name__ == '__main__':
         args.wl_layer = 'enabled'
     args.wl_layer = args.wl_layer or 'detect'
 
-    fs = read_filesystem(args.input_image)
+    # the image is accessed through mmap and the wear levelling layer is removed by remapping the sectors,
+    # so the partition is never copied to memory as a whole
+    fs = map_filesystem(args.input_image)
 
     # An algorithm for removing wear levelling:
     # 1. find an remove dummy sector:
@@ -150,18 +114,13 @@ if __name__ == '__main__':
     # 3. remove cfg sector (trivial)
     # 4. valid fs is then old_fs[-mc:] + old_fs[:-mc]
     if args.wl_layer == 'enabled':
-        fs = remove_wl(fs)
+        fs = remove_wl_view(fs)
     elif args.wl_layer != 'disabled':
         # wear levelling is removed to enable parsing using common algorithm
         fs = remove_wear_levelling_if_exists(fs)
 
-    boot_sector_ = BootSector()
-    boot_sector_.parse_boot_sector(fs)
-    fat = FAT(boot_sector_.boot_sector_state, init_=False)
-
-    boot_dir_start_ = boot_sector_.boot_sector_state.root_directory_start
-    boot_dir_sectors = boot_sector_.boot_sector_state.root_dir_sectors_cnt
-    full_ = fs[boot_dir_start_: boot_dir_start_ + boot_dir_sectors * boot_sector_.boot_sector_state.sector_size]
-    traverse_folder_tree(full_,
-                         boot_sector_.boot_sector_state.volume_label.rstrip(chr(PAD_CHAR)),
-                         boot_sector_.boot_sector_state, fat, fs)
+    # long file names are detected from the LFN entries, --long-name-support is kept for compatibility only
+    fat_image_ = FATImage(fs)
+    if args.verify is not None:
+        sys.exit(0 if verify_image(fat_image_, args.verify, args.ignore, jobs=args.jobs) else 1)
+    fat_image_.extract(fat_image_.volume_label, jobs=args.jobs)
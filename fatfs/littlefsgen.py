@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import fnmatch
+import os
+import struct
+from typing import BinaryIO, Callable, Iterable, List, Optional, Tuple, Union
+
+from fatfs_utils.exceptions import NoFreeBlockException, TooLongNameException
+from fatfs_utils.extents import ExtentsManifest, ImageExtent
+from fatfs_utils.littlefs_format import (CTZ_FORMAT, LFS_ATTR_MAX, LFS_DISK_VERSION, LFS_ENTRIES_MAX, LFS_FILE_MAX,
+                                         LFS_ID_NONE, LFS_MAGIC, LFS_NAME_MAX, LFS_TAG_SIZE_MAX, LFS_TYPE_CTZSTRUCT,
+                                         LFS_TYPE_DIR, LFS_TYPE_DIRSTRUCT, LFS_TYPE_HARDTAIL, LFS_TYPE_INLINESTRUCT,
+                                         LFS_TYPE_REG, LFS_TYPE_SOFTTAIL, LFS_TYPE_SUPERBLOCK, PAIR_FORMAT,
+                                         SUPERBLOCK_FORMAT, TAG_SIZE, align_up, build_metadata_block,
+                                         ctz_block_capacity, ctz_blocks_count, ctz_pointers_count, make_tag)
+from fatfs_utils.utils import FULL_BYTE, FATDefaults
+from fatfs_utils.virtual_tree import VirtualEntry, VirtualTree
+
+# the revision count of the generated metadata blocks, the other block of the pair stays erased
+METADATA_REVISION: int = 1
+# the size of the tail tag with its pair
+TAIL_SIZE: int = TAG_SIZE + struct.calcsize(PAIR_FORMAT)
+SUPERBLOCK_ENTRY_SIZE: int = 2 * TAG_SIZE + len(LFS_MAGIC) + struct.calcsize(SUPERBLOCK_FORMAT)
+
+
+class LittleFSObject:
+    """
+    File or directory of the generated partition with its place in the image.
+    """
+
+    def __init__(self,
+                 name: bytes,
+                 path: str,
+                 is_dir: bool,
+                 size: int = 0,
+                 real_path: str = '',
+                 opener: Optional[Callable[[], BinaryIO]] = None) -> None:
+        self.name: bytes = name
+        # path from the root of the partition separated by '/'
+        self.path: str = path
+        self.is_dir: bool = is_dir
+        self.size: int = size
+        self.real_path: str = real_path
+        # opens the content of the file from the virtual tree, the files on the disk are opened by `real_path`
+        self.opener: Optional[Callable[[], BinaryIO]] = opener
+        self.children: List[LittleFSObject] = []
+        # the directory: the first blocks of its metadata pairs and the children in each of them
+        self.pairs: List[int] = []
+        self.pair_children: List[List[LittleFSObject]] = []
+        # the file stored outside of the metadata: the first block of its skip-list (the blocks are consecutive)
+        self.first_block: Optional[int] = None
+
+    def open(self) -> BinaryIO:
+        if self.opener is not None:
+            return self.opener()
+        return open(self.real_path, 'rb')
+
+
+class LittleFS:
+    """
+    The class LittleFS generates LittleFS v2 image of the directory in process, with the same geometry as mklittlefs
+    (block size and page size). The layout is deterministic: the entries are sorted, the metadata pairs
+    of the directories (depth-first) follow the superblock and the files occupy consecutive blocks behind them
+    in the same order. The metadata blocks contain single compacted commit and the content of the files is streamed
+    from the sources, so the files are never held in the memory as a whole.
+    """
+
+    def __init__(self,
+                 size: int = FATDefaults.SIZE,
+                 block_size: int = 4096,
+                 page_size: int = 256,
+                 inline_max: Optional[int] = None) -> None:
+        """
+        :param page_size: the program (and cache) size, the commits of the metadata are aligned to it
+        :param inline_max: the largest file stored inline in the metadata, littlefs derives it from the cache size
+        """
+        if size % block_size:
+            raise ValueError('The size of the partition must be a multiple of the block size!')
+        self.block_size: int = block_size
+        self.page_size: int = page_size
+        self.block_count: int = size // block_size
+        self.inline_max: int = min(LFS_TAG_SIZE_MAX, page_size, block_size // 8) if inline_max is None else inline_max
+        # the size of the compacted metadata, littlefs splits the directories to keep half of the block for the commits
+        self.metadata_max: int = min(block_size - 40, align_up(block_size // 2, page_size))
+        self.binary_image: bytearray = bytearray(FULL_BYTE * size)
+        self.root: LittleFSObject = LittleFSObject(b'', '', is_dir=True)
+        self.extents: List[ImageExtent] = []
+        # the blocks of the metadata pairs and the files, the free blocks follow them
+        self.used_blocks: int = 0
+        self.ignore_patterns: List[str] = []
+
+    def _ignored(self, name: str, relative_path: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern_) or fnmatch.fnmatch(relative_path, pattern_)
+                   for pattern_ in self.ignore_patterns)
+
+    def _scan(self, source: Union[str, VirtualTree], real_path: str, directory: LittleFSObject) -> None:
+        children_: List[Union[os.DirEntry, VirtualEntry]]
+        if isinstance(source, VirtualTree):
+            children_ = source.scandir(real_path)
+        else:
+            with os.scandir(real_path) as scanned_:
+                children_ = list(scanned_)
+        for child_ in sorted(children_, key=lambda child: child.name.encode()):
+            is_dir_: bool = child_.is_dir()
+            if not is_dir_ and not child_.is_file():
+                continue
+            path_: str = f'{directory.path}/{child_.name}' if directory.path else child_.name
+            if self._ignored(child_.name, path_):
+                continue
+            name_: bytes = child_.name.encode()
+            if len(name_) > LFS_NAME_MAX:
+                raise TooLongNameException(f'The name `{path_}` is longer than {LFS_NAME_MAX} bytes!')
+            if is_dir_:
+                object_: LittleFSObject = LittleFSObject(name_, path_, is_dir=True, real_path=child_.path)
+                directory.children.append(object_)
+                self._scan(source, child_.path, object_)
+            else:
+                directory.children.append(LittleFSObject(name_, path_, is_dir=False, size=child_.stat().st_size,
+                                                         real_path=child_.path,
+                                                         opener=child_.open if isinstance(child_, VirtualEntry)
+                                                         else None))
+
+    def scan(self,
+             input_directory: Union[str, VirtualTree],
+             ignore_patterns: Optional[Iterable[str]] = None) -> LittleFSObject:
+        """
+        Builds the tree of the objects of the partition without writing the image.
+
+        :returns: the root directory
+        """
+        self.ignore_patterns = list(ignore_patterns or [])
+        self.root = LittleFSObject(b'', '', is_dir=True)
+        self._scan(input_directory, '' if isinstance(input_directory, VirtualTree) else input_directory, self.root)
+        return self.root
+
+    def directories(self) -> List[LittleFSObject]:
+        """
+        The directories in the order of the metadata pairs (depth-first), the root first.
+        """
+        directories_: List[LittleFSObject] = []
+        stack_: List[LittleFSObject] = [self.root]
+        while stack_:
+            directory_: LittleFSObject = stack_.pop()
+            directories_.append(directory_)
+            stack_.extend(reversed([child_ for child_ in directory_.children if child_.is_dir]))
+        return directories_
+
+    def files(self) -> List[LittleFSObject]:
+        return [child_ for directory_ in self.directories() for child_ in directory_.children if not child_.is_dir]
+
+    def _is_inline(self, file: LittleFSObject) -> bool:
+        return file.size <= self.inline_max
+
+    def _entry_size(self, object_: LittleFSObject) -> int:
+        struct_size_: int = object_.size if not object_.is_dir and self._is_inline(object_) \
+            else struct.calcsize(CTZ_FORMAT)
+        return 2 * TAG_SIZE + len(object_.name) + struct_size_
+
+    def _split(self, directory: LittleFSObject) -> List[List[LittleFSObject]]:
+        """
+        Splits the entries of the directory to the metadata pairs the same way as littlefs compacts them.
+        """
+        pairs_: List[List[LittleFSObject]] = [[]]
+        # the revision count, the tail and the CRC
+        size_: int = TAG_SIZE + TAIL_SIZE + 2 * TAG_SIZE
+        entries_: int = 0
+        if directory is self.root:
+            size_ += SUPERBLOCK_ENTRY_SIZE
+            entries_ += 1
+        for child_ in directory.children:
+            entry_size_: int = self._entry_size(child_)
+            if entries_ and (align_up(size_ + entry_size_, self.page_size) > self.metadata_max
+                             or entries_ == LFS_ENTRIES_MAX):
+                pairs_.append([])
+                size_, entries_ = TAG_SIZE + TAIL_SIZE + 2 * TAG_SIZE, 0
+            pairs_[-1].append(child_)
+            size_ += entry_size_
+            entries_ += 1
+        return pairs_
+
+    def _allocate(self) -> None:
+        next_block_: int = 0
+        for directory_ in self.directories():
+            directory_.pair_children = self._split(directory_)
+            directory_.pairs = list(range(next_block_, next_block_ + 2 * len(directory_.pair_children), 2))
+            next_block_ += 2 * len(directory_.pair_children)
+        for file_ in self.files():
+            if not self._is_inline(file_):
+                file_.first_block = next_block_
+                next_block_ += ctz_blocks_count(file_.size, self.block_size)
+        self.used_blocks = next_block_
+        if next_block_ > self.block_count:
+            raise NoFreeBlockException(f'The content requires {next_block_} blocks, '
+                                       f'the partition has {self.block_count}!')
+
+    def _write_metadata(self, directory: LittleFSObject, next_pair: Optional[int]) -> None:
+        for index_, (block_, children_) in enumerate(zip(directory.pairs, directory.pair_children)):
+            attributes_: List[Tuple[int, bytes]] = []
+            id_: int = 0
+            if directory is self.root and index_ == 0:
+                superblock_: bytes = struct.pack(SUPERBLOCK_FORMAT, LFS_DISK_VERSION, self.block_size,
+                                                 self.block_count, LFS_NAME_MAX, LFS_FILE_MAX, LFS_ATTR_MAX)
+                attributes_ += [(make_tag(LFS_TYPE_SUPERBLOCK, 0, len(LFS_MAGIC)), LFS_MAGIC),
+                                (make_tag(LFS_TYPE_INLINESTRUCT, 0, len(superblock_)), superblock_)]
+                id_ += 1
+            for child_ in children_:
+                if child_.is_dir:
+                    attributes_ += [(make_tag(LFS_TYPE_DIR, id_, len(child_.name)), child_.name),
+                                    (make_tag(LFS_TYPE_DIRSTRUCT, id_, struct.calcsize(PAIR_FORMAT)),
+                                     struct.pack(PAIR_FORMAT, child_.pairs[0], child_.pairs[0] + 1))]
+                elif child_.first_block is None:
+                    with child_.open() as source_:
+                        content_: bytes = source_.read(child_.size + 1)
+                    if len(content_) != child_.size:
+                        raise ValueError(f'The size of `{child_.path}` has changed!')
+                    attributes_ += [(make_tag(LFS_TYPE_REG, id_, len(child_.name)), child_.name),
+                                    (make_tag(LFS_TYPE_INLINESTRUCT, id_, child_.size), content_)]
+                else:
+                    head_: int = child_.first_block + ctz_blocks_count(child_.size, self.block_size) - 1
+                    attributes_ += [(make_tag(LFS_TYPE_REG, id_, len(child_.name)), child_.name),
+                                    (make_tag(LFS_TYPE_CTZSTRUCT, id_, struct.calcsize(CTZ_FORMAT)),
+                                     struct.pack(CTZ_FORMAT, head_, child_.size))]
+                id_ += 1
+            # the pairs of the directory are linked by the hard tails, the directories by the soft tails
+            tail_: Optional[Tuple[int, int]] = None
+            if index_ + 1 < len(directory.pairs):
+                tail_ = (LFS_TYPE_HARDTAIL, directory.pairs[index_ + 1])
+            elif next_pair is not None:
+                tail_ = (LFS_TYPE_SOFTTAIL, next_pair)
+            if tail_ is not None:
+                attributes_.append((make_tag(tail_[0], LFS_ID_NONE, struct.calcsize(PAIR_FORMAT)),
+                                    struct.pack(PAIR_FORMAT, tail_[1], tail_[1] + 1)))
+            address_: int = block_ * self.block_size
+            self.binary_image[address_: address_ + self.block_size] = build_metadata_block(
+                METADATA_REVISION, attributes_, self.block_size, self.page_size)
+            self.extents.append(ImageExtent(address_, self.block_size, 'superblock' if block_ == 0 else 'directory',
+                                            directory.path))
+
+    def _write_file(self, file: LittleFSObject) -> None:
+        assert file.first_block is not None
+        blocks_cnt_: int = ctz_blocks_count(file.size, self.block_size)
+        view_: memoryview = memoryview(self.binary_image)
+        remaining_: int = file.size
+        with file.open() as source_:
+            for index_ in range(blocks_cnt_):
+                address_: int = (file.first_block + index_) * self.block_size
+                pointers_cnt_: int = ctz_pointers_count(index_)
+                # the pointers to the blocks index - 2^i
+                struct.pack_into(f'<{pointers_cnt_}I', self.binary_image, address_,
+                                 *(file.first_block + index_ - (1 << i_) for i_ in range(pointers_cnt_)))
+                chunk_: int = min(remaining_, ctz_block_capacity(index_, self.block_size))
+                start_: int = address_ + TAG_SIZE * pointers_cnt_
+                read_: int = 0
+                while read_ < chunk_:
+                    data_: bytes = source_.read(chunk_ - read_)
+                    if not data_:
+                        raise ValueError(f'The size of `{file.path}` has changed!')
+                    view_[start_ + read_: start_ + read_ + len(data_)] = data_
+                    read_ += len(data_)
+                remaining_ -= chunk_
+        self.extents.append(ImageExtent(file.first_block * self.block_size, blocks_cnt_ * self.block_size, 'file',
+                                        file.path))
+
+    def generate(self,
+                 input_directory: Union[str, VirtualTree],
+                 ignore_patterns: Optional[Iterable[str]] = None) -> None:
+        """
+        Encodes the folder into the binary image.
+
+        :param input_directory: the directory on the disk or the virtual tree (e.g. the content of the archive)
+        :param ignore_patterns: glob-style patterns of the names or of the paths relative to the input directory
+            (separated by '/') of the objects left out of the partition
+        """
+        self.scan(input_directory, ignore_patterns)
+        self._allocate()
+        directories_: List[LittleFSObject] = self.directories()
+        for index_, directory_ in enumerate(directories_):
+            next_pair_: Optional[int] = directories_[index_ + 1].pairs[0] if index_ + 1 < len(directories_) else None
+            self._write_metadata(directory_, next_pair_)
+        for file_ in self.files():
+            if file_.first_block is not None:
+                self._write_file(file_)
+        self.extents.sort(key=lambda extent: extent.offset)
+
+    def write_filesystem(self, output_path: str) -> None:
+        with open(output_path, 'wb') as output:
+            output.write(self.binary_image)
+
+
+def main() -> None:
+    desc = 'Create a LittleFS filesystem and populate it with directory content'
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('input_directory',
+                        help='Path to the directory that will be encoded into littlefs image, '
+                             'or the tar or zip archive')
+    parser.add_argument('--output_file',
+                        default='littlefs_image.img',
+                        help='Filename of the generated littlefs image')
+    parser.add_argument('--partition_size',
+                        default=FATDefaults.SIZE,
+                        type=lambda value: int(value, 0),
+                        help='Size of the partition in bytes')
+    parser.add_argument('--block_size',
+                        default=4096,
+                        type=int,
+                        help='Size of the erase block in bytes')
+    parser.add_argument('--page_size',
+                        default=256,
+                        type=int,
+                        help='Size of the page (program and cache size) in bytes')
+    parser.add_argument('--ignore',
+                        action='append',
+                        default=[],
+                        help='Glob-style pattern of the names or the relative paths of the files and directories '
+                             'left out of the image, can be repeated')
+    parser.add_argument('--extents_manifest',
+                        default=None,
+                        help='Write the manifest of the populated extents of the image with their hashes to the file')
+    args = parser.parse_args()
+
+    input_directory: Union[str, VirtualTree] = args.input_directory
+    if os.path.isfile(args.input_directory):
+        input_directory = VirtualTree.from_archive(args.input_directory)
+    elif not os.path.isdir(args.input_directory):
+        raise NotADirectoryError(f'The target directory `{args.input_directory}` does not exist!')
+
+    littlefs = LittleFS(size=args.partition_size, block_size=args.block_size, page_size=args.page_size)
+    try:
+        littlefs.generate(input_directory, ignore_patterns=args.ignore)
+    finally:
+        if isinstance(input_directory, VirtualTree):
+            input_directory.close()
+    littlefs.write_filesystem(args.output_file)
+    if args.extents_manifest:
+        ExtentsManifest(littlefs.binary_image, littlefs.extents).write_manifest(args.extents_manifest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import os
+import sys
+from functools import partial
+from typing import List, Optional, Union
+
+from fatfs_utils.content_manifest import ContentManifest, HashTask, hash_file, hash_opened
+from fatfs_utils.littlefs_image import LittleFSImage
+from fatfs_utils.virtual_tree import VirtualTree
+from littlefsgen import LittleFS
+
+
+def image_tasks(littlefs_image: LittleFSImage) -> List[HashTask]:
+    """
+    The hashing tasks of the files of the image, the directories are parsed here, so the tasks only read the content.
+    """
+    tasks_: List[HashTask] = []
+    for directory_, _, _ in littlefs_image.walk():
+        for stat_ in littlefs_image.scandir(directory_):
+            if not stat_.is_dir:
+                tasks_.append((stat_.path, stat_.size, partial(hash_opened, partial(littlefs_image.open, stat_.path),
+                                                               ContentManifest.HASH_ALGORITHM)))
+    return tasks_
+
+
+def directory_tasks(littlefs_image: LittleFSImage,
+                    directory: Union[str, VirtualTree],
+                    ignore_patterns: List[str]) -> List[HashTask]:
+    """
+    The hashing tasks of the files of the directory (or the virtual tree) with the paths they would have
+    in the generated image.
+    """
+    littlefs_: LittleFS = LittleFS(size=littlefs_image.block_count * littlefs_image.block_size,
+                                   block_size=littlefs_image.block_size)
+    littlefs_.scan(directory, ignore_patterns)
+    return [(file_.path, file_.size, partial(hash_opened, file_.opener, ContentManifest.HASH_ALGORITHM)
+             if file_.opener is not None else partial(hash_file, file_.real_path, ContentManifest.HASH_ALGORITHM))
+            for file_ in littlefs_.files()]
+
+
+def verify_image(littlefs_image: LittleFSImage,
+                 directory: str,
+                 ignore_patterns: List[str],
+                 jobs: Optional[int] = None) -> bool:
+    """
+    Compares the files of the image with the files of the directory by their hashes and prints the differences.
+    The files are hashed straight from the image, nothing is extracted. The names are compared case-sensitively
+    as stored by LittleFS.
+    """
+    missing_, extra_, different_ = ContentManifest.compare_tasks(
+        directory_tasks(littlefs_image, directory, ignore_patterns), image_tasks(littlefs_image), jobs)
+    for title_, paths_ in (('Missing in the image', missing_), ('Not in the directory', extra_),
+                           ('Different content', different_)):
+        if paths_:
+            print(f'{title_}:')
+            print('\n'.join(f'    {path_}' for path_ in paths_))
+    if missing_ or extra_ or different_:
+        return False
+    print(f'The image matches the directory `{directory}`.')
+    return True
+
+
+def list_image(littlefs_image: LittleFSImage) -> None:
+    print(f'block size {littlefs_image.block_size}, {littlefs_image.block_count} blocks, '
+          f'disk version {littlefs_image.disk_version >> 16}.{littlefs_image.disk_version & 0xffff}')
+    for directory_, _, _ in littlefs_image.walk():
+        for stat_ in littlefs_image.scandir(directory_):
+            print(f'{stat_.path}/' if stat_.is_dir else f'{stat_.path} {stat_.size}')
+
+
+if __name__ == '__main__':
+    desc = 'Tool for parsing littlefs image and extracting directory structure on host.'
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description=desc)
+    argument_parser.add_argument('input_image',
+                                 help='Path to the image that will be parsed and extracted.')
+    argument_parser.add_argument('--output_directory',
+                                 default='littlefs_image',
+                                 help='The directory the image is extracted to, it must not exist.')
+    argument_parser.add_argument('--block_size',
+                                 type=int,
+                                 default=None,
+                                 help='Size of the erase block in bytes, detected from the superblock by default.')
+    argument_parser.add_argument('--jobs',
+                                 type=int,
+                                 default=None,
+                                 help='Number of threads writing the extracted files or hashing the files.')
+    argument_parser.add_argument('--list',
+                                 action='store_true',
+                                 help='Print the files with their sizes instead of extracting the image.')
+    argument_parser.add_argument('--verify',
+                                 metavar='DIRECTORY',
+                                 default=None,
+                                 help='Compare the files of the image with the directory by their hashes '
+                                      'instead of extracting the image.')
+    argument_parser.add_argument('--ignore',
+                                 action='append',
+                                 default=[],
+                                 help='Glob-style pattern of the names or the relative paths of the files and '
+                                      'directories of the verified directory which are not in the image, '
+                                      'can be repeated')
+    args = argument_parser.parse_args()
+
+    if args.verify is not None and not os.path.isdir(args.verify):
+        raise NotADirectoryError(f'The directory `{args.verify}` does not exist!')
+
+    with LittleFSImage.from_file(args.input_image, block_size=args.block_size) as littlefs_image_:
+        if args.verify is not None:
+            sys.exit(0 if verify_image(littlefs_image_, args.verify, args.ignore, jobs=args.jobs) else 1)
+        if args.list:
+            list_image(littlefs_image_)
+        else:
+            littlefs_image_.extract(args.output_directory, jobs=args.jobs)
@@ -2,17 +2,24 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
+import hashlib
+import io
 import os
 import shutil
 import sys
+import tarfile
 import unittest
-from subprocess import STDOUT, check_output
+import zipfile
+from subprocess import STDOUT, CalledProcessError, check_output
+
+from construct import ConstError, PaddingError
 
 from test_utils import CFG, fill_sector, generate_test_dir_1, generate_test_dir_2
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import fatfsgen  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.boot_sector import BootSector  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.content_manifest import ContentManifest  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.cluster import Cluster  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.entry import Entry  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.exceptions import InconsistentFATAttributes  # noqa E402  # pylint: disable=C0413
@@ -20,8 +27,20 @@ from fatfs_utils.exceptions import NotInitialized  # noqa E402  # pylint: disabl
 from fatfs_utils.exceptions import TooLongNameException  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.exceptions import WriteDirectoryException  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.exceptions import LowerCaseException, NoFreeClusterException  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.extents import ExtentsManifest, fat_image_extents  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.fat import FAT, pack_fat12, unpack_fat12  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.fat_image import FATImage  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.geometry_optimizer import format_candidates, optimize_geometry  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.layout import StableLayout  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.partition_plan import PartitionPlan  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.utils import right_strip_string  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.utils import FAT12, read_filesystem  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.virtual_tree import VirtualTree  # noqa E402  # pylint: disable=C0413
+
+
+class NonSeekable(io.BytesIO):
+    def seekable(self) -> bool:
+        return False
 
 
 class FatFSGen(unittest.TestCase):
@@ -434,6 +453,16 @@ class FatFSGen(unittest.TestCase):
             output,
             b'WARNING: It is not recommended to create FATFS with bounding count of clusters: 4085 or 65525\n')
 
+    def test_failed_generation_leaves_no_image(self) -> None:
+        output_file = os.path.join('output_data', 'image.img')
+        with open(os.path.join('test_dir', 'large.txt'), 'wb') as file:
+            file.write(b'a' * 0x10000)
+        self.assertRaises(CalledProcessError, check_output,
+                          ['python', '../fatfsgen.py', '--partition_size', '65536', '--output_file', output_file,
+                           'test_dir'], stderr=STDOUT)
+        self.assertFalse(os.path.exists(output_file))
+        self.assertEqual([name for name in os.listdir('output_data') if name.endswith('.tmp')], [])
+
     def test_boundary_clusters_fat32(self) -> None:
         self.assertRaises(NotImplementedError, fatfsgen.FATFS, size=268419193)
 
@@ -527,9 +556,407 @@ class FatFSGen(unittest.TestCase):
         self.assertEqual(fatfs.fat.get_chained_content(1)[:15], b'WRITEF  TXT \x00\x00\x00')
         self.assertEqual(fatfs.fat.get_chained_content(2)[:15], b'aaaaaaaaaaaaaaa')
 
+    def test_fat12_bulk_packing(self) -> None:
+        raw = b'\xf8\xff\xff\xe8\x43\x00\x05\xf0\xff'
+        table = unpack_fat12(raw, 6)
+        self.assertEqual(list(table), [0xFF8, 0xFFF, 0x3E8, 0x004, 0x005, 0xFFF])
+        self.assertEqual(pack_fat12(table), raw)
+        self.assertEqual(pack_fat12(unpack_fat12(raw, 5)), raw[:7] + b'\x00')
+
+    def test_fat_table_matches_image(self) -> None:
+        fatfs = fatfsgen.FATFS()
+        fatfs.create_file('WRITEF', extension='TXT')
+        fatfs.write_content(path_from_root=['WRITEF.TXT'], content=3 * CFG['sector_size'] * b'a')
+        fatfs.fat.clusters[7].set_in_fat(0x123)
+        # the table parsed from the image equals the one built in memory
+        parsed = FAT(fatfs.state.boot_sector_state, init_=False)
+        self.assertEqual(parsed.table, fatfs.fat.table)
+        self.assertEqual(fatfs.fat.clusters[2].next_cluster.id, 3)
+        self.assertIsNone(fatfs.fat.clusters[4].next_cluster)
+        image = bytes(fatfs.state.binary_image)
+        fatfs.fat.write_table()
+        self.assertEqual(bytes(fatfs.state.binary_image), image)
+
+    def test_chain_runs(self) -> None:
+        fatfs = fatfsgen.FATFS()
+        fatfs.create_file('WRITEF', extension='TXT')
+        fatfs.write_content(path_from_root=['WRITEF.TXT'], content=3 * CFG['sector_size'] * b'a')
+        self.assertEqual(fatfs.fat.get_chain_runs(2), [(0x6000, 0x3000)])
+        self.assertEqual(fatfs.fat.get_chain_runs(2, size=0x2001), [(0x6000, 0x2001)])
+        # fragment the chain: 2 -> 3 -> 6
+        fatfs.fat.clusters[3].set_in_fat(6)
+        fatfs.fat.clusters[6].set_in_fat(0xFFF)
+        self.assertEqual(fatfs.fat.get_cluster_chain(2), [2, 3, 6])
+        self.assertEqual(fatfs.fat.get_chain_runs(2), [(0x6000, 0x2000), (0xa000, 0x1000)])
+        output = io.BytesIO()
+        self.assertEqual(fatfs.fat.write_chained_content(output, 2, size=0x2800), 0x2800)
+        self.assertEqual(output.getvalue(), fatfs.fat.get_chained_content(2, size=0x2800))
+
+    def test_streaming_generation(self) -> None:
+        with open(os.path.join(CFG['test_dir'], 'test', 'large.bin'), 'wb') as file:
+            file.write(bytes(range(256)) * 100)
+        with open(os.path.join(CFG['test_dir'], 'empty'), 'wb'):
+            pass
+        fatfs = fatfsgen.FATFS(size=0x40000)
+        fatfs.generate(CFG['test_dir'])
+        fatfs.write_filesystem(CFG['output_file'])
+        file_system = read_filesystem(CFG['output_file'])
+
+        streamed_file = os.path.join('output_data', 'streamed.img')
+        fatfs = fatfsgen.FATFS(size=0x40000, output_path=streamed_file)
+        fatfs.generate(CFG['test_dir'])
+        fatfs.write_filesystem(streamed_file)
+        fatfs.close()
+        streamed_file_system = read_filesystem(streamed_file)
+
+        # the images differ only in the random volume ID
+        self.assertEqual(streamed_file_system[:39], file_system[:39])
+        self.assertEqual(streamed_file_system[43:], file_system[43:])
+
+    def test_stable_layout(self) -> None:
+        layout = StableLayout(slack=0.5)
+        fatfs = fatfsgen.FATFS(layout=layout)
+        fatfs.generate(CFG['test_dir'])
+        fatfs.write_filesystem(CFG['output_file'])
+        file_system = read_filesystem(CFG['output_file'])
+        self.assertEqual(StableLayout.from_image(CFG['output_file'], slack=0.5).extents, layout.placed)
+
+        # the new file precedes the existing ones in the traversal order
+        with open(os.path.join(CFG['test_dir'], 'test', 'aaa'), 'wb') as file:
+            file.write(b'a' * 5000)
+        manifest_file = os.path.join('output_data', 'layout.json')
+        layout.write_manifest(manifest_file)
+        new_layout = StableLayout.load(manifest_file, slack=0.5)
+        fatfs = fatfsgen.FATFS(layout=new_layout)
+        fatfs.generate(CFG['test_dir'])
+        new_file_system = fatfs.state.binary_image
+
+        self.assertEqual({key: value for key, value in new_layout.placed.items() if key != 'TEST/AAA'}, layout.placed)
+        first_cluster, clusters_cnt = new_layout.placed['TEST/AAA']
+        self.assertEqual(clusters_cnt, 3)
+        # the FAT, the directory TEST and the content of the new file
+        test_dir_sector = (0x6000 + (layout.placed['TEST'][0] - 2) * 0x1000) // 0x1000
+        changed_sectors = [i for i in range(len(file_system) // 0x1000)
+                           if file_system[i * 0x1000: (i + 1) * 0x1000]
+                           != new_file_system[i * 0x1000: (i + 1) * 0x1000]]
+        self.assertEqual(changed_sectors, [1, test_dir_sector, 6 + first_cluster - 2, 6 + first_cluster - 1])
+
+    def test_stable_layout_default_datetime(self) -> None:
+        fatfs = fatfsgen.FATFS(use_default_datetime=False, layout=StableLayout())
+        self.assertTrue(fatfs.state.use_default_datetime)
+
+    def test_directory_index(self) -> None:
+        fatfs = fatfsgen.FATFS(long_names_enabled=True)
+        fatfs.create_directory('TESTFOLD')
+        for i in range(300):
+            fatfs.create_file(f'F{i}', extension='TXT', path_from_root=['TESTFOLD'], is_empty=True)
+        fatfs.create_file('thisisverylongfilenama', extension='txt', path_from_root=['TESTFOLD'])
+        fatfs.create_file('thisisverylongfilenamb', extension='txt', path_from_root=['TESTFOLD'])
+        fatfs.write_filesystem(CFG['output_file'])
+        file_system = read_filesystem(CFG['output_file'])
+
+        directory = fatfs.root_directory.recursive_search(['TESTFOLD'], fatfs.root_directory)
+        self.assertEqual(fatfs.root_directory.recursive_search(['TESTFOLD', 'F299.TXT'], fatfs.root_directory).name,
+                         'F299')
+        self.assertIsNone(directory.lookup_entity('F300', 'TXT'))
+        self.assertEqual(directory.prefix_counter['thisis'], 2)
+        # '.', '..' and 300 files fill two clusters and 46 entries of the third one,
+        # each long name takes two LFN entries and the short entry
+        self.assertEqual(file_system[0x7000:0x700c], b'F126    TXT ')
+        self.assertEqual(file_system[0x85a0:0x85ac], b'F299    TXT ')
+        self.assertEqual(file_system[0x8600:0x860b], b'thisis~\x01txt')
+        self.assertEqual(file_system[0x8660:0x866b], b'thisis~\x02txt')
+        self.assertEqual(fatfs.fat.get_cluster_chain(2), [2, 3, 4])
+        self.assertIs(directory.find_free_entry(), directory.entries[308])
+
+    def test_directory_path_cache(self) -> None:
+        fatfs = fatfsgen.FATFS()
+        fatfs.create_directory('TESTFOLD')
+        fatfs.create_directory('NESTED', path_from_root=['TESTFOLD'])
+        fatfs.create_directory('DEEP', path_from_root=['TESTFOLD', 'NESTED'])
+        fatfs.create_file('WRITEF', extension='TXT', path_from_root=['TESTFOLD', 'NESTED', 'DEEP'])
+        fatfs.write_content(path_from_root=['TESTFOLD', 'NESTED', 'DEEP', 'WRITEF.TXT'], content=b'deep')
+
+        root = fatfs.root_directory
+        deep = root.search_directory(['TESTFOLD', 'NESTED', 'DEEP'])
+        self.assertIs(deep, root.recursive_search(['TESTFOLD', 'NESTED', 'DEEP'], root))
+        self.assertIs(root.search_entity(['TESTFOLD', 'NESTED', 'DEEP', 'WRITEF.TXT']), deep.entities[0])
+        with self.assertRaises(FileNotFoundError):
+            root.search_entity(['TESTFOLD', 'NESTED', 'MISSING.TXT'])
+        with self.assertRaises(FileNotFoundError):
+            root.search_directory(['TESTFOLD', 'MISSING'])
+
+    def test_lazy_directory_entries(self) -> None:
+        fatfs = fatfsgen.FATFS()
+        fatfs.create_directory('TESTFOLD')
+        fatfs.create_file('WRITEF', extension='TXT', path_from_root=['TESTFOLD'])
+        fatfs.create_file('WRITEF2', extension='TXT', path_from_root=['TESTFOLD'])
+        directory = fatfs.root_directory.search_directory(['TESTFOLD'])
+
+        self.assertEqual(len(directory.entries), 128)
+        # '.', '..' and two files
+        self.assertEqual(directory.entries.materialized_count, 4)
+        self.assertEqual(directory.entries[3].entry_address, 0x6060)
+        self.assertIs(directory.find_free_entry(), directory.entries[4])
+        self.assertEqual(directory.entries[-1].entry_address, 0x6fe0)
+
+    def test_struct_codecs(self) -> None:
+        fatfs = fatfsgen.FATFS(long_names_enabled=True)
+        fatfs.create_directory('TESTFOLD')
+        fatfs.create_file('thisislongname', extension='txt', path_from_root=['TESTFOLD'])
+        fatfs.write_content(['TESTFOLD', 'thisislongname.txt'], b'a' * 5000)
+        fatfs.write_filesystem(CFG['output_file'])
+        image = read_filesystem(CFG['output_file'])
+
+        boot_sector = image[:BootSector.BOOT_HEADER_SIZE]
+        parsed = BootSector.BOOT_SECTOR_CODEC.parse(boot_sector)
+        self.assertEqual(parsed, {k: v for k, v in BootSector.BOOT_SECTOR_HEADER.parse(boot_sector).items()
+                                  if k != '_io'})
+        self.assertEqual(BootSector.BOOT_SECTOR_CODEC.build(parsed), BootSector.BOOT_SECTOR_HEADER.build(parsed))
+        self.assertEqual(BootSector.BOOT_SECTOR_CODEC.build(parsed), boot_sector)
+
+        directory = image[0x6000:0x6000 + 5 * Entry.ENTRY_CODEC.size]
+        # '.', '..', two LFN entries and the short entry of the file
+        for entry_bytes, fast in zip([directory[i: i + 32] for i in range(0, len(directory), 32)],
+                                     Entry.ENTRY_CODEC.iter_parse(directory)):
+            if entry_bytes[11] == Entry.ATTR_LONG_NAME:
+                continue
+            self.assertEqual(fast, {k: v for k, v in Entry.ENTRY_FORMAT_SHORT_NAME.parse(entry_bytes).items()
+                                    if k != '_io'})
+            self.assertEqual(Entry.ENTRY_CODEC.build(fast), Entry.ENTRY_FORMAT_SHORT_NAME.build(fast))
+            self.assertEqual(Entry.ENTRY_CODEC.build(fast), entry_bytes)
+        self.assertEqual(fast['DIR_Name'], 'thisis~\x01')
+        self.assertEqual(fast['DIR_FileSize'], 5000)
+
+        # invalid data and fields are reported by construct
+        with self.assertRaises(ConstError):
+            BootSector.BOOT_SECTOR_CODEC.parse(b'\x00' * BootSector.BOOT_HEADER_SIZE)
+        with self.assertRaises(PaddingError):
+            Entry.ENTRY_CODEC.build(dict(fast, DIR_Name='TOOLONGNAME'))
+        self.assertIsNone(Entry.ENTRY_CODEC.decode(Entry.ENTRY_CODEC.iter_unpack(b'\xff' * 32).__next__()))
+
     def test_lstrip(self) -> None:
         self.assertEqual(right_strip_string('\x20\x20\x20thisistest\x20\x20\x20'), '   thisistest')
 
+    def test_partition_plan(self) -> None:
+        long_names_dir = os.path.join(CFG['test_dir'], 'test', 'longnames')
+        os.makedirs(long_names_dir)
+        for i in range(130):
+            with open(os.path.join(long_names_dir, f'{i:03}thisislongname.txt'), 'wb') as file:
+                file.write(b'a' * 4100)
+        plan = PartitionPlan(CFG['test_dir'], long_names_enabled=True)
+        self.assertEqual([object_.path for object_ in plan.objects][:4],
+                         [('TEST',), ('TEST', 'LONGNAMES'), ('TEST', 'LONGNAMES', '000THISISLONGNAME.TXT'),
+                          ('TEST', 'LONGNAMES', '001THISISLONGNAME.TXT')])
+        self.assertEqual(plan.root_entries, 2)
+        # two LFN entries and the short entry for every file, '.' and '..'
+        self.assertEqual(plan.objects[1].clusters, 4)
+        # the long file names, the directory LONGNAMES, two other directories and three small files
+        self.assertEqual(plan.clusters, 260 + 4 + 2 + 3)
+
+        geometry = plan.geometry()
+        self.assertEqual(geometry.fatfs_type, FAT12)
+        self.assertEqual(geometry.used_clusters, 269)
+        self.assertGreaterEqual(geometry.data_clusters, geometry.used_clusters)
+        fatfs = fatfsgen.FATFS(size=geometry.size, long_names_enabled=True)
+        fatfs.generate(CFG['test_dir'], plan)
+        self.assertEqual(fatfs.fat.free_clusters_count, geometry.data_clusters - geometry.used_clusters)
+        self.assertEqual(fatfs.state.boot_sector_state.sectors_per_fat_cnt, geometry.fat_sectors)
+        fatfs.write_filesystem(CFG['output_file'])
+
+        # the plan matches the scan of the generator and the size is minimal
+        fatfs = fatfsgen.FATFS(size=geometry.size, long_names_enabled=True)
+        fatfs.generate(CFG['test_dir'])
+        file_system = read_filesystem(CFG['output_file'])
+        # except the random volume ID
+        self.assertEqual(fatfs.state.binary_image[:39], file_system[:39])
+        self.assertEqual(fatfs.state.binary_image[43:], file_system[43:])
+        fatfs = fatfsgen.FATFS(size=geometry.size - 0x1000, long_names_enabled=True)
+        self.assertRaises(NoFreeClusterException, fatfs.generate, CFG['test_dir'], plan)
+
+        with self.assertRaises(NoFreeClusterException):
+            plan.geometry(root_entry_count=1)
+
+    def test_geometry_optimizer(self) -> None:
+        with open(os.path.join(CFG['test_dir'], 'test', 'bigfile'), 'wb') as file:
+            file.write(b'a' * 600000)
+        plan = PartitionPlan(CFG['test_dir'])
+        candidates = optimize_geometry(plan)
+        # two root directory sizes for every sector size
+        self.assertEqual(len(candidates), 8)
+        best = candidates[0].geometry
+        self.assertEqual((best.sector_size, best.root_entry_count), (512, 32))
+        self.assertEqual([candidate.geometry.size for candidate in candidates],
+                         sorted(candidate.geometry.size for candidate in candidates))
+        self.assertEqual(len(format_candidates(candidates).splitlines()), 9)
+
+        fatfs = fatfsgen.FATFS(size=best.size, sector_size=best.sector_size, root_entry_count=best.root_entry_count)
+        fatfs.generate(CFG['test_dir'], plan.with_sector_size(best.sector_size))
+        self.assertEqual(len(fatfs.state.binary_image), best.size)
+        self.assertEqual(fatfs.fat.free_clusters_count, 0)
+        self.assertEqual(candidates[0].non_blank_sectors,
+                         len([i for i in range(best.sectors_count)
+                              if fatfs.state.binary_image[i * 512: (i + 1) * 512] != b'\xff' * 512]))
+
+        # the content doesn't fit the sectors of 4096 bytes in the partition of this size
+        candidates = optimize_geometry(plan, partition_size=0x9B000)
+        self.assertNotIn(4096, [candidate.geometry.sector_size for candidate in candidates])
+        self.assertEqual([candidate.free_bytes for candidate in candidates],
+                         sorted((candidate.free_bytes for candidate in candidates), reverse=True))
+
+    def test_virtual_tree(self) -> None:
+        os.makedirs(os.path.join(CFG['test_dir'], 'test', '__pycache__'))
+        with open(os.path.join(CFG['test_dir'], 'test', '__pycache__', 'mod.pyc'), 'wb') as file:
+            file.write(b'compiled')
+        ignore_patterns = ['__pycache__', '*.pyc']
+        fatfs = fatfsgen.FATFS()
+        fatfs.generate(CFG['test_dir'], ignore_patterns=ignore_patterns)
+        # except the random volume ID
+        expected_image = fatfs.state.binary_image[:39] + fatfs.state.binary_image[43:]
+        self.assertNotIn(b'compiled', fatfs.state.binary_image)
+        self.assertNotIn(b'__PYCA', fatfs.state.binary_image)
+
+        files = {'testfile': b'ahoj\n', 'test/testfil2': io.BytesIO(b'thisistest\n'),
+                 'test/test/lastfile': b'deeptest\n', 'test/__pycache__/mod.pyc': b'compiled'}
+        tar_buffer = io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w:gz') as archive:
+            archive.add(CFG['test_dir'], arcname='.')
+        zip_path = os.path.join('output_data', 'tree.zip')
+        with zipfile.ZipFile(zip_path, 'w') as archive:
+            for path, content in files.items():
+                archive.writestr(path, content if isinstance(content, bytes) else content.getvalue())
+        repository = os.path.join('output_data', 'repository')
+        shutil.copytree(CFG['test_dir'], repository)
+        for command in (['init', '-q'], ['add', '-A'],
+                        ['-c', 'user.name=a', '-c', 'user.email=a', 'commit', '-qm', 'a']):
+            check_output(['git', '-C', repository] + command)
+        # the uncommitted changes are not part of the image
+        with open(os.path.join(repository, 'testfile'), 'w') as file:
+            file.write('changed')
+
+        trees = [VirtualTree.from_dict(files),
+                 VirtualTree.from_tar(io.BytesIO(tar_buffer.getvalue())),
+                 VirtualTree.from_tar(NonSeekable(tar_buffer.getvalue())),
+                 VirtualTree.from_archive(zip_path),
+                 VirtualTree.from_git(repository)]
+        for tree in trees:
+            fatfs = fatfsgen.FATFS()
+            fatfs.generate(tree, ignore_patterns=ignore_patterns)
+            self.assertEqual(fatfs.state.binary_image[:39] + fatfs.state.binary_image[43:], expected_image)
+
+    def test_virtual_tree_close(self) -> None:
+        tar_path = os.path.join('output_data', 'tree.tar')
+        with tarfile.open(tar_path, 'w') as archive:
+            archive.add(CFG['test_dir'], arcname='.')
+        with VirtualTree.from_archive(tar_path) as tree:
+            entry = [entry for entry in tree.scandir() if entry.name == 'testfile'][0]
+            with entry.open() as file:
+                self.assertEqual(file.read(), b'ahoj\n')
+        self.assertRaises((OSError, ValueError), entry.open)
+
+        # the stream of the file is shared by the readers, closing one of them leaves it open
+        tree = VirtualTree.from_dict({'testfile': io.BytesIO(b'ahoj\n')})
+        for _ in range(2):
+            with tree.scandir()[0].open() as file:
+                self.assertEqual(file.read(), b'ahoj\n')
+
+    def test_virtual_tree_links(self) -> None:
+        os.symlink('testfile', os.path.join(CFG['test_dir'], 'link.txt'))
+        os.symlink(os.path.join('test', 'test'), os.path.join(CFG['test_dir'], 'dirlink'))
+        os.symlink(os.path.join('..', 'dirlink', 'lastfile'), os.path.join(CFG['test_dir'], 'test', 'chained'))
+        fatfs = fatfsgen.FATFS(long_names_enabled=True)
+        fatfs.generate(CFG['test_dir'])
+        expected_image = fatfs.state.binary_image[:39] + fatfs.state.binary_image[43:]
+        self.assertTrue(b'LINK    TXT' in fatfs.state.binary_image and b'DIRLINK' in fatfs.state.binary_image)
+
+        tar_buffer = io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w') as archive:
+            archive.add(CFG['test_dir'], arcname='.')
+        repository = os.path.join('output_data', 'repository')
+        shutil.copytree(CFG['test_dir'], repository, symlinks=True)
+        for command in (['init', '-q'], ['add', '-A'],
+                        ['-c', 'user.name=a', '-c', 'user.email=a', 'commit', '-qm', 'a']):
+            check_output(['git', '-C', repository] + command)
+        for tree in (VirtualTree.from_tar(io.BytesIO(tar_buffer.getvalue())), VirtualTree.from_git(repository)):
+            fatfs = fatfsgen.FATFS(long_names_enabled=True)
+            fatfs.generate(tree)
+            self.assertEqual(fatfs.state.binary_image[:39] + fatfs.state.binary_image[43:], expected_image)
+
+        tree = VirtualTree.from_dict({'a/file': b'a'})
+        self.assertRaises(FileNotFoundError, tree.add_links, [('a/link', 'a/missing')])
+        self.assertRaises(ValueError, tree.add_links, [('a/link', '.')])
+        for target in ('../../outside', '/etc/passwd'):
+            archive_buffer = io.BytesIO()
+            with tarfile.open(fileobj=archive_buffer, mode='w') as archive:
+                member = tarfile.TarInfo('a/link')
+                member.type, member.linkname = tarfile.SYMTYPE, target
+                archive.addfile(member)
+            self.assertRaises(ValueError, VirtualTree.from_tar, io.BytesIO(archive_buffer.getvalue()))
+
+    def test_extents_manifest(self) -> None:
+        fatfs = fatfsgen.FATFS(long_names_enabled=True)
+        fatfs.generate(CFG['test_dir'])
+        fatfs.create_file('EMPTY', is_empty=True)
+        image = fatfs.state.binary_image
+        extents = fat_image_extents(image)
+        self.assertEqual([(extent.kind, extent.path) for extent in extents[:5]],
+                         [('boot_sector', ''), ('fat', ''), ('root_directory', ''), ('directory', 'TEST'),
+                          ('directory', 'TEST/TEST')])
+        self.assertEqual(len(extents), 8)
+
+        # the image is restored from the extents written to the erased flash
+        manifest = ExtentsManifest(image, extents).to_manifest()
+        flash = bytearray(b'\xff' * manifest['image_size'])
+        for extent in manifest['extents']:
+            flash[extent['offset']: extent['offset'] + extent['length']] = \
+                image[extent['offset']: extent['offset'] + extent['length']]
+        self.assertEqual(flash, image)
+        self.assertEqual(ExtentsManifest.verify(manifest, flash), [])
+        flash[0x6010] = 0
+        self.assertEqual(ExtentsManifest.verify(manifest, flash), [extents[3]])
+
+    def test_content_manifest(self) -> None:
+        plan = PartitionPlan(CFG['test_dir'])
+        fatfs = fatfsgen.FATFS()
+        fatfs.generate(CFG['test_dir'], plan)
+        manifest = fatfs.add_content_manifest()
+        text = FATImage(fatfs.state.binary_image).read_file('MANIFEST.SHA').decode()
+        self.assertEqual(len(text), ContentManifest.planned_size(plan))
+        self.assertEqual(text.splitlines()[1:], [
+            hashlib.sha256(b'deeptest\n').hexdigest() + ' 9 TEST/TEST/LASTFILE',
+            hashlib.sha256(b'thisistest\n').hexdigest() + ' 11 TEST/TESTFIL2',
+            hashlib.sha256(b'ahoj\n').hexdigest() + ' 5 TESTFILE',
+        ])
+        self.assertEqual(ContentManifest.parse(text).tree_hash, manifest.tree_hash)
+        self.assertEqual(ContentManifest.from_image(FATImage(fatfs.state.binary_image)).to_text(), text)
+        with self.assertRaises(ValueError):
+            ContentManifest.parse(text.replace(' 5 ', ' 6 '))
+
+        fatfs = fatfsgen.FATFS()
+        fatfs.generate(VirtualTree.from_dict({'testfile': b'ahoj\n', 'test/testfil2': b'changed\n',
+                                              'test/other': b''}))
+        other = ContentManifest.from_image(FATImage(fatfs.state.binary_image))
+        self.assertNotEqual(other.tree_hash, manifest.tree_hash)
+        self.assertEqual(manifest.diff(other), (['TEST/TEST/LASTFILE'], ['TEST/OTHER'], ['TEST/TESTFIL2']))
+
+    def test_content_manifest_full_root(self) -> None:
+        # the root directory of two sectors holds 32 entries
+        files = {f'F{i}': b'a' for i in range(32)}
+        fatfs = fatfsgen.FATFS(sector_size=512, root_entry_count=32)
+        fatfs.generate(VirtualTree.from_dict(files))
+        self.assertRaisesRegex(NoFreeClusterException, 'root', fatfs.add_content_manifest)
+
+        full_root = os.path.join('output_data', 'full_root')
+        os.makedirs(full_root)
+        for name, content in files.items():
+            with open(os.path.join(full_root, name), 'wb') as file:
+                file.write(content)
+        with self.assertRaises(CalledProcessError) as error:
+            check_output(['python', '../fatfsgen.py', '--sector_size', '512', '--root_entry_count', '32',
+                          '--partition_size', 'detect', '--content_manifest', 'MANIFEST.SHA',
+                          '--output_file', os.path.join('output_data', 'image.img'), full_root], stderr=STDOUT)
+        self.assertIn(b'Not enough space in root!', error.exception.output)
+
 
 if __name__ == '__main__':
     unittest.main()
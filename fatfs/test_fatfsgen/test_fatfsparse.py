@@ -6,13 +6,18 @@ import os
 import shutil
 import sys
 import unittest
-from subprocess import STDOUT, run
+from subprocess import PIPE, STDOUT, run
 
 from test_utils import compare_folders, fill_sector, generate_local_folder_structure, generate_test_dir_2
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import fatfsgen  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.defragmenter import FATDefragmenter, same_content  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.entry import Entry  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.fat_editor import FATEditor  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.fat_image import FATImage  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.utils import FATDefaults  # noqa E402  # pylint: disable=C0413
+from wl_fatfsgen import add_wl, remove_wl, wl_parameters  # noqa E402  # pylint: disable=C0413
 
 
 class FatFSGen(unittest.TestCase):
@@ -324,6 +329,166 @@ class FatFSGen(unittest.TestCase):
         run(['python', '../fatfsparse.py', 'fatfs_image.img'], stderr=STDOUT)
         assert compare_folders('testf', 'Espressif')
 
+    def test_fat_image_reader(self) -> None:
+        fatfs = fatfsgen.FATFS(long_names_enabled=True)
+        fatfs.create_directory('TESTFOLD')
+        fatfs.create_file('WRITEF', extension='TXT', path_from_root=['TESTFOLD'])
+        content_ = bytes(range(256)) * 40
+        fatfs.write_content(path_from_root=['TESTFOLD', 'WRITEF.TXT'], content=content_)
+        fatfs.create_file('averylongfilename', extension='txt')
+        fatfs.write_content(path_from_root=['averylongfilename.txt'], content=b'hello')
+        fatfs.write_filesystem('fatfs_image.img')
+
+        with FATImage.from_file('fatfs_image.img') as image_:
+            self.assertEqual(set(image_.listdir()), {'TESTFOLD', 'averylongfilename.txt'})
+            self.assertEqual(image_.listdir('TESTFOLD'), ['WRITEF.TXT'])
+            self.assertTrue(image_.stat('/TESTFOLD').is_dir)
+            self.assertEqual(image_.stat('testfold/writef.txt').size, len(content_))
+            self.assertEqual(image_.read_file('averylongfilename.txt'), b'hello')
+            self.assertEqual(list(image_.walk()), [('', ['TESTFOLD'], ['averylongfilename.txt']),
+                                                   ('TESTFOLD', [], ['WRITEF.TXT'])])
+            with image_.open('TESTFOLD/WRITEF.TXT') as file_:
+                self.assertEqual(file_.read(10), content_[:10])
+                file_.seek(4090)
+                self.assertEqual(file_.read(12), content_[4090:4102])
+                file_.seek(-5, 2)
+                self.assertEqual(file_.read(), content_[-5:])
+                self.assertEqual(file_.read(), b'')
+            with self.assertRaises(FileNotFoundError):
+                image_.stat('TESTFOLD/MISSING')
+
+    def test_fat_image_extract(self) -> None:
+        run(['python', '../fatfsgen.py', 'output_data/tst_str'], stderr=STDOUT)
+        with FATImage.from_file('fatfs_image.img') as image_:
+            image_.extract('Espressif', jobs=4)
+
+        assert set(os.listdir('Espressif')) == {'TEST', 'TESTFILE'}
+        assert set(os.listdir('Espressif/TEST')) == {'TEST', 'TESTFIL2'}
+        with open('Espressif/TEST/TESTFIL2', 'rb') as in_:
+            assert in_.read() == b'thisistest\n'
+        with open('Espressif/TEST/TEST/LASTFILE.TXT', 'rb') as in_:
+            assert in_.read() == b'deeptest\n'
+
+    def test_verify(self) -> None:
+        run(['python', '../wl_fatfsgen.py', 'output_data/tst_str', '--content_manifest'], stderr=STDOUT)
+        result_ = run(['python', '../fatfsparse.py', 'fatfs_image.img', '--verify', 'output_data/tst_str'],
+                      stdout=PIPE, stderr=STDOUT)
+        assert result_.returncode == 0
+        assert not os.path.exists('Espressif')
+
+        with open('output_data/tst_str/test/testfil2', 'w') as out_:
+            out_.write('changed\n')
+        with open('output_data/tst_str/newfile', 'w') as out_:
+            out_.write('new\n')
+        os.makedirs('output_data/tst_str/__pycache__')
+        with open('output_data/tst_str/__pycache__/mod.pyc', 'w') as out_:
+            out_.write('ignored\n')
+        result_ = run(['python', '../fatfsparse.py', 'fatfs_image.img', '--verify', 'output_data/tst_str',
+                       '--ignore', '__pycache__', '--jobs', '2'], stdout=PIPE, stderr=STDOUT)
+        assert result_.returncode == 1
+        assert result_.stdout.decode().split() == ['Missing', 'in', 'the', 'image:', 'NEWFILE',
+                                                   'Different', 'content:', 'TEST/TESTFIL2']
+        assert not os.path.exists('Espressif')
+
+    @staticmethod
+    def _generate_image(directories: list, files: list) -> bytearray:
+        fatfs = fatfsgen.FATFS(long_names_enabled=True)
+        for directory in directories:
+            fatfs.create_directory(directory)
+        for path, content in files:
+            name, extension = os.path.splitext(path[-1])
+            fatfs.create_file(name, extension=extension[1:], path_from_root=path[:-1] or None)
+            fatfs.write_content(path, content)
+        image_ = fatfs.state.binary_image
+        # the volume ID is random
+        image_[39:43] = bytes(4)
+        return image_
+
+    def test_fat_editor_add(self) -> None:
+        files_ = [(['TESTFOLD', 'FILE.TXT'], b'a' * 5000),
+                  (['TESTFOLD', 'thisislongname.txt'], b'b' * 100),
+                  (['ROOT.BIN'], b'c' * 9000)]
+        expected_ = self._generate_image(['TESTFOLD'], files_)
+        image_ = self._generate_image(['TESTFOLD'], files_[:1])
+        editor_ = FATEditor(image_)
+        editor_.add_file('TESTFOLD/thisislongname.txt', b'b' * 100)
+        editor_.add_file('ROOT.BIN', b'c' * 9000)
+        self.assertEqual(image_, expected_)
+        # FAT, root directory, TESTFOLD and the data of the new files
+        self.assertEqual(editor_.dirty_sectors, [1, 2, 6, 9, 10, 11, 12])
+        self.assertEqual(editor_.dirty_extents(), [(0x1000, 0x2000), (0x6000, 0x1000), (0x9000, 0x4000)])
+
+        image_ = self._generate_image([], [])
+        editor_ = FATEditor(image_)
+        editor_.mkdir('TESTFOLD')
+        for path_, content_ in files_:
+            editor_.add_file('/'.join(path_), content_)
+        self.assertEqual(image_, expected_)
+        with self.assertRaises(FileExistsError):
+            editor_.add_file('testfold/file.txt', b'')
+        with self.assertRaises(FileNotFoundError):
+            editor_.add_file('MISSING/FILE.TXT', b'')
+
+    def test_fat_editor_modify(self) -> None:
+        image_ = self._generate_image(['TESTFOLD'], [(['TESTFOLD', 'FILE.TXT'], b'a' * 5000),
+                                                     (['TESTFOLD', 'thisislongname.txt'], b'b' * 100),
+                                                     (['ROOT.BIN'], b'c' * 9000)])
+        editor_ = FATEditor(image_)
+        editor_.replace_file('TESTFOLD/FILE.TXT', b'd' * 100)
+        # only the FAT, the entry and the first cluster of the file, the second cluster is freed
+        self.assertEqual(editor_.dirty_sectors, [1, 6, 7])
+        editor_.delete('ROOT.BIN')
+        editor_.rename('TESTFOLD/thisislongname.txt', 'moved_long_name.txt')
+        editor_.rename('TESTFOLD', 'NEWDIR')
+        free_clusters_ = editor_.fat.free_clusters_count
+        editor_.add_file('BIG.BIN', b'e' * 20000)
+        self.assertEqual(editor_.fat.free_clusters_count, free_clusters_ - 5)
+
+        reader_ = FATImage(image_)
+        self.assertEqual(list(reader_.walk()), [('', ['NEWDIR'], ['BIG.BIN', 'moved_long_name.txt']),
+                                                ('NEWDIR', [], ['FILE.TXT'])])
+        self.assertEqual(reader_.read_file('NEWDIR/FILE.TXT'), b'd' * 100)
+        self.assertEqual(reader_.read_file('moved_long_name.txt'), b'b' * 100)
+        self.assertEqual(reader_.read_file('BIG.BIN'), b'e' * 20000)
+        # the freed clusters are reused first
+        self.assertEqual(editor_.fat.get_cluster_chain(reader_.stat('BIG.BIN').first_cluster), [4, 6, 7, 8, 9])
+
+        with self.assertRaises(OSError):
+            editor_.delete('NEWDIR')
+        editor_.delete('NEWDIR/FILE.TXT')
+        editor_.delete('NEWDIR')
+        self.assertEqual(FATImage(image_).listdir(), ['BIG.BIN', 'moved_long_name.txt'])
+
+    def test_defragment(self) -> None:
+        image_ = self._generate_image(['TESTFOLD'], [(['TESTFOLD', f'FILE{i}.TXT'], bytes([i]) * 5000)
+                                                     for i in range(6)])
+        editor_ = FATEditor(image_)
+        for i in range(0, 6, 2):
+            editor_.delete(f'TESTFOLD/FILE{i}.TXT')
+        editor_.add_file('TESTFOLD/thisislongname.txt', b'a' * 20000)
+        editor_.replace_file('TESTFOLD/FILE1.TXT', b'b' * 9000)
+        fragmentation_ = FATDefragmenter(image_).fragmentation()
+        self.assertEqual((fragmentation_.files, fragmentation_.fragmented_files), (4, 2))
+
+        defragmented_ = FATDefragmenter(image_).defragment()
+        fragmentation_ = FATDefragmenter(defragmented_).fragmentation()
+        self.assertEqual((fragmentation_.files, fragmentation_.fragmented_files, fragmentation_.fragments), (4, 0, 5))
+        self.assertEqual((fragmentation_.free_runs, fragmentation_.free_tail), (1, fragmentation_.free_clusters))
+        self.assertTrue(same_content(FATImage(image_), FATImage(defragmented_)))
+
+        # the partition with wear levelling read back from the device: the dummy sector, 2 copies of the state
+        # (2 sectors each) and the config sector
+        partition_ = add_wl(image_, len(image_) + 6 * FATDefaults.WL_SECTOR_SIZE, device_id=1234)
+        with open('fragmented.img', 'wb') as image_file:
+            image_file.write(partition_)
+        run([sys.executable, '../fatfsdefrag.py', 'fragmented.img', 'defragmented.img'], stderr=STDOUT, check=True)
+        with open('defragmented.img', 'rb') as image_file:
+            partition_ = image_file.read()
+        self.assertEqual(wl_parameters(partition_)['device_id'], 1234)
+        self.assertEqual(remove_wl(partition_), defragmented_)
+        os.remove('fragmented.img')
+        os.remove('defragmented.img')
+
     def test_parse_long_name(self) -> None:
         self.assertEqual(
             Entry.parse_entry_long(
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2022 Espressif Systems (Shanghai) CO LTD
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import shutil
+import struct
+import sys
+import unittest
+from subprocess import PIPE, STDOUT, run
+
+from test_utils import generate_test_dir_2
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import littlefsgen  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.exceptions import NoFreeBlockException  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.littlefs_format import (LFS_TYPE_DELETE, LFS_TYPE_INLINESTRUCT,  # noqa E402  # pylint: disable=C0413
+                                         LFS_TYPE_REG, LFS_TYPE_SUPERBLOCK, build_metadata_block,
+                                         ctz_blocks_count, ctz_index, lfs_crc, make_tag)
+from fatfs_utils.littlefs_image import LittleFSImage  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.virtual_tree import VirtualTree  # noqa E402  # pylint: disable=C0413
+
+
+class LittleFSGen(unittest.TestCase):
+    def setUp(self) -> None:
+        os.makedirs('output_data')
+        generate_test_dir_2()
+
+    def tearDown(self) -> None:
+        shutil.rmtree('output_data')
+
+    def test_crc(self) -> None:
+        self.assertEqual(lfs_crc(0xffffffff, b'123456789'), 0xcbf43926 ^ 0xffffffff)
+        self.assertEqual(lfs_crc(lfs_crc(0xffffffff, b'1234'), b'56789'), lfs_crc(0xffffffff, b'123456789'))
+
+    def test_ctz_skip_list(self) -> None:
+        # the last byte of the file is in the last block of the skip-list
+        for size in [1, 4095, 4096, 4097, 8188, 8189, 12280, 12281, 100000, 1 << 20]:
+            self.assertEqual(ctz_index(size - 1, 4096)[0] + 1, ctz_blocks_count(size, 4096), size)
+        self.assertEqual(ctz_index(4096, 4096), (1, 4))
+        self.assertEqual(ctz_index(8188, 4096), (2, 8))
+
+    def test_superblock(self) -> None:
+        littlefs = littlefsgen.LittleFS(size=0x10000)
+        littlefs.generate(VirtualTree.from_dict({'boot.py': b'import mct\n'}))
+        image = littlefs.binary_image
+        self.assertEqual(image[:4], b'\x01\x00\x00\x00')
+        self.assertEqual(image[8:16], b'littlefs')
+        self.assertEqual(struct.unpack_from('<6I', image, 20), (0x20000, 4096, 16, 255, 2147483647, 1022))
+        # the inline file follows the superblock
+        self.assertEqual(image[48:55], b'boot.py')
+        self.assertEqual(image[59:70], b'import mct\n')
+        # the commit is padded to the page, the other block of the pair is erased
+        self.assertEqual(image[256:0x2000], b'\xff' * (0x2000 - 256))
+        self.assertEqual([(extent.offset, extent.length, extent.kind) for extent in littlefs.extents],
+                         [(0, 4096, 'superblock')])
+        self.assertEqual(littlefs.used_blocks, 2)
+
+    def test_generate_directory(self) -> None:
+        with open(os.path.join('output_data', 'tst_str', 'large.bin'), 'wb') as file:
+            file.write(bytes(range(256)) * 64)
+        littlefs = littlefsgen.LittleFS(size=0x20000)
+        littlefs.generate(os.path.join('output_data', 'tst_str'), ignore_patterns=['testfile'])
+        self.assertEqual([(extent.offset, extent.length, extent.kind, extent.path) for extent in littlefs.extents],
+                         [(0x0000, 0x1000, 'superblock', ''), (0x2000, 0x1000, 'directory', 'test'),
+                          (0x4000, 0x1000, 'directory', 'test/test'), (0x6000, 0x5000, 'file', 'large.bin')])
+        self.assertNotIn(b'testfile', littlefs.binary_image)
+        # the first block holds the data only, the second one starts with the pointer to the first one
+        self.assertEqual(littlefs.binary_image[0x6000:0x7000], bytes(range(256)) * 16)
+        self.assertEqual(littlefs.binary_image[0x7000:0x7004], b'\x06\x00\x00\x00')
+        self.assertEqual(littlefs.binary_image[0x7004:0x7100], bytes(range(252)))
+
+        # the layout does not depend on the source
+        tree = VirtualTree.from_dict({'large.bin': bytes(range(256)) * 64, 'test/testfil2': b'thisistest\n',
+                                      'test/test/lastfile.txt': b'deeptest\n'})
+        other = littlefsgen.LittleFS(size=0x20000)
+        other.generate(tree)
+        self.assertEqual(other.binary_image, littlefs.binary_image)
+
+        with self.assertRaises(NoFreeBlockException):
+            littlefsgen.LittleFS(size=0x7000).generate(tree)
+
+    def test_cli(self) -> None:
+        littlefsgen_path = os.path.join(os.path.dirname(__file__), '..', 'littlefsgen.py')
+        output_file = os.path.join('output_data', 'littlefs.img')
+        run([sys.executable, littlefsgen_path, os.path.join('output_data', 'tst_str'), '--partition_size', '0x20000',
+             '--output_file', output_file], stderr=STDOUT, check=True)
+        self.assertEqual(os.path.getsize(output_file), 0x20000)
+
+    def test_parse_image(self) -> None:
+        large = bytes(range(256)) * 100
+        with open(os.path.join('output_data', 'tst_str', 'large.bin'), 'wb') as file:
+            file.write(large)
+        littlefs = littlefsgen.LittleFS(size=0x20000, block_size=1024, page_size=64)
+        littlefs.generate(os.path.join('output_data', 'tst_str'))
+        image = LittleFSImage(littlefs.binary_image)
+        self.assertEqual((image.block_size, image.block_count), (1024, 128))
+        self.assertEqual(image.listdir(), ['large.bin', 'test', 'testfile'])
+        self.assertEqual(list(image.walk()), [('', ['test'], ['large.bin', 'testfile']),
+                                              ('test', ['test'], ['testfil2']), ('test/test', [], ['lastfile.txt'])])
+        self.assertEqual(image.stat('large.bin').size, len(large))
+        self.assertTrue(image.stat('test/test').is_dir)
+        self.assertFalse(image.exists('TESTFILE'))
+        self.assertEqual(image.read_file('large.bin'), large)
+        self.assertEqual(image.read_file('test/test/lastfile.txt'), b'deeptest\n')
+        with image.open('large.bin') as file:
+            file.seek(1020)
+            self.assertEqual(file.read(8), large[1020:1028])
+
+        image.extract(os.path.join('output_data', 'extracted'))
+        with open(os.path.join('output_data', 'extracted', 'large.bin'), 'rb') as file:
+            self.assertEqual(file.read(), large)
+        with open(os.path.join('output_data', 'extracted', 'test', 'testfil2'), 'rb') as file:
+            self.assertEqual(file.read(), b'thisistest\n')
+
+    def test_parse_revisions(self) -> None:
+        littlefs = littlefsgen.LittleFS(size=0x10000)
+        littlefs.generate(VirtualTree.from_dict({'old.txt': b'old\n'}))
+        image = littlefs.binary_image
+        superblock = [(make_tag(LFS_TYPE_SUPERBLOCK, 0, 8), b'littlefs'),
+                      (make_tag(LFS_TYPE_INLINESTRUCT, 0, 24), bytes(image[20:44]))]
+        # the other block of the superblock pair with the newer revision, the second file is created and deleted
+        image[0x1000:0x2000] = build_metadata_block(2, superblock + [
+            (make_tag(LFS_TYPE_REG, 1, 7), b'new.txt'), (make_tag(LFS_TYPE_INLINESTRUCT, 1, 4), b'new\n'),
+            (make_tag(LFS_TYPE_REG, 2, 4), b'gone'), (make_tag(LFS_TYPE_INLINESTRUCT, 2, 0), b''),
+            (make_tag(LFS_TYPE_DELETE, 2, 0), b'')], 4096, 256)
+        parsed = LittleFSImage(image)
+        self.assertEqual(parsed.listdir(), ['new.txt'])
+        self.assertEqual(parsed.read_file('new.txt'), b'new\n')
+        # the commit with the invalid CRC is ignored, so the older block is used
+        image[0x1000 + 60] ^= 0xff
+        self.assertEqual(LittleFSImage(image).listdir(), ['old.txt'])
+
+    def test_parse_cli(self) -> None:
+        littlefsgen_path = os.path.join(os.path.dirname(__file__), '..', 'littlefsgen.py')
+        littlefsparse_path = os.path.join(os.path.dirname(__file__), '..', 'littlefsparse.py')
+        source = os.path.join('output_data', 'tst_str')
+        image_path = os.path.join('output_data', 'littlefs.img')
+        run([sys.executable, littlefsgen_path, source, '--partition_size', '0x20000', '--output_file', image_path],
+            stderr=STDOUT, check=True)
+        result = run([sys.executable, littlefsparse_path, image_path, '--verify', source], stdout=PIPE, check=True)
+        self.assertIn(b'The image matches the directory', result.stdout)
+
+        with open(os.path.join(source, 'test', 'testfil2'), 'ab') as file:
+            file.write(b'changed\n')
+        with open(os.path.join(source, 'Testfile'), 'wb') as file:
+            file.write(b'case\n')
+        result = run([sys.executable, littlefsparse_path, image_path, '--verify', source], stdout=PIPE)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout.decode().splitlines(), ['Missing in the image:', '    Testfile',
+                                                               'Different content:', '    test/testfil2'])
+        result = run([sys.executable, littlefsparse_path, image_path, '--verify', source, '--ignore', 'Testfile',
+                      '--ignore', 'test'], stdout=PIPE)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout.decode().splitlines(), ['Not in the directory:', '    test/test/lastfile.txt',
+                                                               '    test/testfil2'])
+
+        output_directory = os.path.join('output_data', 'extracted')
+        run([sys.executable, littlefsparse_path, image_path, '--output_directory', output_directory], check=True)
+        with open(os.path.join(output_directory, 'test', 'test', 'lastfile.txt'), 'rb') as file:
+            self.assertEqual(file.read(), b'deeptest\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
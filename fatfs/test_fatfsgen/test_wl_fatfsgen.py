@@ -12,6 +12,8 @@ from test_utils import CFG, generate_test_dir_1, generate_test_dir_2
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import wl_fatfsgen  # noqa E402  # pylint: disable=C0413
 from fatfs_utils.exceptions import WLNotInitialized  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.extents import ExtentsManifest  # noqa E402  # pylint: disable=C0413
+from fatfs_utils.utils import FATDefaults  # noqa E402  # pylint: disable=C0413
 
 
 class WLFatFSGen(unittest.TestCase):
@@ -137,6 +139,62 @@ class WLFatFSGen(unittest.TestCase):
         self.assertEqual(file_system[0xa000:0xa010], b'thisistest\n\x00\x00\x00\x00\x00')
         self.assertEqual(file_system[0xb000:0xb010], b'ahoj\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
 
+    def test_remove_wl_view(self) -> None:
+        fatfs = wl_fatfsgen.WLFATFS()
+        fatfs.plain_fatfs.generate(CFG['test_dir2'])
+        fatfs.init_wl()
+        fatfs.wl_write_filesystem(CFG['output_file'])
+        with open(CFG['output_file'], 'rb') as fs_file:
+            file_system = bytearray(fs_file.read())
+        # tag the sectors so misplaced ones are detected
+        for sector_ in range(len(file_system) // FATDefaults.WL_SECTOR_SIZE - fatfs.wl_state_sectors * 2 - 1):
+            file_system[sector_ * FATDefaults.WL_SECTOR_SIZE + 0x800: sector_ * FATDefaults.WL_SECTOR_SIZE + 0x802] = \
+                sector_.to_bytes(2, 'little')
+        state_start_ = len(file_system) - (fatfs.wl_state_sectors * 2 + 1) * FATDefaults.WL_SECTOR_SIZE
+        for records_cnt_, move_count_ in ((0, 0), (3, 0), (0, 5), (7, 2), (20, 11), (511, 511)):
+            image_ = bytearray(file_system)
+            image_[state_start_ + 8: state_start_ + 12] = move_count_.to_bytes(4, 'little')
+            records_start_ = state_start_ + wl_fatfsgen.WLFATFS.WL_STATE_HEADER_SIZE
+            image_[records_start_: records_start_ + 16 * records_cnt_] = 16 * records_cnt_ * b'\x00'
+            self.assertEqual(bytes(wl_fatfsgen.remove_wl_view(image_)), wl_fatfsgen.remove_wl(image_))
+
+    def test_wl_struct_codecs(self) -> None:
+        fatfs = wl_fatfsgen.WLFATFS()
+        fatfs.plain_fatfs.create_file('TESTFILE')
+        fatfs.init_wl()
+        fatfs.wl_write_filesystem(CFG['output_file'])
+        with open(CFG['output_file'], 'rb') as fs_file:
+            file_system = fs_file.read()
+        state_start_ = len(file_system) - (fatfs.wl_state_sectors * 2 + 1) * FATDefaults.WL_SECTOR_SIZE
+        config_start_ = len(file_system) - FATDefaults.WL_SECTOR_SIZE
+        for codec_, definition_, data_ in (
+                (wl_fatfsgen.WLFATFS.WL_STATE_CODEC, wl_fatfsgen.WLFATFS.WL_STATE_T_DATA,
+                 file_system[state_start_: state_start_ + wl_fatfsgen.WLFATFS.WL_STATE_HEADER_SIZE]),
+                (wl_fatfsgen.WLFATFS.WL_CONFIG_CODEC, wl_fatfsgen.WLFATFS.WL_CONFIG_T_DATA,
+                 file_system[config_start_: config_start_ + wl_fatfsgen.WLFATFS.WL_CONFIG_T_HEADER_SIZE])):
+            parsed_ = codec_.parse(data_)
+            self.assertEqual(parsed_, {k: v for k, v in definition_.parse(data_).items() if k != '_io'})
+            self.assertEqual(codec_.build(parsed_), definition_.build(parsed_))
+            self.assertEqual(codec_.build(parsed_), data_[:codec_.size])
+
+    def test_wl_extents(self) -> None:
+        fatfs = wl_fatfsgen.WLFATFS(device_id=3750448905)
+        fatfs.plain_fatfs.generate(CFG['test_dir'])
+        self.assertRaises(WLNotInitialized, fatfs.wl_extents)
+        fatfs.init_wl()
+        image = bytes(fatfs.fatfs_binary_image)
+        extents = fatfs.wl_extents()
+        self.assertEqual([extent.kind for extent in extents[-3:]], ['wl_state', 'wl_state', 'wl_config'])
+        self.assertEqual(extents[0].offset, FATDefaults.WL_SECTOR_SIZE)
+
+        manifest = ExtentsManifest(image, extents).to_manifest()
+        flash = bytearray(b'\xff' * len(image))
+        for extent in manifest['extents']:
+            flash[extent['offset']: extent['offset'] + extent['length']] = \
+                image[extent['offset']: extent['offset'] + extent['length']]
+        self.assertEqual(flash, image)
+        self.assertEqual(ExtentsManifest.verify(manifest, image), [])
+
 
 if __name__ == '__main__':
     unittest.main()
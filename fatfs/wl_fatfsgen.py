@@ -2,14 +2,24 @@
 # SPDX-FileCopyrightText: 2021-2022 Espressif Systems (Shanghai) CO LTD
 # SPDX-License-Identifier: Apache-2.0
 
+from typing import Any, Dict, List, Tuple
+
 from construct import Const, Int32ul, Struct
 from fatfs_utils.exceptions import WLNotInitialized
+from fatfs_utils.extents import ExtentsManifest, ImageExtent, fat_image_extents
+from fatfs_utils.image_view import ImageView
+from fatfs_utils.struct_codec import StructCodec
 from fatfs_utils.utils import (FULL_BYTE, UINT32_MAX, FATDefaults, crc32, generate_4bytes_random,
                                get_args_for_partition_generator)
 from fatfsgen import FATFS
 
 
-def remove_wl(binary_image: bytes) -> bytes:
+def _wl_layout(binary_image: Any) -> Tuple[int, int, int]:
+    """
+    Reads the wear levelling state at the end of the partition.
+
+    :returns: position of the dummy sector (number of the state records), move count and size of one state copy
+    """
     partition_size: int = len(binary_image)
     total_sectors: int = partition_size // FATDefaults.WL_SECTOR_SIZE
     wl_state_size: int = WLFATFS.WL_STATE_HEADER_SIZE + WLFATFS.WL_STATE_RECORD_SIZE * total_sectors
@@ -22,7 +32,7 @@ def remove_wl(binary_image: bytes) -> bytes:
 
     correct_wl_configuration = binary_image[-wl_sectors_size:]
 
-    data_ = WLFATFS.WL_STATE_T_DATA.parse(correct_wl_configuration[:WLFATFS.WL_STATE_HEADER_SIZE])
+    data_ = WLFATFS.WL_STATE_CODEC.parse(correct_wl_configuration[:WLFATFS.WL_STATE_HEADER_SIZE])
 
     total_records = 0
     # iterating over records field of the first copy of the state sector
@@ -31,6 +41,11 @@ def remove_wl(binary_image: bytes) -> bytes:
             total_records += 1
         else:
             break
+    return total_records, data_['move_count'], wl_state_total_size
+
+
+def remove_wl(binary_image: bytes) -> bytes:
+    total_records, move_count, wl_state_total_size = _wl_layout(binary_image)
     before_dummy = binary_image[:total_records * FATDefaults.WL_SECTOR_SIZE]
     after_dummy = binary_image[total_records * FATDefaults.WL_SECTOR_SIZE + FATDefaults.WL_SECTOR_SIZE:]
     new_image: bytes = before_dummy + after_dummy
@@ -39,11 +54,61 @@ def remove_wl(binary_image: bytes) -> bytes:
     new_image = new_image[:len(new_image) - (FATDefaults.WL_SECTOR_SIZE + 2 * wl_state_total_size)]
 
     # reorder to preserve original order
-    new_image = (new_image[-data_['move_count'] * FATDefaults.WL_SECTOR_SIZE:]
-                 + new_image[:-data_['move_count'] * FATDefaults.WL_SECTOR_SIZE])
+    new_image = (new_image[-move_count * FATDefaults.WL_SECTOR_SIZE:]
+                 + new_image[:-move_count * FATDefaults.WL_SECTOR_SIZE])
     return new_image
 
 
+def remove_wl_view(binary_image: Any) -> ImageView:
+    """
+    Same as `remove_wl`, but the partition without wear levelling is expressed as remapping of the sectors
+    of `binary_image` (e.g. mmap of the partition file) instead of the copies of its content.
+    """
+    total_records, move_count, wl_state_total_size = _wl_layout(binary_image)
+    image_: ImageView = ImageView(binary_image)
+    before_dummy = image_.view(None, total_records * FATDefaults.WL_SECTOR_SIZE)
+    after_dummy = image_.view(total_records * FATDefaults.WL_SECTOR_SIZE + FATDefaults.WL_SECTOR_SIZE)
+    new_image: ImageView = before_dummy + after_dummy
+
+    # remove wl sectors
+    new_image = new_image.view(None, len(new_image) - (FATDefaults.WL_SECTOR_SIZE + 2 * wl_state_total_size))
+
+    # reorder to preserve original order
+    new_image = (new_image.view(-move_count * FATDefaults.WL_SECTOR_SIZE)
+                 + new_image.view(None, -move_count * FATDefaults.WL_SECTOR_SIZE))
+    return new_image
+
+
+def wl_parameters(binary_image: Any) -> Dict[str, int]:
+    """
+    Reads the parameters of the wear levelling layer the partition was created with.
+
+    :returns: keyword arguments `device_id`, `version` and `temp_buff_size` of `WLFATFS`
+    """
+    _, _, wl_state_total_size = _wl_layout(binary_image)
+    state_start_: int = len(binary_image) - (FATDefaults.WL_SECTOR_SIZE
+                                             + WLFATFS.WL_STATE_COPY_COUNT * wl_state_total_size)
+    state_ = WLFATFS.WL_STATE_CODEC.parse(binary_image[state_start_: state_start_ + WLFATFS.WL_STATE_CODEC.size])
+    config_start_: int = len(binary_image) - FATDefaults.WL_SECTOR_SIZE
+    config_ = WLFATFS.WL_CONFIG_CODEC.parse(binary_image[config_start_: config_start_ + WLFATFS.WL_CONFIG_CODEC.size])
+    return dict(device_id=state_['device_id'], version=config_['version'], temp_buff_size=config_['temp_buff_size'])
+
+
+def add_wl(plain_image: Any, partition_size: int, **kwargs: Any) -> bytes:
+    """
+    Wraps the plain FAT image into the wear levelling layer, the reverse of `remove_wl`.
+    The state of the layer is initial, as in the generated partition.
+
+    :param kwargs: the parameters of the layer, see `wl_parameters`
+    """
+    wl_fatfs_: WLFATFS = WLFATFS(size=partition_size, **kwargs)
+    if len(plain_image) != wl_fatfs_.plain_fat_sectors * FATDefaults.WL_SECTOR_SIZE:
+        raise ValueError('The size of the image does not match the partition size!')
+    wl_fatfs_.plain_fatfs.state.binary_image = plain_image
+    wl_fatfs_.init_wl()
+    return bytes(wl_fatfs_.fatfs_binary_image)
+
+
 class WLFATFS:
     # pylint: disable=too-many-instance-attributes
     WL_CFG_SECTORS_COUNT = 1
@@ -78,6 +143,21 @@ class WLFATFS:
     )
     WL_CONFIG_T_HEADER_SIZE = 48
 
+    WL_STATE_CODEC = StructCodec(WL_STATE_T_DATA, [
+        ('pos', 'I'),
+        ('max_pos', 'I'),
+        ('move_count', 'I'),
+        ('access_count', 'I'),
+        ('max_count', 'I'),
+        ('block_size', 'I'),
+        ('version', 'I'),
+        ('device_id', 'I'),
+        ('reserved', '28s'),
+    ])
+    WL_CONFIG_CODEC = StructCodec(WL_CONFIG_T_DATA, [(name_, 'I') for name_ in (
+        'start_addr', 'full_mem_size', 'page_size', 'sector_size', 'updaterate', 'wr_size', 'version', 'temp_buff_size'
+    )])
+
     def __init__(self,
                  size: int = FATDefaults.SIZE,
                  sector_size: int = FATDefaults.SECTOR_SIZE,
@@ -148,7 +228,7 @@ class WLFATFS:
         self.fatfs_binary_image = FATDefaults.WL_SECTOR_SIZE * FULL_BYTE + self.fatfs_binary_image
 
     def _add_config_sector(self) -> None:
-        wl_config_data = WLFATFS.WL_CONFIG_T_DATA.build(
+        wl_config_data = WLFATFS.WL_CONFIG_CODEC.build(
             dict(
                 start_addr=0,
                 full_mem_size=self.partition_size,
@@ -171,7 +251,7 @@ class WLFATFS:
             wl_config + (FATDefaults.WL_SECTOR_SIZE - WLFATFS.WL_CONFIG_HEADER_SIZE) * FULL_BYTE)
 
     def _add_state_sectors(self) -> None:
-        wl_state_data = WLFATFS.WL_STATE_T_DATA.build(
+        wl_state_data = WLFATFS.WL_STATE_CODEC.build(
             dict(
                 pos=0,
                 max_pos=self.plain_fat_sectors + WLFATFS.WL_DUMMY_SECTORS_COUNT,
@@ -192,6 +272,21 @@ class WLFATFS:
         )
         self.fatfs_binary_image += (WLFATFS.WL_STATE_COPY_COUNT * wl_state_sector)
 
+    def wl_extents(self) -> List[ImageExtent]:
+        """
+        The populated extents of the partition: the extents of the FAT image behind the dummy sector,
+        the first sectors of the state copies (the rest of the state is erased) and the config sector.
+        """
+        if not self._initialized:
+            raise WLNotInitialized('FATFS is not initialized with WL. First call method WLFATFS.init_wl!')
+        state_start_: int = FATDefaults.WL_SECTOR_SIZE + self.plain_fat_sectors * FATDefaults.WL_SECTOR_SIZE
+        state_copy_size_: int = self.wl_state_sectors * FATDefaults.WL_SECTOR_SIZE
+        return fat_image_extents(self.plain_fatfs.state.binary_image, base_offset=FATDefaults.WL_SECTOR_SIZE) + [
+            ImageExtent(state_start_ + i * state_copy_size_, FATDefaults.WL_SECTOR_SIZE, 'wl_state')
+            for i in range(WLFATFS.WL_STATE_COPY_COUNT)
+        ] + [ImageExtent(state_start_ + WLFATFS.WL_STATE_COPY_COUNT * state_copy_size_,
+                         FATDefaults.WL_SECTOR_SIZE, 'wl_config')]
+
     def wl_write_filesystem(self, output_path: str) -> None:
         if not self._initialized:
             raise WLNotInitialized('FATFS is not initialized with WL. First call method WLFATFS.init_wl!')
@@ -211,5 +306,9 @@ if __name__ == '__main__':
                        use_default_datetime=args.use_default_datetime)
 
     wl_fatfs.plain_fatfs.generate(args.input_directory)
+    if args.content_manifest:
+        wl_fatfs.plain_fatfs.add_content_manifest(args.content_manifest)
     wl_fatfs.init_wl()
     wl_fatfs.wl_write_filesystem(args.output_file)
+    if args.extents_manifest:
+        ExtentsManifest(wl_fatfs.fatfs_binary_image, wl_fatfs.wl_extents()).write_manifest(args.extents_manifest)